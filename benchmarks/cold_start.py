@@ -0,0 +1,142 @@
+"""
+Cold start benchmark for the CloudWatchAutoAlarms Lambda function.
+
+Measures, in fresh Python processes, the time to import the function module and the time until the AWS SDK clients
+an event needs are built and their service models loaded.  The clients are real botocore clients created offline,
+no AWS credentials or network access are needed and no API calls are made.  Exits with status 1 when the median
+import time or the median cold start time exceeds its budget.
+
+    python benchmarks/cold_start.py --runs 10 --output cold-start.json
+    python benchmarks/cold_start.py --env STARTUP_MODE=eager
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.join(os.path.dirname(benchmarks_dir), 'src')
+
+local_account_id = '100000000000'
+events = {
+    'ec2-event': {'source': 'aws.ec2', 'detail-type': 'EC2 Instance State-change Notification',
+                  'account': local_account_id, 'region': 'us-east-1',
+                  'detail': {'instance-id': 'i-0123456789abcdef0', 'state': 'running'}},
+    'cross-account-ec2-event': {'source': 'aws.ec2', 'detail-type': 'EC2 Instance State-change Notification',
+                                'account': '200000000000', 'region': 'us-east-1',
+                                'detail': {'instance-id': 'i-0123456789abcdef0', 'state': 'running'}},
+    'lambda-event': {'source': 'aws.lambda', 'account': local_account_id, 'region': 'us-east-1',
+                     'detail': {'eventName': 'TagResource20170331v2'}},
+    'scan': {'action': 'scan'},
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the cold start of the Lambda function.')
+    parser.add_argument('--events', nargs='+', choices=sorted(events), default=sorted(events),
+                        help='event types to measure the cold start for')
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes per event type, the median is reported')
+    parser.add_argument('--env', nargs='*', default=[], metavar='NAME=VALUE',
+                        help='additional Lambda environment variables, e.g. STARTUP_MODE=eager')
+    parser.add_argument('--max-import-ms', type=float, default=150.0,
+                        help='exit with status 1 if the median import time of an event type exceeds this budget')
+    parser.add_argument('--max-cold-start-ms', type=float, default=600.0,
+                        help='exit with status 1 if the median time until the clients of an event type are ready '
+                             'exceeds this budget')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        print(json.dumps(measure_cold_start(json.loads(args.child))))
+        return 0
+
+    environment = dict(variable.split('=', 1) for variable in args.env)
+    results = list()
+    over_budget = list()
+    for event_type in args.events:
+        runs = [run_in_subprocess(event_type, environment) for _ in range(args.runs)]
+        result = {
+            'event': event_type,
+            'env': environment,
+            'runs': len(runs),
+            'services': runs[0]['services'],
+            'import_ms': round(statistics.median(run['import_ms'] for run in runs), 1),
+            'clients_ms': round(statistics.median(run['clients_ms'] for run in runs), 1),
+            'cold_start_ms': round(statistics.median(run['import_ms'] + run['clients_ms'] for run in runs), 1),
+        }
+        print('{event}: {cold_start_ms} ms cold start, {import_ms} ms import, {clients_ms} ms clients for '
+              '{service_list}'.format(service_list=', '.join(result['services']) or 'no services', **result))
+        if result['import_ms'] > args.max_import_ms:
+            over_budget.append('{} import {} ms > {} ms'.format(event_type, result['import_ms'], args.max_import_ms))
+        if result['cold_start_ms'] > args.max_cold_start_ms:
+            over_budget.append('{} cold start {} ms > {} ms'.format(event_type, result['cold_start_ms'],
+                                                                    args.max_cold_start_ms))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'generated_at': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+        print('Results written to {}'.format(args.output))
+    if over_budget:
+        print('Over budget: {}'.format(', '.join(over_budget)))
+        return 1
+    return 0
+
+
+def run_in_subprocess(event_type, environment):
+    child_environment = dict(os.environ)
+    child_environment.update({
+        'LOCAL_ACCOUNT_ID': local_account_id,
+        'TARGET_REGIONS': 'us-east-1',
+        'AWS_REGION': 'us-east-1',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        # static credentials keep botocore from searching the credential provider chain
+        'AWS_ACCESS_KEY_ID': 'cold-start-benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'cold-start-benchmark',
+        'AWS_EC2_METADATA_DISABLED': 'true',
+        'API_METRICS': 'false',
+    })
+    child_environment.update(environment)
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(event_type)],
+                            stdout=subprocess.PIPE, check=True, universal_newlines=True,
+                            env=child_environment).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_cold_start(event_type):
+    sys.path.insert(0, src_dir)
+    start = time.perf_counter()
+    import cw_auto_alarms
+    import_time = time.perf_counter() - start
+
+    # the clients lambda_handler preloads for the event, built here without invoking the handler so no API calls
+    # are made
+    import actions
+    services = cw_auto_alarms.event_services(events[event_type])
+    start = time.perf_counter()
+    for preloaded in actions.preload_clients(services, 'us-east-1'):
+        preloaded.result()
+    clients_time = time.perf_counter() - start
+    return {
+        'services': services,
+        'import_ms': import_time * 1000.0,
+        'clients_ms': clients_time * 1000.0,
+    }
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,553 @@
+"""
+In-process stand-in for the AWS APIs used by the CloudWatchAutoAlarms Lambda function.
+
+FakeAws generates a synthetic fleet of EC2 instances, Lambda functions and RDS databases spread over a number of
+accounts and regions and serves EC2, Lambda, RDS, Resource Groups Tagging, CloudWatch, STS and Organizations calls for
+it from memory.  Every call is counted per operation and can be
+delayed by a fixed latency to approximate network round trips.  Install it with FakeAws.install(), which replaces
+boto3.client.
+"""
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import boto3
+from botocore.exceptions import ClientError
+
+LOCAL_ACCOUNT_ID = '100000000000'
+MANAGEMENT_ACCOUNT_ID = '900000000000'
+ORGANIZATIONAL_UNIT_ID = 'ou-fake-00000001'
+# the target OU, a child OU and a grandchild OU, accounts are spread over the three
+NESTED_ORGANIZATIONAL_UNIT_IDS = [ORGANIZATIONAL_UNIT_ID, 'ou-fake-00000002', 'ou-fake-00000003']
+ALARM_TAG = 'Create_Auto_Alarms'
+
+# ImageId suffix, PlatformDetails, Name
+AMIS = [
+    ('al2', 'Linux/UNIX', 'amzn2-ami-kernel-5.10-hvm-x86_64-gp2'),
+    ('ubuntu', 'Linux/UNIX', 'ubuntu/images/hvm-ssd/ubuntu-jammy-22.04-amd64-server'),
+    ('windows', 'Windows', 'Windows_Server-2022-English-Full-Base'),
+    ('rhel', 'Red Hat Enterprise Linux', 'RHEL-9.2.0_HVM-x86_64-GP2'),
+    ('suse', 'SUSE Linux', 'suse-sles-15-sp5-v20230620-hvm-ssd-x86_64'),
+]
+DEREGISTERED_AMI = ('deregistered', 'Red Hat Enterprise Linux', None)
+
+DISKS = {
+    'al2': [('nvme0n1p1', 'xfs', '/')],
+    'ubuntu': [('xvda1', 'ext4', '/'), ('xvdb', 'ext4', '/data')],
+    'rhel': [('xvda2', 'xfs', '/')],
+    'suse': [('xvda1', 'xfs', '/')],
+    'deregistered': [('xvda2', 'xfs', '/')],
+}
+
+_snake_case_boundary = re.compile(r'_([a-z])')
+
+
+def operation_name(method_name):
+    return _snake_case_boundary.sub(lambda match: match.group(1).upper(), '_' + method_name)
+
+
+class FakeAws:
+    def __init__(self, accounts=1, regions=('us-east-1',), instances=100, latency=0.0, tagged_fraction=0.8,
+                 custom_tag_fraction=0.25, asg_size=50, quotas=None):
+        self.account_ids = [LOCAL_ACCOUNT_ID] + ['{:012d}'.format(200000000000 + n) for n in range(accounts - 1)]
+        self.regions = list(regions)
+        self.latency = latency
+        self.calls = Counter()
+        self.throttled = Counter()
+        # requests per second allowed per account, region and operation, calls above the quota are throttled
+        self.quotas = dict(quotas or dict())
+        self._quota_usage = dict()
+        self._lock = threading.Lock()
+        self._units = dict()
+
+        units = [(account_id, region) for account_id in self.account_ids for region in self.regions]
+        per_unit, remainder = divmod(instances, len(units))
+        for unit_index, (account_id, region) in enumerate(units):
+            count = per_unit + (1 if unit_index < remainder else 0)
+            self._units[(account_id, region)] = FleetUnit(unit_index, account_id, region, count, tagged_fraction,
+                                                          custom_tag_fraction, asg_size)
+
+    @property
+    def instance_count(self):
+        return sum(len(unit.instances) for unit in self._units.values())
+
+    @property
+    def tagged_running_instance_count(self):
+        return sum(1 for unit in self._units.values() for instance in unit.instances.values()
+                   if unit.is_tagged(instance) and instance['State']['Name'] == 'running')
+
+    def unit(self, account_id, region):
+        return self._units[(account_id, region)]
+
+    def install(self):
+        boto3.client = self.client
+        return self
+
+    def record(self, service, method_name, account_id, region):
+        operation = operation_name(method_name)
+        with self._lock:
+            self.calls['{}:{}'.format(service, operation)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if operation in self.quotas and not self._within_quota(operation, account_id, region):
+            with self._lock:
+                self.throttled['{}:{}'.format(service, operation)] += 1
+            code = 'RequestLimitExceeded' if service == 'ec2' else 'Throttling'
+            raise ClientError({'Error': {'Code': code, 'Message': 'Rate exceeded'},
+                               'ResponseMetadata': {'HTTPStatusCode': 400, 'RetryAttempts': 0}}, operation)
+
+    def _within_quota(self, operation, account_id, region):
+        # token bucket holding one second worth of requests
+        quota = float(self.quotas[operation])
+        key = (account_id, region, operation)
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated_at = self._quota_usage.get(key, (quota, now))
+            tokens = min(quota, tokens + (now - updated_at) * quota)
+            if tokens < 1:
+                self._quota_usage[key] = (tokens, now)
+                return False
+            self._quota_usage[key] = (tokens - 1, now)
+            return True
+
+    def client(self, service_name, region_name=None, aws_access_key_id=None, aws_secret_access_key=None,
+               aws_session_token=None, config=None, **kwargs):
+        region = region_name or (config.region_name if config else None) or self.regions[0]
+        if aws_access_key_id and aws_access_key_id.startswith('FAKE'):
+            account_id = aws_access_key_id[4:16]
+        else:
+            account_id = LOCAL_ACCOUNT_ID
+        clients = {
+            'ec2': Ec2Client,
+            'cloudwatch': CloudWatchClient,
+            'sts': StsClient,
+            'organizations': OrganizationsClient,
+            'lambda': LambdaClient,
+            'rds': RdsClient,
+            'resourcegroupstaggingapi': TaggingClient,
+            'autoscaling': AutoScalingClient,
+        }
+        return clients[service_name](self, service_name, account_id, region)
+
+
+class FleetUnit:
+    """
+    The instances, images, Lambda functions, RDS databases, metrics and alarms of one account and region.  The unit
+    has one Lambda function per 20 instances, one RDS database instance per 50 and one RDS cluster per 200.
+    """
+
+    def __init__(self, unit_index, account_id, region, count, tagged_fraction, custom_tag_fraction, asg_size):
+        self.account_id = account_id
+        self.region = region
+        self.instances = dict()
+        self.images = dict()
+        self.alarms = dict()
+        self._alarm_prefixes = dict()
+        self._lock = threading.Lock()
+
+        for suffix, platform_details, name in AMIS:
+            image_id = 'ami-{}-{:06x}'.format(suffix, unit_index % 4)
+            self.images[image_id] = {
+                'ImageId': image_id,
+                'PlatformDetails': platform_details,
+                'Name': name,
+                'Description': name,
+            }
+
+        for n in range(count):
+            if n % 50 == 49:
+                suffix, platform_details = DEREGISTERED_AMI[0], DEREGISTERED_AMI[1]
+            else:
+                suffix, platform_details, _ = AMIS[n % len(AMIS)]
+            instance_id = 'i-{:06x}{:011x}'.format(unit_index, n)
+            tags = [{'Key': 'Name', 'Value': 'fleet-{}'.format(n)}]
+            if (n * 7919) % 100 < tagged_fraction * 100:
+                tags.append({'Key': ALARM_TAG, 'Value': ''})
+            if (n * 104729) % 100 < custom_tag_fraction * 100:
+                tags.append({'Key': 'AutoAlarm-AWS/EC2-StatusCheckFailed-GreaterThanThreshold-5m-2-Maximum-'
+                                    'Status_check_failed', 'Value': '0'})
+            if asg_size:
+                tags.append({'Key': 'aws:autoscaling:groupName', 'Value': 'asg-{}'.format(n // asg_size)})
+            self.instances[instance_id] = {
+                'InstanceId': instance_id,
+                'ImageId': 'ami-{}-{:06x}'.format(suffix, unit_index % 4),
+                'InstanceType': 't3.medium',
+                'PlatformDetails': platform_details,
+                'State': {'Code': 80, 'Name': 'stopped'} if n % 20 == 19 else {'Code': 16, 'Name': 'running'},
+                'Tags': tags,
+                '_platform': suffix,
+            }
+
+        self.functions = list()
+        for n in range(count // 20):
+            tags = {'team': 'fleet'}
+            if (n * 7919) % 100 < tagged_fraction * 100:
+                tags[ALARM_TAG] = ''
+            self.functions.append({
+                'FunctionName': 'function-{:06x}-{}'.format(unit_index, n),
+                'FunctionArn': 'arn:aws:lambda:{}:{}:function:function-{:06x}-{}'.format(region, account_id,
+                                                                                        unit_index, n),
+                '_tags': tags,
+            })
+
+        self.db_instances = list()
+        self.db_clusters = list()
+        for resources, kind, per_resource in [(self.db_instances, 'db', 50), (self.db_clusters, 'cluster', 200)]:
+            for n in range(count // per_resource):
+                identifier = '{}-{:06x}-{}'.format(kind, unit_index, n)
+                tags = [{'Key': 'team', 'Value': 'fleet'}]
+                if (n * 7919) % 100 < tagged_fraction * 100:
+                    tags.append({'Key': ALARM_TAG, 'Value': ''})
+                arn = 'arn:aws:rds:{}:{}:{}:{}'.format(region, account_id, kind, identifier)
+                if kind == 'db':
+                    resources.append({'DBInstanceIdentifier': identifier, 'DBInstanceArn': arn, 'TagList': tags})
+                else:
+                    resources.append({'DBClusterIdentifier': identifier, 'DBClusterArn': arn, 'TagList': tags})
+
+    def is_tagged(self, instance):
+        return any(tag['Key'] == ALARM_TAG for tag in instance['Tags'])
+
+    def metrics_for(self, instance):
+        base = [
+            {'Name': 'InstanceId', 'Value': instance['InstanceId']},
+            {'Name': 'ImageId', 'Value': instance['ImageId']},
+            {'Name': 'InstanceType', 'Value': instance['InstanceType']},
+        ]
+        metrics = [{'Namespace': 'AWS/EC2', 'MetricName': 'CPUUtilization',
+                    'Dimensions': [{'Name': 'InstanceId', 'Value': instance['InstanceId']}]}]
+        if instance['_platform'] == 'windows':
+            metrics.append({'Namespace': 'CWAgent', 'MetricName': 'Memory % Committed Bytes In Use',
+                            'Dimensions': base + [{'Name': 'objectname', 'Value': 'Memory'}]})
+            metrics.append({'Namespace': 'CWAgent', 'MetricName': 'LogicalDisk % Free Space',
+                            'Dimensions': base + [{'Name': 'objectname', 'Value': 'LogicalDisk'},
+                                                  {'Name': 'instance', 'Value': 'C:'}]})
+        else:
+            metrics.append({'Namespace': 'CWAgent', 'MetricName': 'mem_used_percent', 'Dimensions': list(base)})
+            for device, fstype, path in DISKS[instance['_platform']]:
+                metrics.append({'Namespace': 'CWAgent', 'MetricName': 'disk_used_percent',
+                                'Dimensions': base + [{'Name': 'device', 'Value': device},
+                                                      {'Name': 'fstype', 'Value': fstype},
+                                                      {'Name': 'path', 'Value': path}]})
+        return metrics
+
+    def put_alarm(self, alarm):
+        with self._lock:
+            name = alarm['AlarmName']
+            if name not in self.alarms:
+                for prefix in _indexed_prefixes(name):
+                    self._alarm_prefixes.setdefault(prefix, set()).add(name)
+            self.alarms[name] = alarm
+
+    def delete_alarm(self, name):
+        with self._lock:
+            if self.alarms.pop(name, None) is not None:
+                for prefix in _indexed_prefixes(name):
+                    self._alarm_prefixes[prefix].discard(name)
+
+    def alarm_names(self, prefix):
+        with self._lock:
+            if prefix in self._alarm_prefixes:
+                return sorted(self._alarm_prefixes[prefix])
+            return sorted(name for name in self.alarms if name.startswith(prefix))
+
+
+def _indexed_prefixes(name):
+    # index the prefixes ending at the 3rd to 6th separator, these cover AutoAlarm-<resource id>- prefixes
+    positions = [index for index, character in enumerate(name) if character == '-'][2:6]
+    return [name[:index + 1] for index in positions]
+
+
+def _paginate(items, request, page_size_key, default_page_size, token_key='NextToken'):
+    start = int(request.get(token_key, None) or 0)
+    page_size = request.get(page_size_key, None) or default_page_size
+    page = items[start:start + page_size]
+    next_token = str(start + page_size) if start + page_size < len(items) else None
+    return page, next_token
+
+
+class FakePaginator:
+    def __init__(self, method, page_size_key):
+        self.method = method
+        self.page_size_key = page_size_key
+
+    def paginate(self, PaginationConfig=None, **request):
+        if PaginationConfig and PaginationConfig.get('PageSize', None) and self.page_size_key:
+            request[self.page_size_key] = PaginationConfig['PageSize']
+        if PaginationConfig and PaginationConfig.get('StartingToken', None):
+            request['NextToken'] = PaginationConfig['StartingToken']
+        while True:
+            page = self.method(**request)
+            yield page
+            if not page.get('NextToken', None):
+                return
+            request['NextToken'] = page['NextToken']
+
+
+class MarkerPaginator:
+    """
+    Paginator of the APIs that return their pagination token under another name than NextToken.
+    """
+
+    def __init__(self, method, page_size_key, token_key='Marker', response_token_key=None):
+        self.method = method
+        self.page_size_key = page_size_key
+        self.token_key = token_key
+        self.response_token_key = response_token_key or token_key
+
+    def paginate(self, PaginationConfig=None, **request):
+        if PaginationConfig and PaginationConfig.get('PageSize', None) and self.page_size_key:
+            request[self.page_size_key] = PaginationConfig['PageSize']
+        while True:
+            page = self.method(**request)
+            yield page
+            token = page.get(self.response_token_key, None)
+            if not token:
+                return
+            request[self.token_key] = token
+
+
+class FakeClient:
+    page_size_keys = {}
+
+    def __init__(self, aws, service, account_id, region):
+        self.aws = aws
+        self.service = service
+        self.account_id = account_id
+        self.region = region
+
+    @property
+    def unit(self):
+        return self.aws.unit(self.account_id, self.region)
+
+    def get_paginator(self, method_name):
+        return FakePaginator(getattr(self, method_name), self.page_size_keys.get(method_name, None))
+
+    def record(self, method_name):
+        self.aws.record(self.service, method_name, self.account_id, self.region)
+
+
+class Ec2Client(FakeClient):
+    page_size_keys = {'describe_instances': 'MaxResults'}
+
+    def describe_instances(self, Filters=None, InstanceIds=None, **request):
+        self.record('describe_instances')
+        instances = list(self.unit.instances.values())
+        if InstanceIds:
+            instances = [self.unit.instances[instance_id] for instance_id in InstanceIds if
+                         instance_id in self.unit.instances]
+        for instance_filter in Filters or list():
+            values = instance_filter['Values']
+            if instance_filter['Name'] == 'tag-key':
+                instances = [instance for instance in instances if
+                             any(tag['Key'] in values for tag in instance['Tags'])]
+            elif instance_filter['Name'] == 'instance-state-name':
+                instances = [instance for instance in instances if instance['State']['Name'] in values]
+            elif instance_filter['Name'] == 'instance-id':
+                instances = [instance for instance in instances if instance['InstanceId'] in values]
+        page, next_token = _paginate(instances, request, 'MaxResults', 1000)
+        response = {'Reservations': [{'Instances': [_public(instance)]} for instance in page]}
+        if next_token:
+            response['NextToken'] = next_token
+        return response
+
+    def describe_images(self, ImageIds=None, Filters=None, **request):
+        self.record('describe_images')
+        image_ids = list(ImageIds or list())
+        for image_filter in Filters or list():
+            if image_filter['Name'] == 'image-id':
+                image_ids.extend(image_filter['Values'])
+        return {'Images': [self.unit.images[image_id] for image_id in image_ids if image_id in self.unit.images]}
+
+    def create_tags(self, Resources, Tags):
+        self.record('create_tags')
+        for instance_id in Resources:
+            instance = self.unit.instances[instance_id]
+            keys = set(tag['Key'] for tag in Tags)
+            instance['Tags'] = [tag for tag in instance['Tags'] if tag['Key'] not in keys] + list(Tags)
+
+
+class CloudWatchClient(FakeClient):
+    page_size_keys = {'describe_alarms': 'MaxRecords'}
+
+    def put_metric_alarm(self, **alarm):
+        self.record('put_metric_alarm')
+        stored = dict(alarm)
+        stored['Metrics'] = [dict(metric, ReturnData=True) for metric in alarm.get('Metrics', list())]
+        stored['StateValue'] = 'INSUFFICIENT_DATA'
+        stored['StateUpdatedTimestamp'] = datetime.now(timezone.utc)
+        stored['AlarmConfigurationUpdatedTimestamp'] = stored['StateUpdatedTimestamp']
+        self.unit.put_alarm(stored)
+
+    def describe_alarms(self, AlarmNamePrefix='', AlarmNames=None, AlarmTypes=None, **request):
+        self.record('describe_alarms')
+        if AlarmNames:
+            names = [name for name in AlarmNames if name in self.unit.alarms]
+        else:
+            names = self.unit.alarm_names(AlarmNamePrefix)
+        page, next_token = _paginate(names, request, 'MaxRecords', 100)
+        response = {'MetricAlarms': [dict(self.unit.alarms[name]) for name in page if name in self.unit.alarms],
+                    'CompositeAlarms': []}
+        if next_token:
+            response['NextToken'] = next_token
+        return response
+
+    def delete_alarms(self, AlarmNames):
+        self.record('delete_alarms')
+        if len(AlarmNames) > 100:
+            raise ValueError('delete_alarms accepts at most 100 alarm names')
+        for name in AlarmNames:
+            self.unit.delete_alarm(name)
+
+    def list_metrics(self, Namespace=None, MetricName=None, Dimensions=None, **request):
+        self.record('list_metrics')
+        wanted = dict((dimension['Name'], dimension.get('Value', None)) for dimension in Dimensions or list())
+        if wanted.get('InstanceId', None) in self.unit.instances:
+            candidates = self.unit.metrics_for(self.unit.instances[wanted['InstanceId']])
+        else:
+            candidates = [metric for instance in self.unit.instances.values()
+                          for metric in self.unit.metrics_for(instance)]
+        metrics = list()
+        for metric in candidates:
+            if Namespace and metric['Namespace'] != Namespace:
+                continue
+            if MetricName and metric['MetricName'] != MetricName:
+                continue
+            dimensions = dict((dimension['Name'], dimension['Value']) for dimension in metric['Dimensions'])
+            if all(name in dimensions and (value is None or dimensions[name] == value) for name, value in
+                   wanted.items()):
+                metrics.append(metric)
+        page, next_token = _paginate(metrics, request, None, 500)
+        response = {'Metrics': page}
+        if next_token:
+            response['NextToken'] = next_token
+        return response
+
+
+class LambdaClient(FakeClient):
+    page_size_keys = {'list_functions': 'MaxItems'}
+
+    def list_functions(self, **request):
+        self.record('list_functions')
+        page, next_token = _paginate(self.unit.functions, request, 'MaxItems', 50, 'Marker')
+        response = {'Functions': [_public(function) for function in page]}
+        if next_token:
+            response['NextMarker'] = next_token
+        return response
+
+    def get_paginator(self, method_name):
+        return MarkerPaginator(getattr(self, method_name), self.page_size_keys.get(method_name, None), 'Marker',
+                               'NextMarker')
+
+
+class RdsClient(FakeClient):
+    page_size_keys = {'describe_db_instances': 'MaxRecords', 'describe_db_clusters': 'MaxRecords'}
+
+    def describe_db_instances(self, **request):
+        self.record('describe_db_instances')
+        page, next_token = _paginate(self.unit.db_instances, request, 'MaxRecords', 100, 'Marker')
+        response = {'DBInstances': page}
+        if next_token:
+            response['Marker'] = next_token
+        return response
+
+    def describe_db_clusters(self, **request):
+        self.record('describe_db_clusters')
+        page, next_token = _paginate(self.unit.db_clusters, request, 'MaxRecords', 100, 'Marker')
+        response = {'DBClusters': page}
+        if next_token:
+            response['Marker'] = next_token
+        return response
+
+    def get_paginator(self, method_name):
+        return MarkerPaginator(getattr(self, method_name), self.page_size_keys.get(method_name, None), 'Marker')
+
+
+class AutoScalingClient(FakeClient):
+    page_size_keys = {'describe_auto_scaling_groups': 'MaxRecords'}
+
+    def describe_auto_scaling_groups(self, **request):
+        self.record('describe_auto_scaling_groups')
+        names = sorted(set(tag['Value'] for instance in self.unit.instances.values() for tag in instance['Tags'] if
+                           tag['Key'] == 'aws:autoscaling:groupName'))
+        page, next_token = _paginate(names, request, 'MaxRecords', 50)
+        response = {'AutoScalingGroups': [{'AutoScalingGroupName': name} for name in page]}
+        if next_token:
+            response['NextToken'] = next_token
+        return response
+
+
+class TaggingClient(FakeClient):
+    page_size_keys = {'get_resources': 'ResourcesPerPage'}
+
+    def get_resources(self, ResourceTypeFilters=None, TagFilters=None, **request):
+        self.record('get_resources')
+        resources = list()
+        if not ResourceTypeFilters or 'lambda:function' in ResourceTypeFilters:
+            resources = [{'ResourceARN': function['FunctionArn'],
+                          'Tags': [{'Key': key, 'Value': value} for key, value in function['_tags'].items()]}
+                         for function in self.unit.functions]
+        for tag_filter in TagFilters or list():
+            resources = [resource for resource in resources if
+                         any(tag['Key'] == tag_filter['Key'] and
+                             (not tag_filter.get('Values', None) or tag['Value'] in tag_filter['Values'])
+                             for tag in resource['Tags'])]
+        page, next_token = _paginate(resources, request, 'ResourcesPerPage', 50, 'PaginationToken')
+        return {'ResourceTagMappingList': page, 'PaginationToken': next_token or ''}
+
+    def get_paginator(self, method_name):
+        return MarkerPaginator(getattr(self, method_name), self.page_size_keys.get(method_name, None),
+                               'PaginationToken')
+
+
+class StsClient(FakeClient):
+    def assume_role(self, RoleArn, RoleSessionName, **request):
+        self.record('assume_role')
+        account_id = RoleArn.split(':')[4]
+        return {
+            'Credentials': {
+                'AccessKeyId': 'FAKE{}{:08d}'.format(account_id, int(time.time()) % 100000000),
+                'SecretAccessKey': 'fake',
+                'SessionToken': 'fake',
+                'Expiration': datetime.now(timezone.utc) + timedelta(hours=1),
+            }
+        }
+
+    def get_caller_identity(self):
+        self.record('get_caller_identity')
+        return {'Account': self.account_id}
+
+
+class OrganizationsClient(FakeClient):
+    page_size_keys = {'list_accounts_for_parent': 'MaxResults', 'list_children': 'MaxResults'}
+
+    def list_accounts_for_parent(self, ParentId, **request):
+        self.record('list_accounts_for_parent')
+        accounts = list()
+        if ParentId in NESTED_ORGANIZATIONAL_UNIT_IDS:
+            depth = NESTED_ORGANIZATIONAL_UNIT_IDS.index(ParentId)
+            accounts = [{'Id': account_id, 'Name': 'account-{}'.format(account_id), 'Email': 'fake@example.com',
+                         'Status': 'ACTIVE'} for index, account_id in enumerate(self.aws.account_ids)
+                        if index % len(NESTED_ORGANIZATIONAL_UNIT_IDS) == depth]
+        page, next_token = _paginate(accounts, request, 'MaxResults', 20)
+        response = {'Accounts': page}
+        if next_token:
+            response['NextToken'] = next_token
+        return response
+
+    def list_children(self, ParentId, ChildType, **request):
+        self.record('list_children')
+        children = list()
+        if ChildType == 'ORGANIZATIONAL_UNIT' and ParentId in NESTED_ORGANIZATIONAL_UNIT_IDS[:-1]:
+            child_ou_id = NESTED_ORGANIZATIONAL_UNIT_IDS[NESTED_ORGANIZATIONAL_UNIT_IDS.index(ParentId) + 1]
+            children = [{'Id': child_ou_id, 'Type': 'ORGANIZATIONAL_UNIT'}]
+        page, next_token = _paginate(children, request, 'MaxResults', 20)
+        response = {'Children': page}
+        if next_token:
+            response['NextToken'] = next_token
+        return response
+
+
+def _public(instance):
+    return dict((key, value) for key, value in instance.items() if not key.startswith('_'))
@@ -0,0 +1,306 @@
+"""
+Offline benchmarks for the CloudWatchAutoAlarms Lambda function.
+
+Runs lambda_handler against the in-process AWS stand-in in fake_aws.py for synthetic fleets and reports wall time,
+AWS API calls per instance by operation and peak memory.  Every benchmark runs in a fresh Python process so that
+module level configuration, caches and peak memory are measured from a cold start.
+
+    python benchmarks/run_benchmarks.py --instances 100 1000 10000 --accounts 10 --latency-ms 5 \
+        --output results.json
+    python benchmarks/run_benchmarks.py --output new.json --compare results.json --max-regression 10
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.join(os.path.dirname(benchmarks_dir), 'src')
+
+scenarios = ['scan', 'warm-scan', 'sharded-scan', 'plan', 'events', 'event-batches']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark lambda_handler against stubbed AWS services.')
+    parser.add_argument('--scenarios', nargs='+', choices=scenarios, default=['scan', 'events'],
+                        help='scan: one cold org-wide scan, warm-scan: a second scan in the same container, '
+                             'sharded-scan: a scan sharded per account and region through an in-memory queue, '
+                             'plan: an alarm plan of the fleet without writes, '
+                             'events: EC2 running and terminated events for a sample of instances, event-batches: the '
+                             'same events delivered in SQS batches')
+    parser.add_argument('--instances', nargs='+', type=int, default=[100, 1000, 10000],
+                        help='fleet sizes, instances are spread evenly over all accounts and regions')
+    parser.add_argument('--accounts', type=int, default=10, help='number of accounts, more than 1 scans through '
+                                                                 'AWS Organizations')
+    parser.add_argument('--regions', nargs='+', default=['us-east-1', 'us-west-2'])
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='simulated latency of every AWS API call')
+    parser.add_argument('--events', type=int, default=200, help='number of instances sampled by the events '
+                                                                'scenario')
+    parser.add_argument('--batch-size', type=int, default=10, help='events per SQS batch in the event-batches '
+                                                                   'scenario')
+    parser.add_argument('--env', nargs='*', default=[], metavar='NAME=VALUE',
+                        help='additional Lambda environment variables, e.g. RECONCILE_ALARMS=true')
+    parser.add_argument('--quotas', nargs='*', default=[], metavar='OPERATION=TPS',
+                        help='throttle calls above these requests per second per account and region, e.g. '
+                             'PutMetricAlarm=3.  Without quotas the client-side rate limits of the function are '
+                             'disabled unless set with --env')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='also report the peak Python heap allocated by the handler, slows down the run')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare the results with a previous JSON results file')
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help='exit with status 1 if wall time or API calls regress by more than this percentage '
+                             'against --compare')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        print(json.dumps(run_benchmark(json.loads(args.child))))
+        return 0
+
+    results = list()
+    for scenario in args.scenarios:
+        for instances in args.instances:
+            benchmark = {
+                'name': '{}-{}'.format(scenario, instances),
+                'scenario': scenario,
+                'instances': instances,
+                'accounts': args.accounts,
+                'regions': args.regions,
+                'latency_ms': args.latency_ms,
+                'events': args.events,
+                'batch_size': args.batch_size,
+                'env': dict(variable.split('=', 1) for variable in args.env),
+                'quotas': dict((quota.split('=', 1)[0], float(quota.split('=', 1)[1])) for quota in args.quotas),
+                'tracemalloc': args.tracemalloc,
+            }
+            result = run_in_subprocess(benchmark)
+            print_result(result)
+            results.append(result)
+
+    report = {
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        print('Results written to {}'.format(args.output))
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(json.load(baseline), report, args.max_regression)
+        if regressions:
+            print('Regressions above {}%: {}'.format(args.max_regression, ', '.join(regressions)))
+            return 1
+    return 0
+
+
+def run_in_subprocess(benchmark):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(benchmark)],
+                            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def lambda_environment(benchmark, fake_aws):
+    environment = {
+        'LOCAL_ACCOUNT_ID': fake_aws.LOCAL_ACCOUNT_ID,
+        'TARGET_REGIONS': ','.join(benchmark['regions']),
+        'ALARM_TAG': fake_aws.ALARM_TAG,
+        'SNS_TOPIC_NAME': 'CloudWatchAutoAlarmsSNSTopic',
+        'SNS_TOPIC_ACCOUNT': fake_aws.LOCAL_ACCOUNT_ID,
+        'SCAN_STATE_STORE': 'file://' + tempfile.mkdtemp(prefix='scan-state-'),
+    }
+    if not benchmark['quotas']:
+        # the fake services never throttle, measure the function without client-side rate limits
+        for variable in ['PUT_METRIC_ALARM_RATE_LIMIT', 'DESCRIBE_ALARMS_RATE_LIMIT', 'EC2_DESCRIBE_RATE_LIMIT',
+                         'STS_RATE_LIMIT']:
+            environment[variable] = '0'
+    if benchmark['accounts'] > 1:
+        environment['ORG_MGMT_ACCOUNT'] = fake_aws.MANAGEMENT_ACCOUNT_ID
+        environment['TARGET_ORG_UNITS'] = fake_aws.ORGANIZATIONAL_UNIT_ID
+    if benchmark['scenario'] == 'sharded-scan':
+        environment['SCAN_SHARD_QUEUE'] = 'local'
+    environment.update(benchmark['env'])
+    return environment
+
+
+def run_benchmark(benchmark):
+    sys.path.insert(0, src_dir)
+    import fake_aws
+
+    aws = fake_aws.FakeAws(accounts=benchmark['accounts'], regions=benchmark['regions'],
+                           instances=benchmark['instances'], latency=benchmark['latency_ms'] / 1000.0,
+                           quotas=benchmark['quotas']).install()
+    os.environ.update(lambda_environment(benchmark, fake_aws))
+    fleet_rss = peak_rss_mb()
+
+    # the handler logs at INFO, format the records as Lambda would but discard them
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    handler.setFormatter(logging.Formatter('[%(levelname)s]\t%(asctime)s\t%(message)s'))
+    logging.getLogger().addHandler(handler)
+
+    if benchmark['tracemalloc']:
+        tracemalloc.start()
+    start = time.perf_counter()
+    import cw_auto_alarms
+    import_time = time.perf_counter() - start
+
+    if benchmark['scenario'] in ['events', 'event-batches']:
+        events = ec2_events(aws, benchmark['events'])
+        resources = len(events) // 2
+        if benchmark['scenario'] == 'event-batches':
+            events = sqs_batches(events, benchmark['batch_size'])
+    elif benchmark['scenario'] == 'plan':
+        events = [{'action': 'plan'}]
+        resources = aws.instance_count
+    else:
+        events = [{'action': 'scan'}]
+        resources = aws.instance_count
+        if benchmark['scenario'] == 'warm-scan':
+            cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+            aws.calls.clear()
+            aws.throttled.clear()
+            if benchmark['tracemalloc'] and hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+    handler_result = None
+    start = time.perf_counter()
+    for event in events:
+        handler_result = cw_auto_alarms.lambda_handler(event, None)
+    if benchmark['scenario'] == 'sharded-scan':
+        # deliver the shards one at a time, as the SQS event source mapping of the queue does
+        import actions
+        while len(actions.local_work_queue):
+            for receipt_handle, message in actions.local_work_queue.receive(1):
+                cw_auto_alarms.lambda_handler({'Records': [{'eventSource': 'aws:sqs', 'receiptHandle': receipt_handle,
+                                                            'body': json.dumps(message)}]}, None)
+        handler_result = cw_auto_alarms.lambda_handler({'action': 'scan-status'}, None)
+    wall_time = time.perf_counter() - start
+
+    api_calls = dict(sorted(aws.calls.items()))
+    result = dict(benchmark)
+    result.update({
+        'resources': resources,
+        'tagged_running_instances': aws.tagged_running_instance_count,
+        'import_time_s': round(import_time, 4),
+        'wall_time_s': round(wall_time, 4),
+        'api_calls': api_calls,
+        'api_calls_total': sum(api_calls.values()),
+        'api_throttles': dict(sorted(aws.throttled.items())),
+        'api_calls_per_instance': dict((operation, round(count / max(resources, 1), 4)) for operation, count in
+                                       api_calls.items()),
+        'alarms': sum(len(aws.unit(account_id, region).alarms) for account_id in aws.account_ids for region in
+                      aws.regions),
+        'fleet_rss_mb': fleet_rss,
+        'peak_rss_mb': peak_rss_mb(),
+        'handler_result': handler_result,
+    })
+    if benchmark['tracemalloc']:
+        result['peak_heap_mb'] = round(tracemalloc.get_traced_memory()[1] / 1048576.0, 2)
+        tracemalloc.stop()
+    return result
+
+
+def ec2_events(aws, count):
+    """
+    Returns running events followed by terminated events for up to count tagged, running instances spread evenly over
+    the accounts and regions of the fleet.
+    """
+    candidates = list()
+    for account_id in aws.account_ids:
+        for region in aws.regions:
+            unit = aws.unit(account_id, region)
+            candidates.append([(account_id, region, instance['InstanceId']) for instance in unit.instances.values()
+                               if unit.is_tagged(instance) and instance['State']['Name'] == 'running'])
+    sample = list()
+    while len(sample) < count and any(candidates):
+        for unit_candidates in candidates:
+            if unit_candidates and len(sample) < count:
+                sample.append(unit_candidates.pop(0))
+
+    def event(account_id, region, instance_id, state):
+        return {'source': 'aws.ec2', 'detail-type': 'EC2 Instance State-change Notification', 'account': account_id,
+                'region': region, 'detail': {'instance-id': instance_id, 'state': state}}
+
+    return [event(*instance, 'running') for instance in sample] + [event(*instance, 'terminated') for instance in
+                                                                    sample]
+
+
+def sqs_batches(events, batch_size):
+    """
+    Returns the events as SQS event source mapping invocations of up to batch_size messages.
+    """
+    records = [{'messageId': str(index), 'eventSource': 'aws:sqs', 'body': json.dumps(event)} for index, event in
+               enumerate(events)]
+    return [{'Records': records[index:index + batch_size]} for index in range(0, len(records), batch_size)]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and kilobytes on Linux
+    return round(peak / (1048576.0 if sys.platform == 'darwin' else 1024.0), 2)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=benchmarks_dir, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_result(result):
+    print('{name}: {wall_time_s}s wall, {api_calls_total} API calls, {throttles} throttled, {peak_rss_mb} MB peak '
+          'RSS'.format(throttles=sum(result['api_throttles'].values()), **result))
+    for operation, per_instance in result['api_calls_per_instance'].items():
+        print('    {:<45} {:>10} {:>10}/instance'.format(operation, result['api_calls'][operation], per_instance))
+
+
+def compare(baseline, report, max_regression=None):
+    """
+    Prints the change of every result against the baseline report and returns the names of the results whose wall
+    time or API calls regressed by more than max_regression percent.
+    """
+    baseline_results = dict((result['name'], result) for result in baseline['results'])
+    regressions = list()
+    print('Compared with {} ({})'.format(baseline.get('revision', None), baseline.get('generated_at', None)))
+    for result in report['results']:
+        previous = baseline_results.get(result['name'], None)
+        if previous is None:
+            print('    {}: no baseline'.format(result['name']))
+            continue
+        parameters = ['accounts', 'regions', 'latency_ms', 'events', 'env', 'quotas']
+        if any(previous.get(parameter, None) != result[parameter] for parameter in parameters):
+            print('    {}: run with different parameters than the baseline'.format(result['name']))
+        changes = list()
+        for metric in ['wall_time_s', 'api_calls_total', 'peak_rss_mb']:
+            change = percent_change(previous[metric], result[metric])
+            changes.append('{} {} -> {} ({:+.1f}%)'.format(metric, previous[metric], result[metric], change))
+            if max_regression is not None and metric != 'peak_rss_mb' and change > max_regression:
+                regressions.append('{} {}'.format(result['name'], metric))
+        print('    {}: {}'.format(result['name'], ', '.join(changes)))
+    return regressions
+
+
+def percent_change(previous, current):
+    if not previous:
+        return 0.0 if not current else float('inf')
+    return (current - previous) * 100.0 / previous
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,72 +1,232 @@
-import boto3
+import hashlib
+import json
 import logging
-from botocore.config import Config
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os import getenv
-from datetime import datetime
+from datetime import datetime, timezone
+import alarm_engine
+from alarm_index import AlarmIndex
+from alarm_plan import alarm_hash, plan_entry, manifest_lines, read_manifest, diff_manifests
+from alarm_spec import AlarmSpecError, parse_alarm_spec, convert_to_seconds, valid_anomaly_detection_comparators
+from cache import ExpiringCache
+from metrics import api_metrics, InstrumentedClient
+from throttling import RateLimiter, AdaptiveConcurrency
+from structured_log import structured_log
+from scan_state import ScanInterrupted, LocalFileStateStore, S3StateStore
+from work_queue import LocalWorkQueue, SqsWorkQueue
+from urllib.parse import urlparse
 
 logger = logging.getLogger()
 log_level = getenv("LOGLEVEL", "INFO")
 level = logging.getLevelName(log_level)
 logger.setLevel(level)
 
-valid_comparators = ['GreaterThanOrEqualToThreshold', 'GreaterThanThreshold', 'LessThanThreshold',
-                     'LessThanOrEqualToThreshold', "LessThanLowerOrGreaterThanUpperThreshold", "LessThanLowerThreshold",
-                     "GreaterThanUpperThreshold"]
-
-valid_anomaly_detection_comparators = ["LessThanLowerOrGreaterThanUpperThreshold", "LessThanLowerThreshold",
-                                       "GreaterThanUpperThreshold"]
-
-valid_statistics = ['Average', 'SampleCount', 'Sum', 'Minimum', 'Maximum']
+# Assumed role credentials are cached per role ARN, IAM role credentials are not regional so one entry serves every
+# region of an account.  Entries are refreshed CREDENTIALS_REFRESH_MARGIN seconds before their Expiration.
+credentials_refresh_margin = int(getenv("CREDENTIALS_REFRESH_MARGIN", "300"))
+credentials_cache = ExpiringCache('credentials')
+
+# Clients are pooled per (service, region, credentials) so endpoint resolution, service model loading and connection
+# pools are paid for once per container rather than once per API call.
+client_max_pool_connections = int(getenv("CLIENT_MAX_POOL_CONNECTIONS", "10"))
+client_pool = ExpiringCache('clients')
+client_creation_lock = threading.Lock()
+
+# API calls made with the function's own credentials are reported under LOCAL_ACCOUNT_ID
+local_account_id = getenv("LOCAL_ACCOUNT_ID", "local")
+
+# botocore retries a failed call at most CLIENT_MAX_ATTEMPTS times in total with exponential backoff, throttling is
+# avoided up front by the rate limiter rather than absorbed by long retry sequences.
+client_max_attempts = int(getenv("CLIENT_MAX_ATTEMPTS", "4"))
+
+# Requests per second allowed per account and region for each API family, the defaults are the AWS default quotas.
+# A rate of 0 disables the limit.
+rate_limiter = RateLimiter({
+    'cloudwatch:PutMetricAlarm': getenv("PUT_METRIC_ALARM_RATE_LIMIT", "3"),
+    'cloudwatch:DescribeAlarms': getenv("DESCRIBE_ALARMS_RATE_LIMIT", "9"),
+    'ec2:Describe*': getenv("EC2_DESCRIBE_RATE_LIMIT", "20"),
+    'sts': getenv("STS_RATE_LIMIT", "50")
+})
+
+# In the optimized startup mode boto3 and botocore are imported when the first client is created rather than at
+# module load, and the handler builds the clients an event needs on a background thread as soon as it is invoked, so
+# loading the service models overlaps with the first API calls.  Only the models of the services an event uses are
+# loaded.  The eager mode imports the SDK and loads the models of all services during the init phase instead, which
+# suits provisioned concurrency where init is not on the request path.
+startup_mode = getenv("STARTUP_MODE", "optimized").lower()
+preload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='preload')
+
+# Scan workers process instances under an AIMD concurrency limit that halves when API calls are throttled and
+# recovers as calls succeed again.
+concurrency_controller = AdaptiveConcurrency(int(getenv("SCAN_CONCURRENCY", "10")))
+
+# Work items of sharded scans are queued in memory when SCAN_SHARD_QUEUE is 'local', for tests and local runs
+local_work_queue = LocalWorkQueue()
+
+# The activation tag of an instance holds a fingerprint of its alarm definition and when it was written, as
+# <fingerprint>@<timestamp>.  Scans skip instances whose fingerprint is unchanged and younger than
+# ALARM_FINGERPRINT_MAX_AGE seconds, so that wildcard alarms pick up new metrics and drift is repaired periodically.
+# A maximum age of 0 never expires a fingerprint.
+skip_unchanged_resources_flag = getenv("SKIP_UNCHANGED_RESOURCES", "true").lower()
+alarm_fingerprint_max_age = int(getenv("ALARM_FINGERPRINT_MAX_AGE", "604800"))
+fingerprint_separator = '@'
+fingerprint_timestamp_format = '%Y-%m-%dT%H:%M:%SZ'
+
+# describe_instances accepts at most 1000 results per page
+describe_instances_page_size = 1000
+# EC2 accepts at most 200 values per filter, batched event ingestion describes and tags instances in batches of this size
+describe_instances_batch_size = 200
+
+# Resource types covered by the scan action.  Lambda functions and RDS database instances and clusters are discovered
+# in bulk like EC2 instances, so that resources tagged before deployment, or whose tag event was missed, get alarms.
+scan_resource_types = [resource_type.strip() for resource_type in
+                       getenv("SCAN_RESOURCE_TYPES", "ec2,lambda,rds").lower().split(',')]
+
+# The platform of an AMI never changes, so ImageId to platform mappings are cached across invocations and accounts.
+# Deregistered AMIs are cached with the platform derived from the instance PlatformDetails, or None if unknown.
+platform_cache_ttl = int(getenv("PLATFORM_CACHE_TTL", "86400"))
+platform_cache = ExpiringCache('platforms', max_size=int(getenv("PLATFORM_CACHE_SIZE", "4096")))
+missing_platform = object()
+describe_images_batch_size = 100
+
+# list_metrics results used to resolve wildcard dimensions are cached per (account, region, namespace, metric name,
+# fixed dimensions) for a short time, so instances sharing the same fixed dimensions, e.g. AutoScalingGroupName,
+# share one lookup.
+wildcard_metrics_cache_ttl = int(getenv("WILDCARD_METRICS_CACHE_TTL", "300"))
+wildcard_metrics_cache = ExpiringCache('wildcard_metrics', max_size=int(getenv("WILDCARD_METRICS_CACHE_SIZE", "4096")))
+
+# With ASG_ALARMS set, EC2 instances in an Auto Scaling group get no alarms of their own, their group gets one alarm
+# per alarm tag instead, built from the tags and platform of any of its instances.  'dimension' alarms on metrics with
+# the AutoScalingGroupName dimension: the group metrics of AWS/EC2, and of the CloudWatch agent when its
+# aggregation_dimensions include AutoScalingGroupName.  'metrics-insights' alarms on the instance metrics of the
+# CloudWatch agent with a Metrics Insights query that groups them by InstanceId and keeps the worst instance, AWS/EC2
+# alarms still use the dimension.  The alarms written for a group are remembered for ASG_ALARMS_CACHE_TTL seconds, the
+# events and scans of its other instances are then no-ops.
+asg_alarms_mode = getenv("ASG_ALARMS", "off").lower()
+asg_alarms_cache_ttl = int(getenv("ASG_ALARMS_CACHE_TTL", "3600"))
+asg_alarms_cache = ExpiringCache('asg_alarms', max_size=int(getenv("ASG_ALARMS_CACHE_SIZE", "4096")))
+metrics_insights_functions = {'Average': 'AVG', 'Maximum': 'MAX', 'Minimum': 'MIN', 'Sum': 'SUM',
+                              'SampleCount': 'COUNT'}
+
+# The accounts of the target organizational units and of all OUs nested below them are cached for
+# ACCOUNT_INVENTORY_TTL seconds, so frequent scans do not walk a large organization tree every time.  A TTL of 0
+# walks the tree on every call.  The OUs of one level of the tree are listed by up to ORGANIZATIONS_CONCURRENCY
+# threads, AWS Organizations allows few requests per second.
+account_inventory_ttl = int(getenv("ACCOUNT_INVENTORY_TTL", "3600"))
+account_inventory_cache = ExpiringCache('account_inventory')
+organizations_concurrency = int(getenv("ORGANIZATIONS_CONCURRENCY", "4"))
+
+# With ALARM_INDEX set to a file path, e.g. in /tmp or on a mounted EFS volume, the managed alarms of each account and
+# region are indexed in a SQLite database.  A reconciling scan refreshes the index of an account and region from
+# describe_alarms before it processes its instances and then looks up the existing alarms of each instance in the
+# index, rather than with one describe_alarms call per instance.  The orphaned-alarm sweep refreshes and reads it too.
+# The index of an execution environment does not see the alarms other environments write, so events and deletions
+# always query CloudWatch.  Alarms written and deleted by the function are recorded as they happen.
+alarm_index_path = getenv("ALARM_INDEX", "")
+alarm_index = AlarmIndex(alarm_index_path) if alarm_index_path else None
+alarm_index_refresh_locks = dict()
+alarm_index_refresh_locks_lock = threading.Lock()
 
 
 def boto3_client(resource, region, assumed_credentials=None):
-    config = Config(
-        retries=dict(
-            max_attempts=40
-        ),
-        region_name=region
-    )
+    """
+    Returns a pooled client for the service, region and credentials.  Clients are created once per container and
+    shared across threads and warm invocations.  Clients for assumed credentials are dropped from the pool when the
+    credentials expire, a refreshed set of credentials gets a new client.  Every API call made by a client is recorded
+    in api_metrics.
+    """
     if assumed_credentials:
-        client = boto3.client(
-            resource,
-            aws_access_key_id=assumed_credentials['AccessKeyId'],
-            aws_secret_access_key=assumed_credentials['SecretAccessKey'],
-            aws_session_token=assumed_credentials['SessionToken'],
-            config=config
-        )
+        identity = assumed_credentials['AccessKeyId']
+        expires_at = assumed_credentials['Expiration'].timestamp()
+        account_id = assumed_credentials.get('AccountId', 'unknown')
     else:
-        client = boto3.client(
-            resource,
-            config=config
+        identity = 'default'
+        expires_at = float('inf')
+        account_id = local_account_id
+
+    def create_client():
+        # boto3 and botocore are imported on first use, see STARTUP_MODE
+        import boto3
+        from botocore.config import Config
+
+        config = Config(
+            retries=dict(
+                max_attempts=client_max_attempts,
+                mode='standard'
+            ),
+            region_name=region,
+            max_pool_connections=client_max_pool_connections
         )
-    return client
+        # the default boto3 session is not thread-safe, serialize client creation
+        with client_creation_lock:
+            if assumed_credentials:
+                client = boto3.client(
+                    resource,
+                    aws_access_key_id=assumed_credentials['AccessKeyId'],
+                    aws_secret_access_key=assumed_credentials['SecretAccessKey'],
+                    aws_session_token=assumed_credentials['SessionToken'],
+                    config=config
+                )
+            else:
+                client = boto3.client(
+                    resource,
+                    config=config
+                )
+        return InstrumentedClient(client, resource, account_id, region, rate_limiter,
+                                  concurrency_controller), expires_at
+
+    return client_pool.get_or_load((resource, region, identity), create_client)
 
-def get_current_account_id():
-    sts_client = boto3_client('sts')
 
-    # Call the `get_caller_identity` API
-    account_id = sts_client.get_caller_identity()["Account"]
+def preload_client(resource, region):
+    """
+    Builds the pooled client for the service and region with the default credentials, which loads its service model
+    into the shared botocore loader so that clients for assumed credentials are cheap to build too.  Failures are
+    left to the first real use of the client.
+    """
+    try:
+        boto3_client(resource, region)
+    except Exception as e:
+        logger.debug('Error preloading %s client in region %s: %s', resource, region, e)
+
 
-    # Print or return the account ID
-    print(f"Account ID: {account_id}")
-    return account_id
+def preload_clients(resources, region):
+    """
+    Builds the clients for the services on the preload thread in the given order and returns their futures.
+    """
+    return [preload_executor.submit(preload_client, resource, region) for resource in resources]
 
 
-def assume_cross_account_role(account_id, region):
+def assume_role(role_arn, role_session_name, region):
     """
-    Assumes a cross-account role using the provided account ID and the global role name.
-    If the role is unable to be assumed for any reason, returns None and logs an error message.
+    Assumes the role and returns its credentials, reusing cached credentials until shortly before they expire.
     """
-    try:
-        sts_client = boto3.client('sts', region_name=region)
-        role_arn = f"arn:aws:iam::{account_id}:role/CloudWatchAutoAlarmCrossAccountRole"
-        role_session_name = "CloudWatchAutoAlarmCrossAccountSession"
 
+    def load_credentials():
+        sts_client = boto3_client('sts', region)
         response = sts_client.assume_role(
             RoleArn=role_arn,
             RoleSessionName=role_session_name
         )
-        return response['Credentials']
+        # remember the account of the credentials, clients created with them report their API calls for it
+        credentials = dict(response['Credentials'], AccountId=role_arn.split(':')[4])
+        expires_at = credentials['Expiration'].timestamp() - credentials_refresh_margin
+        logger.debug('Assumed role %s, credentials expire at %s', role_arn, credentials['Expiration'])
+        return credentials, expires_at
+
+    return credentials_cache.get_or_load(role_arn, load_credentials)
+
+
+def assume_cross_account_role(account_id, region):
+    """
+    Assumes a cross-account role using the provided account ID and the global role name.
+    If the role is unable to be assumed for any reason, returns None and logs an error message.
+    """
+    role_arn = f"arn:aws:iam::{account_id}:role/CloudWatchAutoAlarmCrossAccountRole"
+    try:
+        return assume_role(role_arn, "CloudWatchAutoAlarmCrossAccountSession", region)
     except Exception as e:
         error_message = f"Failed to assume role {role_arn} in region {region}: {e}"
         logger.error(error_message)
@@ -77,16 +237,9 @@ def assume_management_account_role(account_id, region):
     Assumes a cross-account role using the provided account ID and the global role name.
     If the role is unable to be assumed for any reason, returns None and logs an error message.
     """
+    role_arn = f"arn:aws:iam::{account_id}:role/CloudWatchAutoAlarmManagementAccountRole"
     try:
-        sts_client = boto3.client('sts', region_name=region)
-        role_arn = f"arn:aws:iam::{account_id}:role/CloudWatchAutoAlarmManagementAccountRole"
-        role_session_name = "CloudWatchAutoAlarmManagementAccountSession"
-
-        response = sts_client.assume_role(
-            RoleArn=role_arn,
-            RoleSessionName=role_session_name
-        )
-        return response['Credentials']
+        return assume_role(role_arn, "CloudWatchAutoAlarmManagementAccountSession", region)
     except Exception as e:
         error_message = f"Failed to assume role {role_arn} in region {region}: {e}"
         logger.error(error_message)
@@ -100,11 +253,11 @@ def check_alarm_tag(instance_id, tag_key, region, account_id=None):
     """
     try:
         if account_id:
-            logger.info("Using cross-account role for EC2 client.")
+            logger.debug("Using cross-account role for EC2 client.")
             assumed_credentials = assume_cross_account_role(account_id, region)
             ec2_client = boto3_client('ec2', region, assumed_credentials)
         else:
-            logger.info("Using default credentials for EC2 client.")
+            logger.debug("Using default credentials for EC2 client.")
             ec2_client = boto3_client('ec2', region)
 
         # Check if the instance has the appropriate alarm tag
@@ -121,15 +274,6 @@ def check_alarm_tag(instance_id, tag_key, region, account_id=None):
         # Can only be one instance when called by CloudWatch Events
         if 'Reservations' in instance and len(instance['Reservations']) > 0 and len(
                 instance['Reservations'][0]['Instances']) > 0:
-            ec2_client.create_tags(
-                Resources=[instance_id],
-                Tags=[
-                    {
-                        'Key': tag_key,
-                        'Value': str(datetime.utcnow())
-                    }
-                ]
-            )
             return instance['Reservations'][0]['Instances'][0]
         else:
             return False
@@ -140,6 +284,167 @@ def check_alarm_tag(instance_id, tag_key, region, account_id=None):
         raise
 
 
+def describe_tagged_instances(instance_ids, tag_key, region, account_id=None):
+    """
+    Batched check_alarm_tag: returns a dict of InstanceId to instance details for the instances that carry the tag key,
+    describing up to describe_instances_batch_size instances per call.  Instances that do not exist are left out of
+    the result.  If an account ID is provided, assumes a cross-account role to access the EC2 client.
+    """
+    if not instance_ids:
+        return dict()
+    try:
+        if account_id:
+            logger.debug("Using cross-account role for EC2 client.")
+            assumed_credentials = assume_cross_account_role(account_id, region)
+            ec2_client = boto3_client('ec2', region, assumed_credentials)
+        else:
+            logger.debug("Using default credentials for EC2 client.")
+            ec2_client = boto3_client('ec2', region)
+
+        instances = dict()
+        for index in range(0, len(instance_ids), describe_instances_batch_size):
+            batch = instance_ids[index:index + describe_instances_batch_size]
+            # an instance-id filter rather than InstanceIds, so unknown instances are omitted instead of failing the batch
+            paginator = ec2_client.get_paginator('describe_instances')
+            for page in paginator.paginate(
+                    Filters=[
+                        {
+                            'Name': 'instance-id',
+                            'Values': batch
+                        },
+                        {
+                            'Name': 'tag-key',
+                            'Values': [tag_key]
+                        }
+                    ]
+            ):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        instances[instance['InstanceId']] = instance
+        return instances
+
+    except Exception as e:
+        # If any unexpected exceptions occur, log and raise the exception
+        logger.error('Failure describing instances {} with tag key: {} : {}'.format(instance_ids, tag_key, e))
+        raise
+
+
+def update_alarm_tag(ec2_client, instance_ids, tag_key, value):
+    """
+    Sets the value of the alarm tag of the instances.  instance_ids is an instance ID or a list of instance IDs.
+    """
+    if isinstance(instance_ids, str):
+        instance_ids = [instance_ids]
+    ec2_client.create_tags(
+        Resources=instance_ids,
+        Tags=[
+            {
+                'Key': tag_key,
+                'Value': value
+            }
+        ]
+    )
+
+
+def update_alarm_fingerprints(tag_values, tag_key, region, account_id=None):
+    """
+    Writes the alarm tag values of a dict of InstanceId to fingerprint tag value, with one create_tags call per
+    distinct value and describe_instances_batch_size instances.  If an account ID is provided, assumes a cross-account
+    role to access the EC2 client.
+    """
+    if not tag_values:
+        return
+    if account_id:
+        assumed_credentials = assume_cross_account_role(account_id, region)
+        ec2_client = boto3_client('ec2', region, assumed_credentials)
+    else:
+        ec2_client = boto3_client('ec2', region)
+    instance_ids_by_value = dict()
+    for instance_id, value in tag_values.items():
+        instance_ids_by_value.setdefault(value, list()).append(instance_id)
+    for value, instance_ids in instance_ids_by_value.items():
+        for index in range(0, len(instance_ids), describe_instances_batch_size):
+            update_alarm_tag(ec2_client, instance_ids[index:index + describe_instances_batch_size], tag_key, value)
+
+
+def alarm_fingerprint(instance_info, default_alarms, wildcard_alarms, metric_dimensions_map, sns_topic_arn,
+                      cw_namespace, create_default_alarms_flag, alarm_separator, alarm_identifier):
+    """
+    Returns a fingerprint of everything the alarms of the instance are built from: the default alarm catalog, the
+    alarm tags of the instance, the instance attributes used as dimensions and its AMI, and the notification target.
+    The alarms of the instance are unchanged as long as the fingerprint is, except for wildcard alarms resolving to
+    new metrics.
+    """
+    attribute_names = set(name for names in metric_dimensions_map.values() for name in names)
+    attribute_names.update(['ImageId', 'PlatformDetails'])
+    definition = {
+        'Catalog': [default_alarms, wildcard_alarms] if create_default_alarms_flag == 'true' else None,
+        'CloudWatchNamespace': cw_namespace,
+        'Dimensions': metric_dimensions_map,
+        'Separator': alarm_separator,
+        'Identifier': alarm_identifier,
+        'AlarmTags': sorted((tag['Key'], tag['Value']) for tag in instance_info.get('Tags', []) if
+                            tag['Key'].startswith(alarm_identifier) or tag['Key'] == 'aws:autoscaling:groupName'),
+        'Attributes': sorted((name, instance_info[name]) for name in attribute_names if
+                             isinstance(instance_info.get(name, None), str)),
+        'SnsTopicArn': sns_topic_arn
+    }
+    # the catalogs are read-only mappings, serialize them as plain dicts
+    encoded = json.dumps(definition, sort_keys=True, default=dict).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def fingerprint_tag_value(fingerprint, timestamp=None):
+    timestamp = timestamp or datetime.now(timezone.utc)
+    return '{}{}{}'.format(fingerprint, fingerprint_separator, timestamp.strftime(fingerprint_timestamp_format))
+
+
+def is_fingerprint_current(instance_info, tag_key, fingerprint):
+    """
+    Returns True when the alarm tag of the instance holds the fingerprint and is younger than
+    alarm_fingerprint_max_age.  Tags written before fingerprints were introduced are never current.
+    """
+    value = next((tag['Value'] for tag in instance_info.get('Tags', []) if tag['Key'] == tag_key), '')
+    tagged_fingerprint, _, written_at = value.partition(fingerprint_separator)
+    if tagged_fingerprint != fingerprint:
+        return False
+    if not alarm_fingerprint_max_age:
+        return True
+    try:
+        written_at = datetime.strptime(written_at, fingerprint_timestamp_format).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return False
+    return (datetime.now(timezone.utc) - written_at).total_seconds() < alarm_fingerprint_max_age
+
+
+def get_tagged_instance_pages(ec2_client, tag_key, starting_token=None):
+    """
+    Yields the running instances that carry the tag key as one (instances, next_token) tuple per describe_instances
+    page, next_token resumes the listing at the following page.  Filtering is done by EC2 so only tagged, running
+    instances are returned and memory use stays flat regardless of fleet size.
+    """
+    pagination_config = {'PageSize': describe_instances_page_size}
+    if starting_token:
+        pagination_config['StartingToken'] = starting_token
+    paginator = ec2_client.get_paginator('describe_instances')
+    page_iterator = paginator.paginate(
+        Filters=[
+            {
+                'Name': 'tag-key',
+                'Values': [tag_key]
+            },
+            {
+                'Name': 'instance-state-name',
+                'Values': ['running']
+            }
+        ],
+        PaginationConfig=pagination_config
+    )
+    for page in page_iterator:
+        yield ([instance for reservation in page['Reservations'] for instance in reservation['Instances']],
+               page.get('NextToken', None))
+
+
 def get_tags_for_rds_instance(db_instance_arn, region, account_id=None):
     """
     Retrieves the tags for a specified RDS instance. If an account ID is provided,
@@ -147,11 +452,11 @@ def get_tags_for_rds_instance(db_instance_arn, region, account_id=None):
     """
     try:
         if account_id:
-            logger.info("Using cross-account role for RDS client.")
+            logger.debug("Using cross-account role for RDS client.")
             assumed_credentials = assume_cross_account_role(account_id, region)
             rds_client = boto3_client('rds', region, assumed_credentials)
         else:
-            logger.info("Using default credentials for RDS client.")
+            logger.debug("Using default credentials for RDS client.")
             rds_client = boto3_client('rds', region)
 
         response = rds_client.list_tags_for_resource(
@@ -169,15 +474,25 @@ def process_rds_alarms(db_arn, is_cluster, activation_tag, default_alarms, sns_t
                        alarm_identifier, tags, region, account_id=None):
     activation_tag = [{'Key': activation_tag} for tag in tags if tag.get("key", None) == activation_tag]
     if not len(activation_tag) > 0:
-        logger.debug('Activation tag not found for {}, nothing to do'.format(db_arn))
+        logger.debug('Activation tag not found for %s, nothing to do', db_arn)
         return True
-    else:
-        logger.debug('Processing db specific custom alarms for: {}'.format(db_arn))
-        for tag in tags:
-            if tag["key"].startswith(alarm_identifier):
-                logger.info('Alarm identifier found: processing db specific alarms for: {}'.format(
-                    db_arn))
-                default_alarms['AWS/RDS'].append({'Key': tag["key"], 'Value': tag.get("value", "")})
+    alarms = build_rds_alarms(db_arn, is_cluster, default_alarms, sns_topic_arn, alarm_separator, alarm_identifier,
+                              tags)
+    return put_alarms(alarms, region, account_id)
+
+
+def build_rds_alarms(db_arn, is_cluster, default_alarms, sns_topic_arn, alarm_separator, alarm_identifier, tags):
+    """
+    Returns the put_metric_alarm requests for an RDS database instance or cluster from its tags, a list of
+    {'key': ..., 'value': ...} dicts as found in AddTagsToResource events.
+    """
+    logger.debug('Processing db specific custom alarms for: %s', db_arn)
+    api_metrics.increment('RdsResourcesProcessed')
+    alarm_tags = list(default_alarms['AWS/RDS'])
+    for tag in tags:
+        if tag["key"].startswith(alarm_identifier):
+            logger.debug('Alarm identifier found: processing db specific alarms for: %s', db_arn)
+            alarm_tags.append({'Key': tag["key"], 'Value': tag.get("value", "")})
 
     # set the default dimensions for AWS/RDS
     db_id = db_arn.split(':')[-1]
@@ -198,155 +513,169 @@ def process_rds_alarms(db_arn, is_cluster, activation_tag, default_alarms, sns_t
             }
         )
 
-    for tag in default_alarms['AWS/RDS']:
-        alarm_properties = tag['Key'].split(alarm_separator)
-        Namespace = alarm_properties[1]
-        MetricName = alarm_properties[2]
-        ComparisonOperator = alarm_properties[3]
-        Period = alarm_properties[4]
-        EvaluationPeriods = alarm_properties[5]
-        Statistic = alarm_properties[6]
-
-    AlarmName = alarm_separator.join(
-        [alarm_identifier, db_id, Namespace, MetricName, ComparisonOperator, str(tag['Value']),
-         Period, "{}p".format(EvaluationPeriods), Statistic])
-
-    # capture optional alarm description
-    try:
-        AlarmDescription = alarm_properties[7]
-        AlarmName += alarm_separator + AlarmDescription
-    except:
-        logger.info('Description not supplied')
-        AlarmDescription = None
-
-    create_alarm(AlarmName, AlarmDescription, MetricName, ComparisonOperator, Period, tag['Value'], Statistic,
-                 Namespace, dimensions, EvaluationPeriods, sns_topic_arn, region, account_id)
+    alarms = list()
+    for tag in alarm_tags:
+        try:
+            spec = parse_alarm_spec(tag['Key'], alarm_separator)
+        except AlarmSpecError:
+            continue
+        alarms.append(build_alarm_from_spec(db_id, spec, tag['Value'], dimensions + spec.metric_dimensions(),
+                                            sns_topic_arn, alarm_identifier))
+    return alarms
 
 
 def process_lambda_alarms(function_name, tags, activation_tag, default_alarms, sns_topic_arn, alarm_separator,
                           alarm_identifier, region, account_id=None):
     activation_tag = tags.get(activation_tag, 'not_found')
     if activation_tag == 'not_found':
-        logger.debug('Activation tag not found for {}, nothing to do'.format(function_name))
+        logger.debug('Activation tag not found for %s, nothing to do', function_name)
         return True
-    else:
-        logger.debug('Processing function specific alarms for: {}'.format(function_name))
-        for tag_key in tags:
-            if tag_key.startswith(alarm_identifier):
-                default_alarms['AWS/Lambda'].append({'Key': tag_key, 'Value': tags[tag_key]})
+    alarms = build_lambda_alarms(function_name, tags, default_alarms, sns_topic_arn, alarm_separator,
+                                 alarm_identifier)
+    return put_alarms(alarms, region, account_id)
 
-        # get the default dimensions for AWS/EC2
-        dimensions = list()
-        dimensions.append(
-            {
-                'Name': 'FunctionName',
-                'Value': function_name
-            }
-        )
 
-        for tag in default_alarms['AWS/Lambda']:
-            alarm_properties = tag['Key'].split(alarm_separator)
-            Namespace = alarm_properties[1]
-            MetricName = alarm_properties[2]
-            ComparisonOperator = alarm_properties[3]
-            Period = alarm_properties[4]
-
-            # Provide support for previous formatting of custom alarm tags where the evaluation period wasn't specified.
-            # If an evaluation period isn't specified in the tag then it defaults to 1, similar to past behavior.
-            if alarm_properties[5] in valid_statistics:
-                EvaluationPeriods = 1
-                eval_period_offset = 0
-            else:
-                EvaluationPeriods = alarm_properties[5]
-                eval_period_offset = 1
+def build_lambda_alarms(function_name, tags, default_alarms, sns_topic_arn, alarm_separator, alarm_identifier):
+    """
+    Returns the put_metric_alarm requests for a Lambda function from its tags, a dict of tag values by key.
+    """
+    logger.debug('Processing function specific alarms for: %s', function_name)
+    api_metrics.increment('LambdaFunctionsProcessed')
+    alarm_tags = list(default_alarms['AWS/Lambda'])
+    for tag_key in tags:
+        if tag_key.startswith(alarm_identifier):
+            alarm_tags.append({'Key': tag_key, 'Value': tags[tag_key]})
+
+    # get the default dimensions for AWS/EC2
+    dimensions = list()
+    dimensions.append(
+        {
+            'Name': 'FunctionName',
+            'Value': function_name
+        }
+    )
 
-            Statistic = alarm_properties[(5 + eval_period_offset)]
+    alarms = list()
+    for tag in alarm_tags:
+        try:
+            spec = parse_alarm_spec(tag['Key'], alarm_separator)
+        except AlarmSpecError:
+            continue
+        alarms.append(build_alarm_from_spec(function_name, spec, tag['Value'],
+                                            dimensions + spec.metric_dimensions(), sns_topic_arn,
+                                            alarm_identifier))
+    return alarms
 
-            AlarmName = alarm_separator.join(
-                [alarm_identifier, function_name, Namespace, MetricName, ComparisonOperator, str(tag['Value']),
-                 Period, "{}p".format(EvaluationPeriods), Statistic])
 
-            # capture optional alarm description
-            try:
-                AlarmDescription = alarm_properties[(6 + eval_period_offset)]
-                AlarmName += alarm_separator + AlarmDescription
-            except:
-                logger.info('Description not supplied')
-                AlarmDescription = None
-
-            create_alarm(AlarmName, AlarmDescription, MetricName, ComparisonOperator, Period, tag['Value'], Statistic,
-                         Namespace,
-                         dimensions, EvaluationPeriods, sns_topic_arn, region, account_id)
-
-
-# def create_alarm_from_wildcard_tag(instance_id, alarm_tag, instance_info, metric_dimensions_map, sns_topic_arn,
-#                                    alarm_separator, alarm_identifier):
-#     alarm_properties = alarm_tag['Key'].split(alarm_separator)
-#     namespace = alarm_properties[1]
-#     MetricName = alarm_properties[2]
-#     AlarmName = alarm_separator.join([alarm_identifier, id, namespace, MetricName])
-#
-#     dimensions, properties_offset, AlarmName = determine_dimensions(AlarmName, alarm_separator, alarm_tag, instance_info, metric_dimensions_map,
-#                                                                     namespace)
+def get_tagged_lambda_function_pages(tagging_client, tag_key):
+    """
+    Yields the Lambda functions tagged with tag_key as lists of (function name, tags) tuples, one list per page.  The
+    Resource Groups Tagging API returns the functions together with all of their tags, up to 100 per call, so no
+    per-function tag lookups are needed.
+    """
+    paginator = tagging_client.get_paginator('get_resources')
+    for page in paginator.paginate(ResourceTypeFilters=['lambda:function'], TagFilters=[{'Key': tag_key}],
+                                   ResourcesPerPage=100):
+        yield [(resource['ResourceARN'].split(':')[-1],
+                {tag['Key']: tag['Value'] for tag in resource.get('Tags', [])})
+               for resource in page['ResourceTagMappingList']]
+
+
+def get_tagged_db_pages(rds_client, tag_key):
+    """
+    Yields the RDS database instances and then the clusters tagged with tag_key as lists of (ARN, is cluster, tags)
+    tuples, one list per page.  describe_db_instances and describe_db_clusters include the tags of every resource,
+    the tags are returned as {'key': ..., 'value': ...} dicts like in AddTagsToResource events.
+    """
+    for method_name, resources_key, arn_key, is_cluster in [
+        ('describe_db_instances', 'DBInstances', 'DBInstanceArn', False),
+        ('describe_db_clusters', 'DBClusters', 'DBClusterArn', True)
+    ]:
+        for page in rds_client.get_paginator(method_name).paginate():
+            resources = list()
+            for resource in page[resources_key]:
+                tags = [{'key': tag['Key'], 'value': tag['Value']} for tag in resource.get('TagList', [])]
+                if any(tag['key'] == tag_key for tag in tags):
+                    resources.append((resource[arn_key], is_cluster, tags))
+            yield resources
+
+
+def get_tagged_resource_alarm_pages(create_alarm_tag, default_alarms, sns_topic_arn, alarm_separator,
+                                    alarm_identifier, region, account_id=None):
+    """
+    Yields the alarms of the Lambda functions and RDS database instances and clusters tagged with create_alarm_tag
+    in the region, one list of put_metric_alarm requests per page of resources.  Only the resource types in
+    SCAN_RESOURCE_TYPES are discovered.  A notify tag overrides sns_topic_arn like it does for tag events.  If an
+    account ID is provided, assumes a cross-account role to access the clients.
+    """
+    if account_id:
+        assumed_credentials = assume_cross_account_role(account_id, region)
+    else:
+        assumed_credentials = None
+
+    if 'lambda' in scan_resource_types:
+        tagging_client = boto3_client('resourcegroupstaggingapi', region, assumed_credentials)
+        for functions in get_tagged_lambda_function_pages(tagging_client, create_alarm_tag):
+            yield [alarm for function_name, tags in functions for alarm in
+                   build_lambda_alarms(function_name, tags, default_alarms, tags.get('notify', sns_topic_arn),
+                                       alarm_separator, alarm_identifier)]
+
+    if 'rds' in scan_resource_types:
+        rds_client = boto3_client('rds', region, assumed_credentials)
+        for db_resources in get_tagged_db_pages(rds_client, create_alarm_tag):
+            alarms = list()
+            for db_arn, is_cluster, tags in db_resources:
+                target_sns_topic_arn = next((tag['value'] for tag in tags if tag['key'] == 'notify'), sns_topic_arn)
+                alarms.extend(build_rds_alarms(db_arn, is_cluster, default_alarms, target_sns_topic_arn,
+                                               alarm_separator, alarm_identifier, tags))
+            yield alarms
+
 
 def create_alarm_from_tag(id, alarm_tag, instance_info, metric_dimensions_map, sns_topic_arn, alarm_separator,
                           alarm_identifier, region, account_id = None):
-    # split alarm tag to decipher alarm properties, first property is alarm_identifier and ignored...
-    alarm_properties = alarm_tag['Key'].split(alarm_separator)
-    namespace = alarm_properties[1]
-    MetricName = alarm_properties[2]
-
-    AlarmName = alarm_separator.join([alarm_identifier, id, namespace, MetricName])
-
-    dimensions, properties_offset, AlarmName = determine_dimensions(AlarmName, alarm_separator, alarm_tag,
-                                                                    instance_info, metric_dimensions_map,
-                                                                    namespace)
-
-    logger.info("dimensions: {}, properties_offset: {}, AlarmName: {}".format(dimensions, properties_offset, AlarmName))
-    ComparisonOperator = alarm_properties[(properties_offset + 3)]
-    Period = alarm_properties[(properties_offset + 4)]
-
-    # Provide support for previous formatting of custom alarm tags where the evaluation period wasn't specified.
-    # If an evaluation period isn't specified in the tag then it defaults to 1, similar to past behavior.
-    if alarm_properties[(properties_offset + 5)] in valid_statistics:
-        EvaluationPeriods = 1
-        eval_period_offset = 0
-    else:
-        EvaluationPeriods = alarm_properties[(properties_offset + 5)]
-        eval_period_offset = 1
+    alarm = build_alarm_from_tag(id, alarm_tag, instance_info, metric_dimensions_map, sns_topic_arn, alarm_separator,
+                                 alarm_identifier)
+    return put_alarm(alarm, region, account_id)
 
-    Statistic = alarm_properties[(properties_offset + 5 + eval_period_offset)]
 
-    AlarmName += alarm_separator.join(
-        ['', ComparisonOperator, str(alarm_tag['Value']), str(Period), "{}p".format(EvaluationPeriods), Statistic])
+def build_alarm_from_tag(id, alarm_tag, instance_info, metric_dimensions_map, sns_topic_arn, alarm_separator,
+                         alarm_identifier):
+    """
+    Returns the put_metric_alarm request for an EC2 instance alarm tag without creating the alarm.
+    Raises AlarmSpecError if the tag key is invalid.
+    """
+    spec = parse_alarm_spec(alarm_tag['Key'], alarm_separator)
+    dimensions = determine_dimensions(spec, instance_info, metric_dimensions_map)
+    return build_alarm_from_spec(id, spec, alarm_tag['Value'], dimensions, sns_topic_arn, alarm_identifier)
 
-    # add the description to the alarm name. If none are specified, log a message
-    try:
-        AlarmDescription = alarm_properties[(properties_offset + 6 + eval_period_offset)]
-        AlarmName += alarm_separator + AlarmDescription
-    except:
-        logger.info('Description not supplied')
-        AlarmDescription = None
 
-    create_alarm(AlarmName, AlarmDescription, MetricName, ComparisonOperator, Period, alarm_tag['Value'], Statistic,
-                 namespace,
-                 dimensions, EvaluationPeriods, sns_topic_arn, region, account_id)
+def build_alarm_from_spec(id, spec, threshold, dimensions, sns_topic_arn, alarm_identifier):
+    """
+    Returns the put_metric_alarm request for a compiled alarm spec and threshold without creating the alarm.
+    """
+    AlarmName = spec.alarm_name(alarm_identifier, id, threshold)
+    logger.debug("dimensions: %s, AlarmName: %s", dimensions, AlarmName)
+    return build_alarm(AlarmName, spec.description, spec.metric, spec.comparator, spec.period, threshold,
+                       spec.statistic, spec.namespace, dimensions, spec.evaluation_periods, sns_topic_arn)
 
 
-def determine_dimensions(AlarmName, alarm_separator, alarm_tag, instance_info, metric_dimensions_map, namespace):
+def determine_dimensions(spec, instance_info, metric_dimensions_map):
+    """
+    Returns the dimensions for an alarm on the instance: the dimensions configured for the namespace of the spec in
+    metric_dimensions_map, populated from the instance, followed by the dimensions specified in the tag key.
+    """
     dimensions = list()
     # the number of dimensions may be different depending on the namespace.  For the default 'CWAgent' namespace, the default is to also include extended properties defined in cw_auto_alarms.py:append_dimensions
-    for dimension_name in metric_dimensions_map.get(namespace, list()):
+    for dimension_name in metric_dimensions_map.get(spec.namespace, list()):
         dimension = dict()
         # Evaluate the dimensions specified for the metric namespace
         # If AutoScalingGroupName has been specified as a dimension to include, we first check to see if the instance has a tag indicating it is a part of an ASG.
         # If it is, we get the ASG name and populate its value for this dimension.
         if dimension_name == 'AutoScalingGroupName':
             # find out if the instance is part of an autoscaling group
-            instance_asg = next(
-                (tag['Value'] for tag in instance_info['Tags'] if tag['Key'] == 'aws:autoscaling:groupName'), None)
-            if instance_asg:
-                dimension_value = instance_asg
+            asg_name = instance_asg(instance_info)
+            if asg_name:
+                dimension_value = asg_name
                 dimension['Name'] = dimension_name
                 dimension['Value'] = dimension_value
                 dimensions.append(dimension)
@@ -362,99 +691,219 @@ def determine_dimensions(AlarmName, alarm_separator, alarm_tag, instance_info, m
                 logger.warning(
                     "Dimension {} has been specified in APPEND_DIMENSIONS but  no dimension value exists, skipping...".format(
                         dimension_name))
-    logger.debug("dimensions are {}".format(dimensions))
-    additional_dimensions = determine_additional_dimensions(alarm_tag, alarm_separator)
-    # process the dimensions
-    properties_offset = 0
-    try:
-        if additional_dimensions:
-            for num, dim in enumerate(additional_dimensions[::2]):
-                val = additional_dimensions[num * 2 + 1]
-                dimensions.append(
-                    {
-                        'Name': dim,
-                        'Value': val
-                    }
-                )
-                AlarmName += alarm_separator.join(['', dim, val])
-                properties_offset = properties_offset + 2
-    except Exception as e:
-        logger.error('Getting dimensions: {}'.format(e))
-        raise
+    dimensions.extend(spec.metric_dimensions())
+    logger.debug("dimensions are %s", dimensions)
+    return dimensions
 
-    return dimensions, properties_offset, AlarmName
 
-
-def determine_additional_dimensions(alarm_tag, alarm_separator):
-    alarm_properties = alarm_tag['Key'].split(alarm_separator)
-    additional_dimensions = list()
-    # determine the dimensions and the last dimension for this alarm
-    # exclude last element which is the DESCRIPTION that differentiates alarms
-    for index, prop in enumerate(alarm_properties[3:-1], start=3):
-        if prop in valid_comparators:
-            prop_end_index = index
-            break
-    else:
-        prop_end_index = None
-    if prop_end_index:
-        additional_dimensions.extend(alarm_properties[3:prop_end_index])
-    else:
-        logger.error('Unable to determine the dimensions for alarm tag: {}'.format(alarm_tag))
-        raise Exception
-    return additional_dimensions
-
-
-def process_alarm_tags(instance_id, instance_info, default_alarms, wildcard_alarms, metric_dimensions_map,
-                       sns_topic_arn, cw_namespace, create_default_alarms_flag, alarm_separator, alarm_identifier,
-                       region, account_id=None):
+def determine_desired_alarms(instance_id, instance_info, default_alarms, wildcard_alarms, metric_dimensions_map,
+                             sns_topic_arn, cw_namespace, create_default_alarms_flag, alarm_separator, alarm_identifier,
+                             region, account_id=None):
+    """
+    Returns the put_metric_alarm requests for every custom, default, platform and wildcard alarm of the instance,
+    keyed by alarm name.  Nothing is written, the region and account are only used to look up the platform and
+    resolve wildcard dimensions.
+    """
     tags = instance_info['Tags']
 
     ImageId = instance_info['ImageId']
-    logger.debug('ImageId is: {}'.format(ImageId))
-    platform = determine_platform(ImageId, region, account_id)
+    logger.debug('ImageId is: %s', ImageId)
+    platform = determine_platforms([instance_info], region, account_id)[ImageId]
+    logger.debug('Platform is: %s', platform)
 
-    # if platform information is unavailable via determine_platform, try the platform in instance_info
-    # determine_platform uses the describe_images API call. In some cases, the AMI may be deregistered
-    # hence, use instance_info to extract platform details. This can detect Windows, Red Hat, SUSE platforms
-    # instance_info does not contain enough information to distinguish Ubuntu and Amazon Linux platforms
+    desired_alarms = dict()
 
-    if not platform:
-        platform_details = instance_info['PlatformDetails']
-        logger.debug('Platform details of instance: {}'.format(platform_details))
-        platform = format_platform_details(platform_details)
-
-    logger.debug('Platform is: {}'.format(platform))
+    def add_desired_alarms(alarm_tags):
+        for alarm_tag in alarm_tags:
+            try:
+                alarm = build_alarm_from_tag(instance_id, alarm_tag, instance_info, metric_dimensions_map,
+                                             sns_topic_arn, alarm_separator, alarm_identifier)
+            except AlarmSpecError:
+                # the invalid tag has been reported when it was parsed, carry on with the remaining alarms
+                continue
+            desired_alarms[alarm['AlarmName']] = alarm
 
     # scan instance tags and create alarms for any custom alarm tags
-    for instance_tag in tags:
-        if instance_tag['Key'].startswith(alarm_identifier):
-            create_alarm_from_tag(instance_id, instance_tag, instance_info, metric_dimensions_map, sns_topic_arn,
-                                  alarm_separator, alarm_identifier, region, account_id)
+    add_desired_alarms([instance_tag for instance_tag in tags if instance_tag['Key'].startswith(alarm_identifier)])
 
     if create_default_alarms_flag == 'true':
-        for alarm_tag in default_alarms['AWS/EC2']:
-            create_alarm_from_tag(instance_id, alarm_tag, instance_info, metric_dimensions_map, sns_topic_arn,
-                                  alarm_separator, alarm_identifier, region, account_id)
+        add_desired_alarms(default_alarms['AWS/EC2'])
         if platform:
-            for alarm_tag in default_alarms[cw_namespace][platform]:
-                create_alarm_from_tag(instance_id, alarm_tag, instance_info, metric_dimensions_map, sns_topic_arn,
-                                      alarm_separator, alarm_identifier, region, account_id)
+            add_desired_alarms(default_alarms[cw_namespace][platform])
             if wildcard_alarms and cw_namespace in wildcard_alarms and platform in wildcard_alarms[cw_namespace]:
-                for wildcard_alarm_tag in wildcard_alarms[cw_namespace][platform]:
-                    logger.info("processing wildcard tag {}".format(wildcard_alarm_tag))
-                    resolved_alarm_tags = determine_wildcard_alarms(wildcard_alarm_tag, alarm_separator,
-                                                                    instance_info, metric_dimensions_map, region, account_id)
-                    if resolved_alarm_tags:
-                        for resolved_alarm_tag in resolved_alarm_tags:
-                            create_alarm_from_tag(instance_id, resolved_alarm_tag, instance_info, metric_dimensions_map,
-                                                  sns_topic_arn,
-                                                  alarm_separator, alarm_identifier, region, account_id)
-                    else:
-                        logger.info("No wildcard alarms found for platform: {}".format(platform))
+                resolved_alarm_tags = resolve_wildcard_alarms(wildcard_alarms[cw_namespace][platform],
+                                                              alarm_separator, instance_info, metric_dimensions_map,
+                                                              region, account_id)
+                if resolved_alarm_tags:
+                    add_desired_alarms(resolved_alarm_tags)
+                else:
+                    logger.debug("No wildcard alarms found for platform: %s", platform)
         else:
             logger.warning("Skipping platform specific alarm creation for {}, unknown platform.".format(instance_id))
     else:
-        logger.info("Default alarm creation is turned off")
+        logger.debug("Default alarm creation is turned off")
+
+    return desired_alarms
+
+
+def instance_asg(instance_info):
+    """
+    Returns the name of the Auto Scaling group of the instance, or None if it is not part of one.
+    """
+    return next((tag['Value'] for tag in instance_info['Tags'] if tag['Key'] == 'aws:autoscaling:groupName'), None)
+
+
+def uses_asg_alarms(instance_info):
+    """
+    Returns True if the alarms of the instance are the alarms of its Auto Scaling group, see ASG_ALARMS.
+    """
+    return asg_alarms_mode in ['dimension', 'metrics-insights'] and instance_asg(instance_info) is not None
+
+
+def asg_metrics_insights_query(asg_name, spec, instance_info, metric_dimensions_map):
+    """
+    Returns a Metrics Insights query for the alarm spec over the instance metrics of the Auto Scaling group, grouped
+    by InstanceId and by the wildcard dimensions of the spec, that keeps the series of the worst instance: the highest
+    for GreaterThan comparators, the lowest for LessThan comparators.  Returns None if the spec cannot be expressed as
+    a query: its statistic has no Metrics Insights function, it is an anomaly detection alarm, or the metrics of the
+    instance do not carry the InstanceId and AutoScalingGroupName dimensions.
+    """
+    function = metrics_insights_functions.get(spec.statistic, None)
+    if not function or spec.is_anomaly_detection or "'" in asg_name:
+        return None
+    dimension_names = [dimension['Name'] for dimension in
+                       determine_dimensions(spec, instance_info, metric_dimensions_map)]
+    if 'InstanceId' not in dimension_names or 'AutoScalingGroupName' not in dimension_names:
+        return None
+    filters = ["\"AutoScalingGroupName\" = '{}'".format(asg_name)]
+    filters.extend("\"{}\" = '{}'".format(name, value) for name, value in spec.dimensions if
+                   name not in spec.wildcard_dimensions)
+    group_by = ['InstanceId'] + list(spec.wildcard_dimensions)
+    return 'SELECT {function}("{metric}") FROM SCHEMA("{namespace}", {dimensions}) WHERE {filters} GROUP BY ' \
+           '{group_by} ORDER BY {function}() {order} LIMIT 1'.format(
+                function=function, metric=spec.metric, namespace=spec.namespace,
+                dimensions=', '.join('"{}"'.format(name) for name in dimension_names),
+                filters=' AND '.join(filters), group_by=', '.join('"{}"'.format(name) for name in group_by),
+                order='ASC' if spec.comparator.startswith('LessThan') else 'DESC')
+
+
+def build_asg_alarm(asg_name, spec, threshold, instance_info, metric_dimensions_map, sns_topic_arn,
+                    alarm_identifier):
+    """
+    Returns the put_metric_alarm request of the alarm spec for an Auto Scaling group, or None if the spec cannot be
+    alarmed on at group level: wildcard dimensions can only be resolved by a Metrics Insights query.
+    """
+    alarm_name = spec.alarm_name(alarm_identifier, asg_name, threshold)
+    if asg_alarms_mode == 'metrics-insights' and spec.namespace != 'AWS/EC2':
+        query = asg_metrics_insights_query(asg_name, spec, instance_info, metric_dimensions_map)
+        if query:
+            return build_query_alarm(alarm_name, spec.description, query, spec.comparator, spec.period, threshold,
+                                     spec.evaluation_periods, sns_topic_arn)
+    if spec.has_wildcards:
+        structured_log.info('asg_alarm_skipped', 'wildcard dimensions cannot be resolved for a group', sample=True,
+                            alarm_name=alarm_name, asg=asg_name)
+        return None
+    dimensions = [{'Name': 'AutoScalingGroupName', 'Value': asg_name}] + spec.metric_dimensions()
+    return build_alarm_from_spec(asg_name, spec, threshold, dimensions, sns_topic_arn, alarm_identifier)
+
+
+def determine_asg_desired_alarms(asg_name, instance_info, default_alarms, wildcard_alarms, metric_dimensions_map,
+                                 sns_topic_arn, cw_namespace, create_default_alarms_flag, alarm_separator,
+                                 alarm_identifier, region, account_id=None):
+    """
+    Returns the put_metric_alarm requests of the Auto Scaling group, keyed by alarm name, for the custom, default,
+    platform and wildcard alarm tags of one of its instances.  Nothing is written, the region and account are only
+    used to look up the platform.
+    """
+    alarm_tags = [instance_tag for instance_tag in instance_info['Tags'] if
+                  instance_tag['Key'].startswith(alarm_identifier)]
+    if create_default_alarms_flag == 'true':
+        alarm_tags.extend(default_alarms['AWS/EC2'])
+        platform = determine_platforms([instance_info], region, account_id)[instance_info['ImageId']]
+        if platform:
+            alarm_tags.extend(default_alarms[cw_namespace][platform])
+            if wildcard_alarms and cw_namespace in wildcard_alarms and platform in wildcard_alarms[cw_namespace]:
+                alarm_tags.extend(wildcard_alarms[cw_namespace][platform])
+        else:
+            logger.warning("Skipping platform specific alarm creation for {}, unknown platform.".format(asg_name))
+
+    desired_alarms = dict()
+    for alarm_tag in alarm_tags:
+        try:
+            spec = parse_alarm_spec(alarm_tag['Key'], alarm_separator)
+        except AlarmSpecError:
+            continue
+        alarm = build_asg_alarm(asg_name, spec, alarm_tag['Value'], instance_info, metric_dimensions_map,
+                                sns_topic_arn, alarm_identifier)
+        if alarm:
+            desired_alarms[alarm['AlarmName']] = alarm
+    return desired_alarms
+
+
+def process_asg_alarms(asg_name, instance_info, default_alarms, wildcard_alarms, metric_dimensions_map,
+                       sns_topic_arn, cw_namespace, create_default_alarms_flag, alarm_separator, alarm_identifier,
+                       region, account_id=None):
+    """
+    Writes the alarms of the Auto Scaling group of the instance that were not written with the same definition for
+    the group within ASG_ALARMS_CACHE_TTL seconds.  Returns the number of alarms written and whether all of them
+    were written.
+    """
+    desired_alarms = determine_asg_desired_alarms(asg_name, instance_info, default_alarms, wildcard_alarms,
+                                                  metric_dimensions_map, sns_topic_arn, cw_namespace,
+                                                  create_default_alarms_flag, alarm_separator, alarm_identifier,
+                                                  region, account_id)
+    cache_key = (account_id, region, asg_name)
+    written_hashes = asg_alarms_cache.get(cache_key, None) or dict()
+    desired_hashes = dict((alarm_name, alarm_hash(alarm)) for alarm_name, alarm in desired_alarms.items())
+    alarms = [desired_alarms[alarm_name] for alarm_name in sorted(desired_alarms) if
+              written_hashes.get(alarm_name, None) != desired_hashes[alarm_name]]
+    if not alarms:
+        api_metrics.increment('AsgMembersUnchanged')
+        return 0, True
+    api_metrics.increment('AsgAlarmSetsProcessed')
+    results = alarm_engine.call_all(put_alarm, [(alarm, region, account_id) for alarm in alarms])
+    # the members of a group may differ, e.g. in platform, the alarms of all of them are remembered
+    written_hashes = dict(written_hashes)
+    written_hashes.update((alarm['AlarmName'], desired_hashes[alarm['AlarmName']]) for alarm, written in
+                          zip(alarms, results) if written)
+    asg_alarms_cache.set(cache_key, written_hashes, time.time() + asg_alarms_cache_ttl)
+    return sum(1 for written in results if written), all(results)
+
+
+def process_alarm_tags(instance_id, instance_info, default_alarms, wildcard_alarms, metric_dimensions_map,
+                       sns_topic_arn, cw_namespace, create_default_alarms_flag, alarm_separator, alarm_identifier,
+                       region, account_id=None, reconcile_alarms_flag='false', use_alarm_index=False):
+    """
+    Creates the alarms for the instance, they are written concurrently on the call executor of alarm_engine.  Returns
+    the number of alarms written and whether every desired alarm was written, an instance with alarms that failed to
+    write is not up to date.  When reconcile_alarms_flag is 'true', only alarms that are missing or differ from their
+    desired definition are written and alarms for the instance that are no longer desired are deleted,
+    use_alarm_index is passed on to reconcile_alarms.  An instance that uses the alarms of its Auto Scaling group
+    writes those instead.  The outcome is logged as one resource record.
+    """
+    api_metrics.increment('InstancesProcessed')
+    with structured_log.resource('ec2', instance_id, account_id=account_id, region=region) as record:
+        if uses_asg_alarms(instance_info):
+            record.add(asg=instance_asg(instance_info))
+            alarms_written, complete = process_asg_alarms(instance_asg(instance_info), instance_info, default_alarms,
+                                                          wildcard_alarms, metric_dimensions_map, sns_topic_arn,
+                                                          cw_namespace, create_default_alarms_flag, alarm_separator,
+                                                          alarm_identifier, region, account_id)
+            record.add(alarms_written=alarms_written, complete=complete)
+            return alarms_written, complete
+        desired_alarms = determine_desired_alarms(instance_id, instance_info, default_alarms, wildcard_alarms,
+                                                  metric_dimensions_map, sns_topic_arn, cw_namespace,
+                                                  create_default_alarms_flag, alarm_separator, alarm_identifier,
+                                                  region, account_id)
+        record.add(image_id=instance_info['ImageId'], alarms_desired=len(desired_alarms))
+        if reconcile_alarms_flag == 'true':
+            alarms_written, complete = reconcile_alarms(instance_id, desired_alarms, alarm_identifier,
+                                                        alarm_separator, region, account_id, use_alarm_index)
+        else:
+            alarms_written = put_alarms(list(desired_alarms.values()), region, account_id)
+            complete = alarms_written == len(desired_alarms)
+        record.add(alarms_written=alarms_written, complete=complete)
+        return alarms_written, complete
 
 
 def determine_wildcard_alarms(wildcard_alarm_tag, alarm_separator, instance_info, metric_dimensions_map,
@@ -462,117 +911,188 @@ def determine_wildcard_alarms(wildcard_alarm_tag, alarm_separator, instance_info
     """
     Determines fixed alarm tags for wildcard alarms, using cross-account permissions if an account ID is provided.
     """
+    return resolve_wildcard_alarms([wildcard_alarm_tag], alarm_separator, instance_info, metric_dimensions_map, region,
+                                   account_id)
+
+
+def resolve_wildcard_alarms(wildcard_alarm_tags, alarm_separator, instance_info, metric_dimensions_map, region,
+                            account_id=None):
+    """
+    Determines fixed alarm tags for all wildcard alarm tags of an instance.  The tags are grouped by namespace and
+    each group is resolved with a single, fully paginated list_metrics lookup filtered on the fixed dimensions the
+    group has in common, the results are then matched to each tag locally.
+    """
     try:
+        groups = dict()
+        for wildcard_alarm_tag in wildcard_alarm_tags:
+            spec = parse_alarm_spec(wildcard_alarm_tag['Key'], alarm_separator)
+            dimensions = determine_dimensions(spec, instance_info, metric_dimensions_map)
+            fixed_dimensions = [(dimension['Name'], dimension['Value']) for dimension in dimensions if
+                                dimension['Value'] != '*']
+            groups.setdefault(spec.namespace, list()).append((wildcard_alarm_tag, spec, fixed_dimensions))
+
         fixed_alarm_tags = []
-        alarm_properties = wildcard_alarm_tag['Key'].split(alarm_separator)
-        namespace = alarm_properties[1]
-        MetricName = alarm_properties[2]
+        for namespace, group in groups.items():
+            common_dimensions = [dimension for dimension in group[0][2] if
+                                 all(dimension in fixed_dimensions for _, _, fixed_dimensions in group)]
+            metric_names = set(spec.metric for _, spec, _ in group)
+            metric_name = metric_names.pop() if len(metric_names) == 1 else None
+            metrics = list_metrics(namespace, metric_name, common_dimensions, region, account_id)
+
+            for wildcard_alarm_tag, spec, fixed_dimensions in group:
+                resolved_keys = list()
+                for metric in metrics:
+                    if metric['MetricName'] != spec.metric:
+                        continue
+                    metric_dimensions = {metric_dim['Name']: metric_dim['Value'] for metric_dim in metric['Dimensions']}
+                    if any(metric_dimensions.get(name, None) != value for name, value in fixed_dimensions):
+                        continue
+                    resolved_key = spec.resolve_wildcards(metric_dimensions).key
+                    if resolved_key not in resolved_keys:
+                        resolved_keys.append(resolved_key)
+                logger.debug("wildcard alarm %s resolved to %s", wildcard_alarm_tag['Key'], resolved_keys)
+                fixed_alarm_tags.extend({'Key': key, 'Value': wildcard_alarm_tag['Value']} for key in resolved_keys)
+
+        logger.debug("%s wildcard alarm tags resolved to %s fixed alarm tags", len(wildcard_alarm_tags),
+                     len(fixed_alarm_tags))
+        return fixed_alarm_tags
 
-        dimensions, properties_offset, AlarmName = determine_dimensions("", alarm_separator, wildcard_alarm_tag,
-                                                                        instance_info, metric_dimensions_map,
-                                                                        namespace)
-        logger.info("wildcard alarm: {}, dimensions: {}, properties offset: {}".format(wildcard_alarm_tag, dimensions,
-                                                                                       properties_offset))
+    except Exception as e:
+        logger.error('Error determining wildcard alarms: {}'.format(e))
+        raise
 
-        wildcard_dimensions = [dimension for dimension in dimensions if dimension['Value'] == '*']
-        fixed_dimensions = [dimension for dimension in dimensions if dimension['Value'] != '*']
 
-        logger.info("original dimensions: {}, wildcard_dimensions: {}, fixed_dimensions: {}".format(
-            dimensions, wildcard_dimensions, fixed_dimensions
-        ))
+def list_metrics(namespace, metric_name, dimensions, region, account_id=None):
+    """
+    Returns all metrics in the namespace, optionally limited to metric_name, that have the given (name, value)
+    dimensions.  Results are cached for WILDCARD_METRICS_CACHE_TTL seconds.
+    """
+    cache_key = (account_id, region, namespace, metric_name, frozenset(dimensions))
 
+    def load_metrics():
         # Use cross-account role if account_id is provided
         if account_id:
-            logger.info("Using cross-account role for CloudWatch client.")
+            logger.debug("Using cross-account role for CloudWatch client.")
             assumed_credentials = assume_cross_account_role(account_id, region)
             cw_client = boto3_client('cloudwatch', region, assumed_credentials)
         else:
-            logger.info("Using default credentials for CloudWatch client.")
+            logger.debug("Using default credentials for CloudWatch client.")
             cw_client = boto3_client('cloudwatch', region)
 
-        listmetrics_response = cw_client.list_metrics(
-            Namespace=namespace,
-            MetricName=MetricName,
-            Dimensions=fixed_dimensions
-        )
+        request = {
+            'Namespace': namespace,
+            'Dimensions': [{'Name': name, 'Value': value} for name, value in dimensions]
+        }
+        if metric_name:
+            request['MetricName'] = metric_name
 
-        logger.info("list_metrics response: {}".format(listmetrics_response))
-
-        metrics_for_wildcards = None
-        if 'Metrics' in listmetrics_response:
-            metrics_for_wildcards = listmetrics_response['Metrics']
-            for metric in metrics_for_wildcards:
-                translated_alarm = dict()
-                original_alarm_key = alarm_properties.copy()
-                metric_dimensions = metric['Dimensions']
-                for wildcard_dim in wildcard_dimensions:
-                    for metric_dim in metric_dimensions:
-                        if metric_dim['Name'] == wildcard_dim['Name']:
-                            original_dim_value_index = original_alarm_key.index(metric_dim['Name']) + 1
-                            original_alarm_key[original_dim_value_index] = metric_dim['Value']
-
-                translated_alarm['Key'] = alarm_separator.join(original_alarm_key)
-                translated_alarm['Value'] = wildcard_alarm_tag['Value']
-                fixed_alarm_tags.append(translated_alarm)
-
-        logger.info("fixed alarm tags are: {}".format(fixed_alarm_tags))
-        return fixed_alarm_tags
+        metrics = list()
+        paginator = cw_client.get_paginator('list_metrics')
+        for page in paginator.paginate(**request):
+            metrics.extend(page.get('Metrics', list()))
+        logger.debug("list_metrics for %s returned %s metrics", request, len(metrics))
+        return metrics, time.time() + wildcard_metrics_cache_ttl
 
-    except Exception as e:
-        logger.error('Error determining wildcard alarms: {}'.format(e))
-        raise
+    return wildcard_metrics_cache.get_or_load(cache_key, load_metrics)
+
+
+def determine_platforms(instances, region, account_id=None):
+    """
+    Returns a dict of ImageId to platform for the AMIs of the instances.  Cached platforms are reused, the remaining
+    AMIs are resolved with batched describe_images calls.  If the AMI has been deregistered, the platform is taken
+    from the PlatformDetails of the instance.  This can detect Windows, Red Hat and SUSE, but not distinguish Ubuntu
+    from Amazon Linux, in which case the platform is None.  All results are cached, including fallbacks.
+    """
+    platforms = dict()
+    unresolved = dict()
+    for instance in instances:
+        image_id = instance['ImageId']
+        if image_id in platforms or image_id in unresolved:
+            continue
+        platform = platform_cache.get(image_id, missing_platform)
+        if platform is missing_platform:
+            unresolved[image_id] = instance.get('PlatformDetails', '')
+        else:
+            platforms[image_id] = platform
+
+    if unresolved:
+        image_platforms = describe_image_platforms(list(unresolved), region, account_id)
+        expires_at = time.time() + platform_cache_ttl
+        for image_id, platform_details in unresolved.items():
+            if image_id in image_platforms:
+                platform = image_platforms[image_id]
+            else:
+                logger.warning("No image information found for ImageId: {}, using instance platform details {}".format(
+                    image_id, platform_details))
+                platform = format_platform_details(platform_details)
+            platform_cache.set(image_id, platform, expires_at)
+            platforms[image_id] = platform
+
+    return platforms
 
 
-def determine_platform(imageid, region, account_id=None):
+def describe_image_platforms(image_ids, region, account_id=None):
     """
-    Determines the platform of an EC2 instance based on its AMI image ID.
+    Returns a dict of ImageId to platform for the images found by describe_images, batching up to
+    describe_images_batch_size images per call.  Images that no longer exist are left out of the result.
     If an account ID is provided, assumes a cross-account role to access the EC2 client.
     """
     try:
         # Use cross-account role if account_id is provided
         if account_id:
-            logger.info("Using cross-account role for EC2 client.")
+            logger.debug("Using cross-account role for EC2 client.")
             assumed_credentials = assume_cross_account_role(account_id, region)
             ec2_client = boto3_client('ec2', region, assumed_credentials)
         else:
-            logger.info("Using default credentials for EC2 client.")
+            logger.debug("Using default credentials for EC2 client.")
             ec2_client = boto3_client('ec2', region)
 
-        # Retrieve image information
-        image_info = ec2_client.describe_images(
-            ImageIds=[imageid]
-        )
-
-        # Process the image information to determine the platform
-        if 'Images' in image_info and len(image_info['Images']) > 0:
-            platform_details = image_info['Images'][0].get('PlatformDetails', '')
-            logger.debug('Platform details of image: {}'.format(platform_details))
-            platform = format_platform_details(platform_details)
-
-            if not platform and 'Linux/UNIX' in platform_details:
-                image_name = image_info['Images'][0].get('Name', '').lower()
-                description = image_info['Images'][0].get('Description', '').lower()
-                if 'ubuntu' in image_name:
-                    platform = 'Ubuntu'
-                elif 'ubuntu' in description:
-                    platform = 'Ubuntu'
-                else:
-                    # an assumption is made here that it is Amazon Linux.
-                    # note that it could still be an Ubuntu EC2 instance if the AMI is an Ubuntu image
-                    # but the Name and Description does not contain 'ubuntu'
-                    platform = 'Amazon Linux'
-            return platform
-        else:
-            logger.warning("No image information found for ImageId: {}".format(imageid))
-            return None
+        image_platforms = dict()
+        for index in range(0, len(image_ids), describe_images_batch_size):
+            # an image-id filter rather than ImageIds, so deregistered AMIs are omitted instead of failing the batch
+            image_info = ec2_client.describe_images(
+                Filters=[
+                    {
+                        'Name': 'image-id',
+                        'Values': image_ids[index:index + describe_images_batch_size]
+                    }
+                ],
+                IncludeDeprecated=True
+            )
+            for image in image_info.get('Images', list()):
+                image_platforms[image['ImageId']] = determine_image_platform(image)
+        return image_platforms
 
     except Exception as e:
         # If any other exceptions which we didn't expect are raised
         # then fail and log the exception message.
-        logger.error('Failure describing image {}: {}'.format(imageid, e))
+        logger.error('Failure describing images {}: {}'.format(image_ids, e))
         raise
 
 
+def determine_image_platform(image):
+    """
+    Determines the platform of an EC2 instance from the describe_images details of its AMI.
+    """
+    platform_details = image.get('PlatformDetails', '')
+    logger.debug('Platform details of image: %s', platform_details)
+    platform = format_platform_details(platform_details)
+
+    if not platform and 'Linux/UNIX' in platform_details:
+        image_name = image.get('Name', '').lower()
+        description = image.get('Description', '').lower()
+        if 'ubuntu' in image_name:
+            platform = 'Ubuntu'
+        elif 'ubuntu' in description:
+            platform = 'Ubuntu'
+        else:
+            # an assumption is made here that it is Amazon Linux.
+            # note that it could still be an Ubuntu EC2 instance if the AMI is an Ubuntu image
+            # but the Name and Description does not contain 'ubuntu'
+            platform = 'Amazon Linux'
+    return platform
+
+
 def format_platform_details(platform_details):
     if 'Windows' in platform_details or 'SQL Server' in platform_details:
         return 'Windows'
@@ -594,23 +1114,22 @@ def format_platform_details(platform_details):
         return None
 
 
-def convert_to_seconds(s):
-    try:
-        seconds_per_unit = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
-        return int(s[:-1]) * seconds_per_unit[s[-1]]
-    except Exception as e:
-        # If any other exceptions which we didn't expect are raised
-        # then fail and log the exception message.
-        logger.error('Error converting threshold string {} to seconds!'.format(s, e))
-        raise
-
-
 # Alarm Name Format: <AlarmIdentifier>-<InstanceId>-<Namespace>-<MetricName>-<ComparisonOperator>-<Threshold>-<Period>-<EvaluationPeriods>p-<Statistic>
 # Example:  AutoAlarm-i-00e4f327736cb077f-AWS/EC2_CPUUtilization-GreaterThanThreshold-80-5m-1p=Average
 def create_alarm(AlarmName, AlarmDescription, MetricName, ComparisonOperator, Period, Threshold, Statistic, Namespace,
                  Dimensions,
                  EvaluationPeriods,
                  sns_topic_arn, region, account_id = None):
+    alarm = build_alarm(AlarmName, AlarmDescription, MetricName, ComparisonOperator, Period, Threshold, Statistic,
+                        Namespace, Dimensions, EvaluationPeriods, sns_topic_arn)
+    return put_alarm(alarm, region, account_id)
+
+
+def build_alarm(AlarmName, AlarmDescription, MetricName, ComparisonOperator, Period, Threshold, Statistic, Namespace,
+                Dimensions, EvaluationPeriods, sns_topic_arn):
+    """
+    Returns the put_metric_alarm request for the alarm without creating it.
+    """
     if AlarmDescription:
         AlarmDescription = AlarmDescription.replace("_", " ")
     else:
@@ -625,99 +1144,335 @@ def create_alarm(AlarmName, AlarmDescription, MetricName, ComparisonOperator, Pe
 
     Threshold = float(Threshold)
 
-    logger.info("Creating alarm in region {}, account {}".format(region, account_id))
+    # Define the metrics for the alarm
+    metrics = [{
+        'Id': 'm1',
+        'MetricStat': {
+            'Metric': {
+                'MetricName': MetricName,
+                'Namespace': Namespace,
+                'Dimensions': Dimensions
+            },
+            'Stat': Statistic,
+            'Period': Period
+        },
+    }]
+
+    # Define the alarm
+    alarm = {
+        'AlarmName': AlarmName,
+        'AlarmDescription': AlarmDescription,
+        'EvaluationPeriods': int(EvaluationPeriods),
+        'ComparisonOperator': ComparisonOperator,
+        'Metrics': metrics
+    }
+
+    # Handle anomaly detection comparators
+    if ComparisonOperator in valid_anomaly_detection_comparators:
+        metrics.append(
+            {
+                'Id': 't1',
+                'Label': 't1',
+                'Expression': "ANOMALY_DETECTION_BAND(m1, {})".format(Threshold),
+            }
+        )
+        alarm['ThresholdMetricId'] = 't1'
+    else:
+        alarm['Threshold'] = Threshold
+
+    # Add SNS topic for notifications
+    if sns_topic_arn is not None:
+        alarm['AlarmActions'] = [sns_topic_arn]
+
+    return alarm
+
+
+def build_query_alarm(AlarmName, AlarmDescription, Expression, ComparisonOperator, Period, Threshold,
+                      EvaluationPeriods, sns_topic_arn):
+    """
+    Returns the put_metric_alarm request for an alarm on a Metrics Insights query without creating it.
+    """
+    if AlarmDescription:
+        AlarmDescription = AlarmDescription.replace("_", " ")
+    else:
+        AlarmDescription = 'Created by cloudwatch-auto-alarms'
+
+    alarm = {
+        'AlarmName': AlarmName,
+        'AlarmDescription': AlarmDescription,
+        'EvaluationPeriods': int(EvaluationPeriods),
+        'ComparisonOperator': ComparisonOperator,
+        'Threshold': float(Threshold),
+        'Metrics': [{
+            'Id': 'q1',
+            'Expression': Expression,
+            'Period': convert_to_seconds(Period),
+            'ReturnData': True
+        }]
+    }
+
+    if sns_topic_arn is not None:
+        alarm['AlarmActions'] = [sns_topic_arn]
+
+    return alarm
+
+
+def put_alarm(alarm, region, account_id=None):
+    """
+    Creates or updates the alarm from a put_metric_alarm request.  Returns True if the alarm was written.
+    """
     try:
         # Use cross-account role if account_id is provided
         if account_id:
-            logger.info("Using cross-account role for CloudWatch client.")
+            logger.debug("Using cross-account role for CloudWatch client.")
             assumed_credentials = assume_cross_account_role(account_id, region)
             cw_client = boto3_client('cloudwatch', region, assumed_credentials)
         else:
-            logger.info("Using default credentials for CloudWatch client.")
+            logger.debug("Using default credentials for CloudWatch client.")
             cw_client = boto3_client('cloudwatch', region)
 
-        # Define the metrics for the alarm
-        metrics = [{
-            'Id': 'm1',
-            'MetricStat': {
-                'Metric': {
-                    'MetricName': MetricName,
-                    'Namespace': Namespace,
-                    'Dimensions': Dimensions
-                },
-                'Stat': Statistic,
-                'Period': Period
-            },
-        }]
-
-        # Define the alarm
-        alarm = {
-            'AlarmName': AlarmName,
-            'AlarmDescription': AlarmDescription,
-            'EvaluationPeriods': int(EvaluationPeriods),
-            'ComparisonOperator': ComparisonOperator,
-            'Metrics': metrics
-        }
-
-        # Handle anomaly detection comparators
-        if ComparisonOperator in valid_anomaly_detection_comparators:
-            metrics.append(
-                {
-                    'Id': 't1',
-                    'Label': 't1',
-                    'Expression': "ANOMALY_DETECTION_BAND(m1, {})".format(Threshold),
-                }
-            )
-            alarm['ThresholdMetricId'] = 't1'
-        else:
-            alarm['Threshold'] = Threshold
-
-        # Add SNS topic for notifications
-        if sns_topic_arn is not None:
-            alarm['AlarmActions'] = [sns_topic_arn]
-
         # Create the alarm
         cw_client.put_metric_alarm(**alarm)
-        logger.info('Created alarm {}'.format(AlarmName))
+        if alarm_index:
+            alarm_index.put(account_id, region, alarm['AlarmName'], alarm_namespace(alarm), definition_hash(alarm))
+        structured_log.info('alarm_written', sample=True, alarm_name=alarm['AlarmName'], region=region,
+                            account_id=account_id)
+        api_metrics.increment('AlarmsWritten')
+        return True
 
     except Exception as e:
         # If any other exceptions which we didn't expect are raised
         # then fail and log the exception message.
         logger.error(
-            'Error creating alarm {}!: {}'.format(AlarmName, e))
+            'Error creating alarm {}!: {}'.format(alarm['AlarmName'], e))
+        return False
 
 
-def delete_alarms(name, alarm_identifier, alarm_separator, region, account_id=None):
+def put_alarms(alarms, region, account_id=None):
     """
-    Deletes CloudWatch alarms matching the specified name and alarm identifier.
-    If an account ID is provided, assumes a cross-account role to access the CloudWatch client.
+    Creates or updates the alarms from a list of put_metric_alarm requests concurrently, the number of calls in flight
+    across all resources is bounded by the call executor of alarm_engine.  Returns the number of alarms written.
+    """
+    results = alarm_engine.call_all(put_alarm, [(alarm, region, account_id) for alarm in alarms])
+    return sum(1 for written in results if written)
+
+
+def alarm_definition(alarm):
+    """
+    Returns the settings of an alarm managed by this solution in a form that compares equal between a
+    put_metric_alarm request and the matching describe_alarms result.
+    """
+    metrics = list()
+    for metric in alarm.get('Metrics', list()):
+        metric_stat = metric.get('MetricStat', None)
+        if metric_stat:
+            dimensions = tuple(sorted((dimension['Name'], str(dimension['Value'])) for dimension in
+                                      metric_stat['Metric'].get('Dimensions', list())))
+            metrics.append((metric['Id'], metric_stat['Metric']['Namespace'], metric_stat['Metric']['MetricName'],
+                            dimensions, metric_stat['Stat'], metric_stat['Period']))
+        else:
+            metrics.append((metric['Id'], metric.get('Expression', '')))
+
+    return (
+        alarm.get('AlarmDescription', None),
+        alarm.get('EvaluationPeriods', None),
+        alarm.get('ComparisonOperator', None),
+        alarm.get('Threshold', None),
+        alarm.get('ThresholdMetricId', None),
+        tuple(sorted(alarm.get('AlarmActions', list()))),
+        tuple(sorted(metrics))
+    )
+
+
+def get_existing_alarms(name, alarm_identifier, alarm_separator, region, account_id=None):
+    """
+    Returns the metric alarms created for the named resource keyed by alarm name, paging through describe_alarms.
     """
     try:
         AlarmNamePrefix = alarm_separator.join([alarm_identifier, name]) + alarm_separator
 
         # Use cross-account role if account_id is provided
         if account_id:
-            logger.info("Using cross-account role for CloudWatch client.")
+            logger.debug("Using cross-account role for CloudWatch client.")
             assumed_credentials = assume_cross_account_role(account_id, region)
             cw_client = boto3_client('cloudwatch', region, assumed_credentials)
         else:
-            logger.info("Using default credentials for CloudWatch client.")
+            logger.debug("Using default credentials for CloudWatch client.")
             cw_client = boto3_client('cloudwatch', region)
 
-        logger.debug('Calling describe_alarms with prefix {}'.format(AlarmNamePrefix))
-        response = cw_client.describe_alarms(AlarmNamePrefix=AlarmNamePrefix)
-        alarm_list = []
-        logger.debug('Response from describe_alarms(): {}'.format(response))
+        existing_alarms = dict()
+        paginator = cw_client.get_paginator('describe_alarms')
+        for page in paginator.paginate(AlarmNamePrefix=AlarmNamePrefix, AlarmTypes=['MetricAlarm']):
+            for alarm in page.get('MetricAlarms', list()):
+                existing_alarms[alarm['AlarmName']] = alarm
+        return existing_alarms
 
-        if 'MetricAlarms' in response:
-            for alarm in response['MetricAlarms']:
-                alarm_name = alarm['AlarmName']
-                alarm_list.append(alarm_name)
-        if alarm_list:
-            logger.info('deleting {} for {}'.format(alarm_list, name))
+    except Exception as e:
+        logger.error('Error describing alarms for {}: {}'.format(name, e))
+        raise
+
+
+def definition_hash(alarm):
+    """
+    Returns a hash of the alarm_definition of a put_metric_alarm request or describe_alarms result.
+    """
+    return alarm_hash(alarm_definition(alarm))
+
+
+def refresh_alarm_index(alarm_identifier, alarm_separator, region, account_id=None):
+    """
+    Refreshes the alarm index of the account and region from describe_alarms, paging through all alarms with the
+    alarm identifier prefix.  Refreshes of the same account and region are serialized.
+    """
+    with alarm_index_refresh_locks_lock:
+        lock = alarm_index_refresh_locks.setdefault((account_id, region), threading.Lock())
+    with lock:
+        try:
+            if account_id:
+                assumed_credentials = assume_cross_account_role(account_id, region)
+                cw_client = boto3_client('cloudwatch', region, assumed_credentials)
+            else:
+                cw_client = boto3_client('cloudwatch', region)
+
+            def managed_alarms():
+                paginator = cw_client.get_paginator('describe_alarms')
+                for page in paginator.paginate(AlarmNamePrefix=alarm_identifier + alarm_separator,
+                                               AlarmTypes=['MetricAlarm']):
+                    for alarm in page.get('MetricAlarms', list()):
+                        yield alarm
+
+            result = alarm_index.refresh(account_id, region, managed_alarms(),
+                                         lambda alarm: (alarm_namespace(alarm), definition_hash(alarm)))
+        except Exception as e:
+            logger.error('Error refreshing the alarm index of account {} region {}: {}'.format(account_id, region, e))
+            raise
+        api_metrics.increment('AlarmIndexRefreshes')
+        structured_log.info('alarm_index_refreshed', account_id=account_id, region=region, **result)
+
+
+def get_existing_alarm_hashes(name, alarm_identifier, alarm_separator, region, account_id=None,
+                              use_alarm_index=False):
+    """
+    Returns the definition hashes of the alarms created for the named resource keyed by alarm name.  With
+    use_alarm_index, the caller refreshed the alarm index of the account and region and the hashes are read from it,
+    otherwise they come from describe_alarms.
+    """
+    if use_alarm_index and alarm_index:
+        api_metrics.increment('AlarmIndexLookups')
+        return alarm_index.alarm_hashes(account_id, region, alarm_separator.join([alarm_identifier, name]) +
+                                        alarm_separator)
+    existing_alarms = get_existing_alarms(name, alarm_identifier, alarm_separator, region, account_id)
+    return dict((alarm_name, definition_hash(alarm)) for alarm_name, alarm in existing_alarms.items())
+
+
+def get_alarm_hashes(alarm_names, region, account_id=None):
+    """
+    Returns the definition hashes of those of the named alarms that exist, keyed by alarm name.  The alarms are
+    described in batches of 100 names, the maximum accepted by a single describe_alarms call.
+    """
+    try:
+        if account_id:
+            assumed_credentials = assume_cross_account_role(account_id, region)
+            cw_client = boto3_client('cloudwatch', region, assumed_credentials)
+        else:
+            cw_client = boto3_client('cloudwatch', region)
+
+        alarm_hashes = dict()
+        for index in range(0, len(alarm_names), 100):
+            response = cw_client.describe_alarms(AlarmNames=alarm_names[index:index + 100],
+                                                 AlarmTypes=['MetricAlarm'])
+            for alarm in response.get('MetricAlarms', list()):
+                alarm_hashes[alarm['AlarmName']] = definition_hash(alarm)
+        return alarm_hashes
+
+    except Exception as e:
+        logger.error('Error describing {} alarms in region {}: {}'.format(len(alarm_names), region, e))
+        raise
+
+
+def changed_alarms(alarms, region, account_id=None):
+    """
+    Returns the put_metric_alarm requests of alarms that are missing or whose definition differs from the existing
+    alarm, in order.
+    """
+    existing_hashes = get_alarm_hashes([alarm['AlarmName'] for alarm in alarms], region, account_id)
+    changed = [alarm for alarm in alarms if existing_hashes.get(alarm['AlarmName'], None) != definition_hash(alarm)]
+    api_metrics.increment('ResourceAlarmsUnchanged', len(alarms) - len(changed))
+    return changed
+
+
+def reconcile_alarms(name, desired_alarms, alarm_identifier, alarm_separator, region, account_id=None,
+                     use_alarm_index=False):
+    """
+    Brings the alarms of the named resource in line with desired_alarms, a dict of put_metric_alarm requests keyed
+    by alarm name.  Alarms that are missing or whose definition differs are written, alarms that exist for the
+    resource but are no longer desired are deleted.  Returns the number of alarms written and whether all changed
+    alarms were written.  With use_alarm_index, the existing alarms are read from the alarm index, which the caller
+    refreshed.  The changed alarms are written concurrently.
+    """
+    existing_alarms = get_existing_alarm_hashes(name, alarm_identifier, alarm_separator, region, account_id,
+                                                use_alarm_index)
+
+    changed_alarms = list()
+    for alarm_name, alarm in desired_alarms.items():
+        existing_hash = existing_alarms.pop(alarm_name, None)
+        if existing_hash and existing_hash == definition_hash(alarm):
+            logger.debug('Alarm %s is up to date', alarm_name)
+            continue
+        changed_alarms.append(alarm)
+    alarms_written = put_alarms(changed_alarms, region, account_id)
+
+    if existing_alarms:
+        structured_log.info('stale_alarms', sample=True, resource_id=name, region=region, account_id=account_id,
+                            alarms=len(existing_alarms), alarm_names=lambda: sorted(existing_alarms))
+        delete_alarm_names(list(existing_alarms), region, account_id)
+
+    logger.debug('Reconciled alarms for %s: %s desired, %s written', name, len(desired_alarms), alarms_written)
+    return alarms_written, alarms_written == len(changed_alarms)
+
+
+def delete_alarm_names(alarm_names, region, account_id=None):
+    """
+    Deletes the named alarms in batches of 100, the maximum accepted by a single delete_alarms call.
+    """
+    try:
+        # Use cross-account role if account_id is provided
+        if account_id:
+            logger.debug("Using cross-account role for CloudWatch client.")
+            assumed_credentials = assume_cross_account_role(account_id, region)
+            cw_client = boto3_client('cloudwatch', region, assumed_credentials)
+        else:
+            logger.debug("Using default credentials for CloudWatch client.")
+            cw_client = boto3_client('cloudwatch', region)
+
+        for index in range(0, len(alarm_names), 100):
+            batch = alarm_names[index:index + 100]
+            structured_log.info('alarms_deleted', sample=True, region=region, account_id=account_id,
+                                alarms=len(batch), alarm_names=lambda: batch)
             cw_client.delete_alarms(
-                AlarmNames=alarm_list
+                AlarmNames=batch
             )
+            if alarm_index:
+                alarm_index.remove(account_id, region, batch)
+        return True
+
+    except Exception as e:
+        logger.error('Error deleting {} alarms in region {}: {}'.format(len(alarm_names), region, e))
+        raise
+
+
+def delete_alarms(name, alarm_identifier, alarm_separator, region, account_id=None):
+    """
+    Deletes CloudWatch alarms matching the specified name and alarm identifier, paging through describe_alarms and
+    deleting in batches of 100.  If an account ID is provided, assumes a cross-account role to access the CloudWatch
+    client.  The alarms are always listed from CloudWatch, never from the alarm index, so that no alarm is left
+    behind.
+    """
+    try:
+        alarm_list = list(get_existing_alarms(name, alarm_identifier, alarm_separator, region, account_id))
+        if alarm_list:
+            structured_log.debug('alarms_to_delete', resource_id=name, alarms=len(alarm_list))
+            delete_alarm_names(alarm_list, region, account_id)
         return True
     except Exception as e:
         # If any other exceptions which we didn't expect are raised
@@ -726,82 +1481,604 @@ def delete_alarms(name, alarm_identifier, alarm_separator, region, account_id=No
             'Error deleting alarms for {}!: {}'.format(name, e))
 
 
-def scan_and_process_alarm_tags(create_alarm_tag, default_alarms, metric_dimensions_map, sns_topic_arn, cw_namespace, create_default_alarms_flag, alarm_separator, alarm_identifier, region, account_id=None):
+def alarm_namespace(alarm):
     """
-    Scans EC2 instances and processes alarm tags. If an account ID is provided,
-    assumes a cross-account role to access the EC2 client.
+    Returns the metric namespace of a describe_alarms metric alarm, for metric math and Metrics Insights alarms the
+    namespace of its first metric.
+    """
+    if alarm.get('Namespace', None):
+        return alarm['Namespace']
+    for metric in alarm.get('Metrics', list()):
+        if 'MetricStat' in metric:
+            return metric['MetricStat']['Metric']['Namespace']
+        # Metrics Insights queries select FROM SCHEMA("<namespace>", ...)
+        expression = metric.get('Expression', '')
+        if 'SCHEMA("' in expression:
+            return expression.split('SCHEMA("', 1)[1].split('"', 1)[0]
+    return None
+
+
+def alarm_resource(alarm, alarm_identifier, alarm_separator, cw_namespace):
+    """
+    Returns the (resource type, resource id) an alarm created by this solution belongs to, taken from its name
+    <alarm_identifier>-<resource id>-<namespace>-..., or None if the resource type cannot be determined.  The
+    resource type is 'ec2', 'lambda', 'rds' or, with ASG_ALARMS, 'autoscaling'.
+    """
+    namespace = alarm_namespace(alarm)
+    if not namespace:
+        return None
+    name = alarm['AlarmName'][len(alarm_identifier + alarm_separator):]
+    # resource ids may contain the separator, the namespace that follows the id marks where it ends
+    end = name.find(alarm_separator + namespace + alarm_separator)
+    if end <= 0:
+        return None
+    resource_id = name[:end]
+    if namespace in ['AWS/EC2', cw_namespace] and resource_id.startswith('i-'):
+        return 'ec2', resource_id
+    if namespace in ['AWS/EC2', cw_namespace] and asg_alarms_mode in ['dimension', 'metrics-insights']:
+        return 'autoscaling', resource_id
+    if namespace == 'AWS/Lambda':
+        return 'lambda', resource_id
+    if namespace == 'AWS/RDS':
+        return 'rds', resource_id
+    return None
+
+
+def list_live_resources(resource_type, region, account_id=None):
+    """
+    Returns the set of ids of the resources of the type that exist in the region: EC2 instances that are not
+    terminated, Lambda functions, RDS database instances and clusters, or Auto Scaling groups.  If an account ID is
+    provided, assumes a cross-account role to access the clients.
+    """
+    if account_id:
+        assumed_credentials = assume_cross_account_role(account_id, region)
+        client = boto3_client(resource_type, region, assumed_credentials)
+    else:
+        client = boto3_client(resource_type, region)
+
+    resource_ids = set()
+    if resource_type == 'ec2':
+        paginator = client.get_paginator('describe_instances')
+        for page in paginator.paginate(
+                Filters=[
+                    {
+                        'Name': 'instance-state-name',
+                        'Values': ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+                    }
+                ],
+                PaginationConfig={'PageSize': describe_instances_page_size}
+        ):
+            for reservation in page['Reservations']:
+                resource_ids.update(instance['InstanceId'] for instance in reservation['Instances'])
+    elif resource_type == 'autoscaling':
+        for page in client.get_paginator('describe_auto_scaling_groups').paginate():
+            resource_ids.update(group['AutoScalingGroupName'] for group in page['AutoScalingGroups'])
+    elif resource_type == 'lambda':
+        for page in client.get_paginator('list_functions').paginate():
+            resource_ids.update(function['FunctionName'] for function in page['Functions'])
+    else:
+        for page in client.get_paginator('describe_db_instances').paginate():
+            resource_ids.update(db_instance['DBInstanceIdentifier'] for db_instance in page['DBInstances'])
+        for page in client.get_paginator('describe_db_clusters').paginate():
+            resource_ids.update(db_cluster['DBClusterIdentifier'] for db_cluster in page['DBClusters'])
+    return resource_ids
+
+
+def collect_orphaned_alarms(alarm_identifier, alarm_separator, cw_namespace, region, account_id=None, dry_run=False):
+    """
+    Deletes the alarms created by this solution whose EC2 instance, Lambda function or RDS resource no longer exists,
+    in one pass over the alarms of the region.  Only the resource types that have alarms are listed, alarms whose
+    resource type cannot be determined or whose resources cannot be listed are kept.  With dry_run, orphaned alarms
+    are only reported.  With ALARM_INDEX set, the pass refreshes the alarm index and reads the alarms from it.
+    Returns a summary of the sweep.
     """
+    try:
+        alarms_by_resource = dict()
+        alarms = 0
+        if alarm_index:
+            refresh_alarm_index(alarm_identifier, alarm_separator, region, account_id)
+            pages = [{'MetricAlarms': alarm_index.alarms(account_id, region)}]
+        else:
+            # Use cross-account role if account_id is provided
+            if account_id:
+                assumed_credentials = assume_cross_account_role(account_id, region)
+                cw_client = boto3_client('cloudwatch', region, assumed_credentials)
+            else:
+                cw_client = boto3_client('cloudwatch', region)
+            paginator = cw_client.get_paginator('describe_alarms')
+            pages = paginator.paginate(AlarmNamePrefix=alarm_identifier + alarm_separator, AlarmTypes=['MetricAlarm'])
+        for page in pages:
+            for alarm in page.get('MetricAlarms', list()):
+                alarms += 1
+                resource = alarm_resource(alarm, alarm_identifier, alarm_separator, cw_namespace)
+                if resource:
+                    alarms_by_resource.setdefault(resource, list()).append(alarm['AlarmName'])
+    except Exception as e:
+        logger.error('Error describing alarms in account {} region {}: {}'.format(account_id, region, e))
+        raise
+
+    orphaned_alarm_names = list()
+    unverified = 0
+    for resource_type in sorted(set(resource_type for resource_type, _ in alarms_by_resource)):
+        try:
+            live_resource_ids = list_live_resources(resource_type, region, account_id)
+        except Exception as e:
+            logger.error('Error listing {} resources in account {} region {}, keeping their alarms: {}'.format(
+                resource_type, account_id, region, e))
+            unverified += sum(len(alarm_names) for (alarm_resource_type, _), alarm_names in alarms_by_resource.items()
+                              if alarm_resource_type == resource_type)
+            continue
+        for (alarm_resource_type, resource_id), alarm_names in alarms_by_resource.items():
+            if alarm_resource_type == resource_type and resource_id not in live_resource_ids:
+                structured_log.info('orphaned_alarms', sample=True, resource_type=resource_type,
+                                    resource_id=resource_id, region=region, account_id=account_id,
+                                    alarms=len(alarm_names))
+                orphaned_alarm_names.extend(alarm_names)
+
+    if orphaned_alarm_names and not dry_run:
+        delete_alarm_names(orphaned_alarm_names, region, account_id)
+    return {
+        'alarms': alarms,
+        'alarms_orphaned': len(orphaned_alarm_names),
+        'alarms_deleted': 0 if dry_run else len(orphaned_alarm_names),
+        'alarms_unverified': unverified
+    }
+
+
+def map_scan_units(scan_units, unit_function, max_workers, totals, activity):
+    """
+    Runs unit_function(account_id, region) for each (organizational_unit_id, account_id, region) unit on a bounded
+    pool of worker threads and returns a summary with the sums of the numbers named in totals of the summaries it
+    returns.  A failing unit is logged as a failure of the activity and recorded in the summary without stopping the
+    remaining units.
+    """
+    summary = {'units': len(scan_units), 'units_processed': 0, 'units_failed': 0}
+    summary.update((name, 0) for name in totals)
+    summary['failures'] = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict()
+        for organizational_unit_id, account_id, region in scan_units:
+            futures[executor.submit(unit_function, account_id, region)] = (account_id, region)
+
+        for future in as_completed(futures):
+            account_id, region = futures[future]
+            try:
+                unit_summary = future.result()
+            except Exception as e:
+                logger.error('Failure {} in account {} region {}: {}'.format(activity, account_id, region, e))
+                summary['units_failed'] += 1
+                summary['failures'].append({'AccountId': account_id, 'Region': region, 'Error': str(e)})
+                continue
+            summary['units_processed'] += 1
+            for name in totals:
+                summary[name] += unit_summary[name]
+    return summary
+
+
+def collect_orphaned_alarms_in_accounts_and_regions(scan_units, alarm_identifier, alarm_separator, cw_namespace,
+                                                    max_workers, dry_run=False):
+    """
+    Runs collect_orphaned_alarms for each (organizational_unit_id, account_id, region) unit on a bounded pool of
+    worker threads.  A failing unit is logged and recorded in the summary without stopping the remaining units.
+    """
+    summary = map_scan_units(scan_units, lambda account_id, region: collect_orphaned_alarms(
+        alarm_identifier, alarm_separator, cw_namespace, region, account_id, dry_run), max_workers,
+                             ['alarms', 'alarms_orphaned', 'alarms_deleted', 'alarms_unverified'],
+                             'collecting orphaned alarms')
+    summary['dry_run'] = dry_run
+    structured_log.info('orphaned_alarm_sweep', **summary)
+    return summary
+
+
+def alarm_manifest_key(account_id, region):
+    return 'alarm-manifest-{}-{}.ndjson'.format(account_id or 'local', region)
+
+
+def alarm_plan_key(account_id, region):
+    return 'alarm-plan-{}-{}.ndjson'.format(account_id or 'local', region)
+
+
+def plan_alarms(create_alarm_tag, default_alarms, wildcard_alarms, metric_dimensions_map, sns_topic_arn, cw_namespace,
+                create_default_alarms_flag, alarm_separator, alarm_identifier, region, store, account_id=None,
+                apply=False):
+    """
+    Plans the alarms of the tagged, running instances of the account and region without writing any alarm, and
+    compares the plan with the manifest of the alarms last applied, kept in store, in one linear pass.  Without
+    apply the plan is saved to store as an NDJSON manifest for inspection.  With apply only the difference is
+    written: new and changed alarms are put, alarms no longer planned are deleted and the plan becomes the applied
+    manifest.  Alarms that fail to be written are left out of the manifest so the next apply retries them.  If an
+    account ID is provided, assumes a cross-account role to access the clients.  Returns a summary.
+    The plan is buffered rather than streamed: describe_instances does not return instances in ResourceId order, so
+    the entries of all resources, alarm names and hashes, are held and sorted before the diff, as is the previous
+    manifest.  With apply, only the definitions of the alarms that are new or changed are kept until they are written.
+    """
+    if account_id:
+        assumed_credentials = assume_cross_account_role(account_id, region)
+        ec2_client = boto3_client('ec2', region, assumed_credentials)
+    else:
+        ec2_client = boto3_client('ec2', region)
+
+    previous_entries = list(read_manifest(store.load_lines(alarm_manifest_key(account_id, region))))
+    previous_hashes = dict((entry['ResourceId'], dict(entry['Alarms'])) for entry in previous_entries) if apply else \
+        dict()
+    entries = list()
+    planned_alarms = dict()
+
+    def add_entry(resource_id, desired_alarms):
+        entry = plan_entry(resource_id, desired_alarms)
+        entries.append(entry)
+        if apply:
+            hashes = previous_hashes.get(resource_id, dict())
+            changed_alarms = dict((alarm_name, desired_alarms[alarm_name]) for alarm_name, definition_hash in
+                                  entry['Alarms'] if hashes.get(alarm_name, None) != definition_hash)
+            if changed_alarms:
+                planned_alarms[resource_id] = changed_alarms
+
+    asg_alarms = dict()
+    instances_planned = 0
+    for instances, _ in get_tagged_instance_pages(ec2_client, create_alarm_tag):
+        determine_platforms(instances, region, account_id)
+        for instance in instances:
+            instances_planned += 1
+            if uses_asg_alarms(instance):
+                # one entry per Auto Scaling group with the alarms of all of its instances
+                asg_name = instance_asg(instance)
+                asg_alarms.setdefault(asg_name, dict()).update(determine_asg_desired_alarms(
+                    asg_name, instance, default_alarms, wildcard_alarms, metric_dimensions_map, sns_topic_arn,
+                    cw_namespace, create_default_alarms_flag, alarm_separator, alarm_identifier, region, account_id))
+                continue
+            desired_alarms = determine_desired_alarms(instance['InstanceId'], instance, default_alarms,
+                                                      wildcard_alarms, metric_dimensions_map, sns_topic_arn,
+                                                      cw_namespace, create_default_alarms_flag, alarm_separator,
+                                                      alarm_identifier, region, account_id)
+            add_entry(instance['InstanceId'], desired_alarms)
+    for asg_name, desired_alarms in asg_alarms.items():
+        add_entry(asg_name, desired_alarms)
+    api_metrics.increment('InstancesPlanned', instances_planned)
+    entries.sort(key=lambda entry: entry['ResourceId'])
+
+    delta = list(diff_manifests(previous_entries, entries))
+    summary = {
+        'resources': len(entries),
+        'alarms_planned': sum(len(entry['Alarms']) for entry in entries),
+        'resources_changed': len(delta),
+        'alarms_to_put': sum(len(put) for _, put, _ in delta),
+        'alarms_to_delete': sum(len(delete) for _, _, delete in delta),
+        'alarms_written': 0,
+        'alarms_deleted': 0
+    }
+    if not apply:
+        store.save_lines(alarm_plan_key(account_id, region), manifest_lines(entries))
+        return summary
+
+    puts = [(resource_id, planned_alarms[resource_id][alarm_name]) for resource_id, put, _ in delta for alarm_name
+            in put]
+    results = alarm_engine.call_all(put_alarm, [(alarm, region, account_id) for _, alarm in puts])
+    failed_alarms = set((resource_id, alarm['AlarmName']) for (resource_id, alarm), written in zip(puts, results) if
+                        not written)
+    summary['alarms_written'] = len(puts) - len(failed_alarms)
+    deletes = [alarm_name for _, _, delete in delta for alarm_name in delete]
+    if deletes:
+        delete_alarm_names(deletes, region, account_id)
+        summary['alarms_deleted'] = len(deletes)
+    if failed_alarms:
+        for entry in entries:
+            entry['Alarms'] = [alarm for alarm in entry['Alarms'] if (entry['ResourceId'], alarm[0]) not in
+                               failed_alarms]
+    store.save_lines(alarm_manifest_key(account_id, region), manifest_lines(entries))
+    structured_log.info('alarm_plan_applied', account_id=account_id, region=region, **summary)
+    return summary
+
+
+def plan_accounts_and_regions(scan_units, create_alarm_tag, default_alarms, wildcard_alarms, metric_dimensions_map,
+                              sns_topic_arn, cw_namespace, create_default_alarms_flag, alarm_separator,
+                              alarm_identifier, store, max_workers, apply=False):
+    """
+    Runs plan_alarms for each (organizational_unit_id, account_id, region) unit on a bounded pool of worker threads.
+    A failing unit is logged and recorded in the summary without stopping the remaining units.
+    """
+    summary = map_scan_units(scan_units, lambda account_id, region: plan_alarms(
+        create_alarm_tag, default_alarms, wildcard_alarms, metric_dimensions_map, sns_topic_arn, cw_namespace,
+        create_default_alarms_flag, alarm_separator, alarm_identifier, region, store, account_id, apply), max_workers,
+                             ['resources', 'alarms_planned', 'resources_changed', 'alarms_to_put', 'alarms_to_delete',
+                              'alarms_written', 'alarms_deleted'], 'planning alarms')
+    summary['applied'] = apply
+    structured_log.info('alarm_plan', **summary)
+    return summary
+
+
+def scan_and_process_alarm_tags(create_alarm_tag, default_alarms, wildcard_alarms, metric_dimensions_map, sns_topic_arn, cw_namespace, create_default_alarms_flag, alarm_separator, alarm_identifier, region, account_id=None, reconcile_alarms_flag='false', organizational_unit_id=None, checkpoint=None, deadline=None):
+    """
+    Scans EC2 instances, Lambda functions and RDS databases and processes alarm tags. If an account ID is provided,
+    assumes a cross-account role to access the clients.  default_alarms and wildcard_alarms are the results of
+    separate_wildcard_alarms.  Returns the number of alarms written.
+    With a checkpoint, the scan resumes from the cursor of the unit and records its progress per instance.  Raises
+    ScanInterrupted when the deadline is reached before all instances are processed.
+    """
+    if deadline and deadline.reached():
+        raise ScanInterrupted()
     try:
         # Use cross-account role if account_id is provided
         if account_id:
-            logger.info("Using cross-account role for EC2 client.")
+            logger.debug("Using cross-account role for EC2 client.")
             assumed_credentials = assume_cross_account_role(account_id, region)
             ec2_client = boto3_client('ec2', region, assumed_credentials)
         else:
-            logger.info("Using default credentials for EC2 client.")
+            logger.debug("Using default credentials for EC2 client.")
             ec2_client = boto3_client('ec2', region)
 
-        # Separate wildcard alarms and default alarms
-        default_filtered_alarms, wildcard_alarms = separate_wildcard_alarms(alarm_separator, cw_namespace,
-                                                                            default_alarms)
-
-        # Process instances
-        for reservation in ec2_client.describe_instances()["Reservations"]:
-            for instance in reservation["Instances"]:
-                # Process only running instances
-                if instance["State"]["Code"] > 16:
+        # Process running instances tagged for alarming, the describe_instances results are reused for the instance
+        # details so no further describe calls are needed per instance
+        alarms_written = 0
+        cursor = checkpoint.cursor(account_id, region) if checkpoint else None
+        page_token = cursor['NextToken'] if cursor else None
+        processed_instance_ids = set(cursor['ProcessedInstanceIds']) if cursor else set()
+        if cursor:
+            structured_log.info('scan_unit_resumed', account_id=account_id, region=region,
+                                processed_instances=len(processed_instance_ids))
+        instance_pages = get_tagged_instance_pages(ec2_client, create_alarm_tag, page_token) if \
+            'ec2' in scan_resource_types else []
+        # the index is refreshed once per unit and scan, one pass over the alarms of the unit instead of one
+        # describe_alarms call per instance
+        use_alarm_index = bool(alarm_index) and reconcile_alarms_flag == 'true' and 'ec2' in scan_resource_types
+        if use_alarm_index:
+            refresh_alarm_index(alarm_identifier, alarm_separator, region, account_id)
+        for instances, next_token in instance_pages:
+            if checkpoint:
+                checkpoint.start_page(organizational_unit_id, account_id, region, page_token)
+            # resolve the platforms of all AMIs on the page in batches, process_alarm_tags then hits the cache
+            determine_platforms(instances, region, account_id)
+            for instance in instances:
+                if instance["InstanceId"] in processed_instance_ids:
                     continue
-
-                if check_alarm_tag(instance["InstanceId"], create_alarm_tag, region, account_id):
-                    process_alarm_tags(instance["InstanceId"], instance, default_filtered_alarms, wildcard_alarms,
-                                       metric_dimensions_map, sns_topic_arn, cw_namespace, create_default_alarms_flag,
-                                       alarm_separator, alarm_identifier, region, account_id)
-
+                if deadline and deadline.reached():
+                    raise ScanInterrupted(alarms_written)
+                fingerprint = alarm_fingerprint(instance, default_alarms, wildcard_alarms, metric_dimensions_map,
+                                                sns_topic_arn, cw_namespace, create_default_alarms_flag,
+                                                alarm_separator, alarm_identifier)
+                if skip_unchanged_resources_flag == 'true' and is_fingerprint_current(instance, create_alarm_tag,
+                                                                                      fingerprint):
+                    api_metrics.increment('InstancesUnchanged')
+                else:
+                    with concurrency_controller.slot():
+                        instance_alarms_written, complete = process_alarm_tags(
+                            instance["InstanceId"], instance, default_alarms, wildcard_alarms, metric_dimensions_map,
+                            sns_topic_arn, cw_namespace, create_default_alarms_flag, alarm_separator,
+                            alarm_identifier, region, account_id, reconcile_alarms_flag, use_alarm_index)
+                        alarms_written += instance_alarms_written
+                        # only tagged when every alarm was written, an instance with alarms that failed is processed
+                        # again by the next scan.  The alarms of Auto Scaling group members are tracked per group,
+                        # their tags are left alone
+                        if not complete:
+                            api_metrics.increment('InstancesIncomplete')
+                        elif not uses_asg_alarms(instance):
+                            update_alarm_tag(ec2_client, instance["InstanceId"], create_alarm_tag,
+                                             fingerprint_tag_value(fingerprint))
+                if checkpoint:
+                    checkpoint.instance_processed(account_id, region, instance["InstanceId"])
+            processed_instance_ids = set()
+            page_token = next_token
+            if checkpoint and page_token:
+                checkpoint.start_page(organizational_unit_id, account_id, region, page_token)
+                checkpoint.save()
+
+        # Lambda functions and RDS databases follow the instances, a resumed unit discovers them again from the
+        # start.  They have no fingerprint tag, the alarms of each page are described instead and only the alarms
+        # that are missing or changed are written
+        for alarms in get_tagged_resource_alarm_pages(create_alarm_tag, default_alarms, sns_topic_arn,
+                                                      alarm_separator, alarm_identifier, region, account_id):
+            if deadline and deadline.reached():
+                raise ScanInterrupted(alarms_written)
+            with concurrency_controller.slot():
+                if skip_unchanged_resources_flag == 'true':
+                    alarms = changed_alarms(alarms, region, account_id)
+                alarms_written += put_alarms(alarms, region, account_id)
+        return alarms_written
+
+    except ScanInterrupted:
+        raise
     except Exception as e:
         logger.error('Failure describing reservations: {}'.format(e))
         raise
 
 
 def separate_wildcard_alarms(alarm_separator, cw_namespace, default_alarms):
+    """
+    Splits the platform alarms for cw_namespace into fixed and wildcard alarms.  default_alarms is left unchanged, a
+    copy without the wildcard alarms is returned so the function can be called repeatedly and from several threads.
+    """
+    filtered_alarms = dict(default_alarms)
+    filtered_alarms[cw_namespace] = dict()
     wildcard_alarms = dict()
     wildcard_alarms[cw_namespace] = dict()
     for platform in default_alarms[cw_namespace]:
-        wildcard_alarms[cw_namespace][platform] = list()
-        logger.info("default alarms for {} are {}".format(platform, default_alarms[cw_namespace][platform]))
+        logger.debug("default alarms for %s are %s", platform, default_alarms[cw_namespace][platform])
         wildcard_alarms[cw_namespace][platform] = [alarm for alarm in default_alarms[cw_namespace][platform] if
-                                                   '*' in alarm['Key'].split(alarm_separator)]
-        default_alarms[cw_namespace][platform] = [alarm for alarm in default_alarms[cw_namespace][platform] if
-                                                  '*' not in alarm['Key'].split(alarm_separator)]
-    logger.info("updated default alarms are {}".format(default_alarms[cw_namespace]))
-    logger.info("updated wildcard alarms are {}".format(wildcard_alarms[cw_namespace]))
-    return default_alarms, wildcard_alarms
+                                                   parse_alarm_spec(alarm['Key'], alarm_separator).has_wildcards]
+        filtered_alarms[cw_namespace][platform] = [alarm for alarm in default_alarms[cw_namespace][platform] if
+                                                   not parse_alarm_spec(alarm['Key'], alarm_separator).has_wildcards]
+    logger.debug("updated default alarms are %s", filtered_alarms[cw_namespace])
+    logger.debug("updated wildcard alarms are %s", wildcard_alarms[cw_namespace])
+    structured_log.info('alarm_catalog', namespace=cw_namespace,
+                        fixed_alarms=lambda: dict((platform, len(alarms)) for platform, alarms in
+                                                  filtered_alarms[cw_namespace].items()),
+                        wildcard_alarms=lambda: dict((platform, len(alarms)) for platform, alarms in
+                                                     wildcard_alarms[cw_namespace].items()))
+    return filtered_alarms, wildcard_alarms
+
+
+def scan_accounts_and_regions(scan_units, create_alarm_tag, default_alarms, wildcard_alarms, metric_dimensions_map,
+                              sns_topic_arn, cw_namespace, create_default_alarms_flag, alarm_separator,
+                              alarm_identifier, max_workers, reconcile_alarms_flag='false', checkpoint=None,
+                              deadline=None):
+    """
+    Runs scan_and_process_alarm_tags for each (organizational_unit_id, account_id, region) unit on a bounded pool of
+    worker threads.  A failing unit is logged and recorded in the summary without stopping the remaining units.  An
+    account_id of None scans the local account.  The number of workers processing instances at the same time adapts
+    to throttling between 1 and max_workers.
+    With a checkpoint, units it records as complete are skipped and the progress of the others is saved to it.  Units
+    still in progress when the deadline is reached are counted as interrupted, units that failed are left pending so
+    that a continuation of the scan retries them.
+    """
+    concurrency_controller.reset(max_workers)
+    rate_limit_waited = rate_limiter.waited
+    summary = {
+        'units': len(scan_units),
+        'units_processed': 0,
+        'units_failed': 0,
+        'units_skipped': 0,
+        'units_interrupted': 0,
+        'alarms_written': 0,
+        'failures': []
+    }
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict()
+        for organizational_unit_id, account_id, region in scan_units:
+            if checkpoint and checkpoint.is_complete(account_id, region):
+                summary['units_skipped'] += 1
+                continue
+            future = executor.submit(scan_and_process_alarm_tags, create_alarm_tag, default_alarms, wildcard_alarms,
+                                     metric_dimensions_map, sns_topic_arn, cw_namespace, create_default_alarms_flag,
+                                     alarm_separator, alarm_identifier, region, account_id, reconcile_alarms_flag,
+                                     organizational_unit_id, checkpoint, deadline)
+            futures[future] = (account_id, region)
+
+        for future in as_completed(futures):
+            account_id, region = futures[future]
+            try:
+                summary['alarms_written'] += future.result()
+                summary['units_processed'] += 1
+            except ScanInterrupted as e:
+                summary['alarms_written'] += e.alarms_written
+                summary['units_interrupted'] += 1
+                continue
+            except Exception as e:
+                logger.error('Failure scanning account {} in region {}: {}'.format(account_id, region, e))
+                failure = {'AccountId': account_id, 'Region': region, 'Error': str(e)}
+                summary['units_failed'] += 1
+                summary['failures'].append(failure)
+                if checkpoint:
+                    checkpoint.fail_unit(account_id, region, failure)
+                    checkpoint.save()
+                continue
+            if checkpoint:
+                checkpoint.complete_unit(account_id, region)
+                checkpoint.save()
+
+    summary['concurrency'] = concurrency_controller.stats()
+    summary['rate_limit_wait_seconds'] = round(rate_limiter.waited - rate_limit_waited, 1)
+    structured_log.info('scan', status='interrupted' if summary['units_interrupted'] else 'complete', **summary)
+    return summary
+
+
+def get_scan_state_store(url):
+    """
+    Returns the scan state store for a s3://bucket/prefix/ or file:///directory URL.
+    """
+    parsed_url = urlparse(url)
+    if parsed_url.scheme == 's3':
+        return S3StateStore(boto3_client('s3', getenv("AWS_REGION", None)), parsed_url.netloc,
+                            parsed_url.path.lstrip('/'))
+    return LocalFileStateStore(parsed_url.path or url)
 
 
-def process_wildcard_alarm(alarm_object):
-    print("alarm object is {}".format(alarm_object))
-    alarm_object['Key'] = "updated"
-    return alarm_object
+def get_work_queue(url):
+    """
+    Returns the work queue for an SQS queue URL, or the in-memory queue of the container for 'local'.  The queue is
+    in the region of the function, the host of its URL varies with legacy and VPC endpoint URLs.
+    """
+    if url == 'local':
+        return local_work_queue
+    return SqsWorkQueue(boto3_client('sqs', getenv("AWS_REGION", None)), url)
+
+
+def invoke_scan_continuation(function_arn, scan_id):
+    """
+    Invokes the function asynchronously to continue the scan.
+    """
+    region = function_arn.split(':')[3]
+    lambda_client = boto3_client('lambda', region)
+    lambda_client.invoke(
+        FunctionName=function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'action': 'scan', 'scan_id': scan_id}).encode('utf-8')
+    )
+    structured_log.info('scan_continuation', function_arn=function_arn, scan_id=scan_id)
+
+
+def list_organizational_unit(client, ou_id):
+    """
+    Returns the active accounts directly under the organizational unit and the ids of its child organizational units.
+    """
+    accounts = []
+    for page in client.get_paginator('list_accounts_for_parent').paginate(ParentId=ou_id):
+        for account in page['Accounts']:
+            if account['Status'] == 'ACTIVE':
+                accounts.append({
+                    'AccountId': account['Id'],
+                    'AccountName': account['Name'],
+                    'Email': account['Email'],
+                    'Status': account['Status']
+                })
+    child_ou_ids = []
+    for page in client.get_paginator('list_children').paginate(ParentId=ou_id, ChildType='ORGANIZATIONAL_UNIT'):
+        child_ou_ids.extend(child['Id'] for child in page['Children'])
+    return accounts, child_ou_ids
 
 
 def get_active_accounts_by_organizational_unit(ou_ids, management_account):
+    """
+    Returns the active accounts of each organizational unit including the accounts of all OUs nested below it, as
+    {ou_id: [account, ...]}.  The tree is walked level by level and the OUs of a level are listed concurrently.  Every
+    account is returned once, under the nearest of ou_ids above it: an OU of ou_ids nested below another one is walked
+    as its own root.
+    """
     region = "us-east-1"
-    logger.info("Assuming role in organizations management account: {}".format(management_account))
+    logger.debug('Assuming role in organizations management account: %s', management_account)
     assumed_credentials = assume_management_account_role(management_account, region)
     client = boto3_client('organizations', region, assumed_credentials)
-    accounts_by_ou = {}
-    for ou_id in ou_ids:
-        ou_id = ou_id.strip()
-        paginator = client.get_paginator('list_accounts_for_parent')
-        accounts = []
-        for page in paginator.paginate(ParentId=ou_id):
-            for account in page['Accounts']:
-                if account['Status'] == 'ACTIVE':
-                    accounts.append({
-                        'AccountId': account['Id'],
-                        'AccountName': account['Name'],
-                        'Email': account['Email'],
-                        'Status': account['Status']
-                    })
-        accounts_by_ou[ou_id] = accounts
-
+    root_ou_ids = list(dict.fromkeys(ou_id.strip() for ou_id in ou_ids if ou_id.strip()))
+    accounts_by_ou = {ou_id: [] for ou_id in root_ou_ids}
+    account_ids = set()
+    visited_ou_ids = set(root_ou_ids)
+    level = [(ou_id, ou_id) for ou_id in root_ou_ids]
+    with ThreadPoolExecutor(max_workers=organizations_concurrency) as executor:
+        while level:
+            results = executor.map(lambda unit: list_organizational_unit(client, unit[1]), level)
+            next_level = []
+            for (root_ou_id, ou_id), (accounts, child_ou_ids) in zip(level, results):
+                for account in accounts:
+                    if account['AccountId'] not in account_ids:
+                        account_ids.add(account['AccountId'])
+                        accounts_by_ou[root_ou_id].append(account)
+                for child_ou_id in child_ou_ids:
+                    if child_ou_id not in visited_ou_ids:
+                        visited_ou_ids.add(child_ou_id)
+                        next_level.append((root_ou_id, child_ou_id))
+            level = next_level
+
+    structured_log.info('organization_accounts', accounts=len(account_ids),
+                        organizational_units=len(visited_ou_ids), root_organizational_units=root_ou_ids)
     return accounts_by_ou
+
+
+def get_account_inventory(ou_ids, management_account):
+    """
+    Returns the result of get_active_accounts_by_organizational_unit from the account inventory cache, walking the
+    organization on a miss, together with whether it was a cache hit and the age of the inventory in seconds.
+    """
+    walked = []
+
+    def load_inventory():
+        walked.append(True)
+        loaded_at = time.time()
+        return (get_active_accounts_by_organizational_unit(ou_ids, management_account), loaded_at), \
+            loaded_at + account_inventory_ttl
+
+    accounts_by_ou, loaded_at = account_inventory_cache.get_or_load((management_account, tuple(ou_ids)),
+                                                                    load_inventory)
+    cache_hit = not walked
+    age = round(time.time() - loaded_at)
+    api_metrics.increment('AccountInventoryCacheHits' if cache_hit else 'AccountInventoryCacheMisses')
+    structured_log.info('account_inventory', cache_hit=cache_hit, age=age)
+    return accounts_by_ou, cache_hit, age
@@ -0,0 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+
+# The alarm writes of a resource are issued concurrently on a pool of threads shared by every scan and event worker
+# thread of the container.  Its size bounds the number of calls in flight across all resources, keep it at or below
+# CLIENT_MAX_POOL_CONNECTIONS so that every call gets a pooled connection.
+alarm_write_concurrency = int(getenv("ALARM_WRITE_CONCURRENCY", "10"))
+call_executor = ThreadPoolExecutor(max_workers=alarm_write_concurrency, thread_name_prefix='alarm-engine')
+
+
+def call_all(function, argument_lists):
+    """
+    Runs the blocking AWS call once for every tuple of arguments in argument_lists on the shared call executor and
+    returns the results in the same order.  Must not be called from a call executor thread, which would wait for a
+    slot of its own pool.
+    """
+    futures = [call_executor.submit(function, *arguments) for arguments in argument_lists]
+    return [future.result() for future in futures]
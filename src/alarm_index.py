@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+
+schema = [
+    'CREATE TABLE IF NOT EXISTS alarms (account TEXT NOT NULL, region TEXT NOT NULL, alarm_name TEXT NOT NULL, '
+    'namespace TEXT, definition_hash TEXT, updated_at TEXT, PRIMARY KEY (account, region, alarm_name))',
+    'CREATE TABLE IF NOT EXISTS refreshes (account TEXT NOT NULL, region TEXT NOT NULL, refreshed_at REAL NOT NULL, '
+    'watermark TEXT, PRIMARY KEY (account, region))'
+]
+
+
+def index_account(account_id):
+    return account_id or 'local'
+
+
+def configuration_timestamp(alarm):
+    """
+    Returns the AlarmConfigurationUpdatedTimestamp of a describe_alarms result as an ISO 8601 string, or None.
+    """
+    updated_at = alarm.get('AlarmConfigurationUpdatedTimestamp', None)
+    if updated_at is None:
+        return None
+    return updated_at.isoformat() if hasattr(updated_at, 'isoformat') else str(updated_at)
+
+
+class AlarmIndex:
+    """
+    SQLite index of the alarms managed by the solution, one row per (account, region, alarm name) with the namespace
+    and definition hash of the alarm.  Alarm names start with <alarm identifier>-<resource id>-, the alarms of a
+    resource are found with a range scan of the primary key on that prefix.  Each (account, region) is refreshed in
+    bulk from describe_alarms.  CloudWatch cannot list only the alarms changed since a point in time, so every refresh
+    reads all alarms; the watermark of a refresh, the latest configuration update it saw, only saves the next refresh
+    from hashing again the alarms that did not change.  Thread-safe, one connection is shared by all threads.
+    """
+
+    def __init__(self, path):
+        # imported here so that the function only loads sqlite3 when ALARM_INDEX is set
+        import sqlite3
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            # the index can always be rebuilt from describe_alarms, commits need not wait for the disk
+            self._connection.execute('PRAGMA synchronous=OFF')
+            for statement in schema:
+                self._connection.execute(statement)
+
+    def refresh(self, account_id, region, alarms, entry):
+        """
+        Brings the index of the account and region in line with alarms, an iterable of all describe_alarms results
+        of managed alarms, which is always consumed in full.  entry(alarm) returns the (namespace, definition hash)
+        of an alarm and is only called for alarms that are new to the index or whose configuration changed since the
+        watermark of the last refresh.  Alarms missing from alarms are removed.  Returns the number of alarms seen,
+        updated and removed.
+        """
+        account = index_account(account_id)
+        with self._lock:
+            row = self._connection.execute('SELECT watermark FROM refreshes WHERE account = ? AND region = ?',
+                                           (account, region)).fetchone()
+            known = set(name for name, in self._connection.execute(
+                'SELECT alarm_name FROM alarms WHERE account = ? AND region = ?', (account, region)))
+        watermark = row[0] if row else None
+
+        seen = set()
+        rows = list()
+        latest = watermark
+        for alarm in alarms:
+            alarm_name = alarm['AlarmName']
+            seen.add(alarm_name)
+            updated_at = configuration_timestamp(alarm)
+            if updated_at and (latest is None or updated_at > latest):
+                latest = updated_at
+            if alarm_name in known and watermark and updated_at and updated_at < watermark:
+                continue
+            namespace, definition_hash = entry(alarm)
+            rows.append((account, region, alarm_name, namespace, definition_hash, updated_at))
+        removed = known - seen
+
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO alarms VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._connection.executemany('DELETE FROM alarms WHERE account = ? AND region = ? AND alarm_name = ?',
+                                         [(account, region, alarm_name) for alarm_name in removed])
+            self._connection.execute('INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?, ?)',
+                                     (account, region, time.time(), latest))
+        return {'alarms': len(seen), 'updated': len(rows), 'removed': len(removed)}
+
+    def put(self, account_id, region, alarm_name, namespace, definition_hash):
+        """
+        Records an alarm that was written.
+        """
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO alarms VALUES (?, ?, ?, ?, ?, NULL)',
+                                     (index_account(account_id), region, alarm_name, namespace, definition_hash))
+
+    def remove(self, account_id, region, alarm_names):
+        """
+        Forgets alarms that were deleted.
+        """
+        account = index_account(account_id)
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM alarms WHERE account = ? AND region = ? AND alarm_name = ?',
+                                         [(account, region, alarm_name) for alarm_name in alarm_names])
+
+    def alarm_hashes(self, account_id, region, prefix):
+        """
+        Returns the definition hashes of the alarms whose name starts with prefix, keyed by alarm name.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT alarm_name, definition_hash FROM alarms WHERE account = ? AND region = ? AND alarm_name >= ? '
+                'AND alarm_name < ?', (index_account(account_id), region, prefix, prefix + '\U0010ffff')).fetchall()
+        return dict((alarm_name, definition_hash) for alarm_name, definition_hash in rows
+                    if alarm_name.startswith(prefix))
+
+    def alarms(self, account_id, region):
+        """
+        Returns the indexed alarms of the account and region as [{'AlarmName': <name>, 'Namespace': <namespace>}].
+        """
+        with self._lock:
+            rows = self._connection.execute('SELECT alarm_name, namespace FROM alarms WHERE account = ? AND region = ?',
+                                            (index_account(account_id), region)).fetchall()
+        return [{'AlarmName': alarm_name, 'Namespace': namespace} for alarm_name, namespace in rows]
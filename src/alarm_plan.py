@@ -0,0 +1,73 @@
+import hashlib
+import json
+
+# length of the hex digest kept for alarm definition hashes, 64 bits is plenty to detect a changed definition
+alarm_hash_length = 16
+
+
+def alarm_hash(alarm):
+    """
+    Returns a hash of a put_metric_alarm request that changes whenever any setting of the alarm changes.
+    """
+    encoded = json.dumps(alarm, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()[:alarm_hash_length]
+
+
+def plan_entry(resource_id, desired_alarms):
+    """
+    Returns the manifest entry of a resource from its desired alarms, a dict of put_metric_alarm requests keyed by
+    alarm name: {'ResourceId': <id>, 'Alarms': [[<alarm name>, <definition hash>], ...]} with the alarms sorted by
+    name.
+    """
+    return {
+        'ResourceId': resource_id,
+        'Alarms': [[alarm_name, alarm_hash(desired_alarms[alarm_name])] for alarm_name in sorted(desired_alarms)]
+    }
+
+
+def manifest_lines(entries):
+    """
+    Yields the manifest entries as NDJSON lines, entries must be sorted by ResourceId.
+    """
+    for entry in entries:
+        yield json.dumps(entry, separators=(',', ':')) + '\n'
+
+
+def read_manifest(lines):
+    """
+    Yields the entries of an NDJSON manifest from an iterable of lines, blank lines are skipped.
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if line.strip():
+            yield json.loads(line)
+
+
+def diff_manifests(previous_entries, current_entries):
+    """
+    Compares two manifests sorted by ResourceId in a single linear pass and yields (resource_id, alarm names to put,
+    alarm names to delete) for every resource whose alarms differ.  A resource missing from the current manifest has
+    all of its alarms deleted, a resource new to it has all of its alarms put.
+    """
+    previous_entries = iter(previous_entries)
+    current_entries = iter(current_entries)
+    previous = next(previous_entries, None)
+    current = next(current_entries, None)
+    while previous is not None or current is not None:
+        if current is None or (previous is not None and previous['ResourceId'] < current['ResourceId']):
+            yield previous['ResourceId'], [], [alarm_name for alarm_name, _ in previous['Alarms']]
+            previous = next(previous_entries, None)
+        elif previous is None or current['ResourceId'] < previous['ResourceId']:
+            yield current['ResourceId'], [alarm_name for alarm_name, _ in current['Alarms']], []
+            current = next(current_entries, None)
+        else:
+            previous_hashes = dict(previous['Alarms'])
+            current_names = set(alarm_name for alarm_name, _ in current['Alarms'])
+            put = [alarm_name for alarm_name, definition_hash in current['Alarms'] if
+                   previous_hashes.get(alarm_name, None) != definition_hash]
+            delete = [alarm_name for alarm_name in previous_hashes if alarm_name not in current_names]
+            if put or delete:
+                yield current['ResourceId'], put, delete
+            previous = next(previous_entries, None)
+            current = next(current_entries, None)
@@ -0,0 +1,209 @@
+import logging
+from collections.abc import Mapping
+from functools import lru_cache
+from types import MappingProxyType
+
+logger = logging.getLogger()
+
+valid_comparators = ['GreaterThanOrEqualToThreshold', 'GreaterThanThreshold', 'LessThanThreshold',
+                     'LessThanOrEqualToThreshold', "LessThanLowerOrGreaterThanUpperThreshold", "LessThanLowerThreshold",
+                     "GreaterThanUpperThreshold"]
+
+valid_anomaly_detection_comparators = ["LessThanLowerOrGreaterThanUpperThreshold", "LessThanLowerThreshold",
+                                       "GreaterThanUpperThreshold"]
+
+valid_statistics = ['Average', 'SampleCount', 'Sum', 'Minimum', 'Maximum']
+
+wildcard = '*'
+
+
+class AlarmSpecError(Exception):
+    pass
+
+
+seconds_per_unit = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def convert_to_seconds(s):
+    try:
+        return int(s[:-1]) * seconds_per_unit[s[-1]]
+    except Exception as e:
+        # If any other exceptions which we didn't expect are raised
+        # then fail and log the exception message.
+        logger.error('Error converting threshold string {} to seconds! {}'.format(s, e))
+        raise
+
+
+class AlarmSpec:
+    """
+    Immutable, compiled form of an alarm tag key:
+    <AlarmIdentifier>-<Namespace>-<MetricName>-[<DimensionName>-<DimensionValue>...]-<ComparisonOperator>-<Period>-
+    [<EvaluationPeriods>]-<Statistic>-[<Description>]
+    Use parse_alarm_spec to obtain instances, parsed keys are memoized.
+    """
+    __slots__ = ('key', 'separator', 'namespace', 'metric', 'dimensions', 'wildcard_dimensions', 'comparator',
+                 'period', 'period_seconds', 'evaluation_periods', 'statistic', 'description')
+
+    def __init__(self, key, separator, namespace, metric, dimensions, comparator, period, period_seconds,
+                 evaluation_periods, statistic, description):
+        values = {
+            'key': key,
+            'separator': separator,
+            'namespace': namespace,
+            'metric': metric,
+            'dimensions': tuple(dimensions),
+            'wildcard_dimensions': tuple(name for name, value in dimensions if value == wildcard),
+            'comparator': comparator,
+            'period': period,
+            'period_seconds': period_seconds,
+            'evaluation_periods': evaluation_periods,
+            'statistic': statistic,
+            'description': description
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('AlarmSpec is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('AlarmSpec is immutable')
+
+    def __eq__(self, other):
+        return isinstance(other, AlarmSpec) and (self.key, self.separator) == (other.key, other.separator)
+
+    def __hash__(self):
+        return hash((self.key, self.separator))
+
+    def __repr__(self):
+        return 'AlarmSpec({!r})'.format(self.key)
+
+    @property
+    def has_wildcards(self):
+        return len(self.wildcard_dimensions) > 0
+
+    @property
+    def is_anomaly_detection(self):
+        return self.comparator in valid_anomaly_detection_comparators
+
+    def metric_dimensions(self):
+        """
+        Returns the dimensions specified in the tag key in the format used by the CloudWatch API.
+        """
+        return [{'Name': name, 'Value': value} for name, value in self.dimensions]
+
+    def alarm_name(self, alarm_identifier, resource_id, threshold):
+        """
+        Returns the name of the alarm created from this spec for the resource.
+        """
+        name = [alarm_identifier, resource_id, self.namespace, self.metric]
+        for dimension_name, dimension_value in self.dimensions:
+            name.extend([dimension_name, dimension_value])
+        name.extend([self.comparator, str(threshold), self.period, "{}p".format(self.evaluation_periods),
+                     self.statistic])
+        if self.description is not None:
+            name.append(self.description)
+        return self.separator.join(name)
+
+    def resolve_wildcards(self, dimension_values):
+        """
+        Returns the spec with its wildcard dimension values replaced by the values in dimension_values, a dict of
+        dimension name to value.  Wildcard dimensions missing from dimension_values are left unchanged.
+        """
+        properties = self.key.split(self.separator)
+        dimension_index = 3
+        for dimension_name, dimension_value in self.dimensions:
+            if dimension_value == wildcard and dimension_name in dimension_values:
+                properties[dimension_index + 1] = dimension_values[dimension_name]
+            dimension_index += 2
+        return parse_alarm_spec(self.separator.join(properties), self.separator)
+
+
+def parse_alarm_spec(key, separator):
+    """
+    Returns the compiled AlarmSpec for an alarm tag key.  Raises AlarmSpecError if the key is invalid, the error is
+    logged the first time the key is parsed only.
+    """
+    spec = _compile_alarm_spec(key, separator)
+    if isinstance(spec, AlarmSpecError):
+        raise AlarmSpecError(str(spec))
+    return spec
+
+
+@lru_cache(maxsize=8192)
+def _compile_alarm_spec(key, separator):
+    try:
+        return _parse(key, separator)
+    except Exception as e:
+        error = AlarmSpecError('Invalid alarm tag {}: {}'.format(key, e))
+        logger.error(str(error))
+        return error
+
+
+def _parse(key, separator):
+    properties = key.split(separator)
+    if len(properties) < 6:
+        raise ValueError('expected at least 6 properties separated by "{}"'.format(separator))
+    namespace = properties[1]
+    metric = properties[2]
+
+    # the comparison operator ends the dimensions, the last element is excluded because it is the description or
+    # the statistic
+    for comparator_index, prop in enumerate(properties[3:-1], start=3):
+        if prop in valid_comparators:
+            break
+    else:
+        raise ValueError('no valid comparison operator found')
+
+    dimension_properties = properties[3:comparator_index]
+    if len(dimension_properties) % 2:
+        raise ValueError('dimensions must be name and value pairs, got {}'.format(dimension_properties))
+    dimensions = list(zip(dimension_properties[::2], dimension_properties[1::2]))
+
+    comparator = properties[comparator_index]
+    period = properties[comparator_index + 1]
+    if len(period) < 2 or not period[:-1].isdigit() or period[-1] not in seconds_per_unit:
+        raise ValueError('invalid period {}, expected a number followed by one of {}'.format(
+            period, ''.join(seconds_per_unit)))
+    period_seconds = int(period[:-1]) * seconds_per_unit[period[-1]]
+
+    # Provide support for previous formatting of custom alarm tags where the evaluation period wasn't specified.
+    # If an evaluation period isn't specified in the tag then it defaults to 1, similar to past behavior.
+    statistic_index = comparator_index + 2
+    if statistic_index >= len(properties):
+        raise ValueError('statistic not specified')
+    if properties[statistic_index] in valid_statistics:
+        evaluation_periods = 1
+    else:
+        evaluation_periods = int(properties[statistic_index])
+        statistic_index += 1
+        if statistic_index >= len(properties):
+            raise ValueError('statistic not specified')
+    statistic = properties[statistic_index]
+
+    # the description is optional
+    if statistic_index + 1 < len(properties):
+        description = properties[statistic_index + 1]
+    else:
+        description = None
+
+    return AlarmSpec(key, separator, namespace, metric, dimensions, comparator, period, period_seconds,
+                     evaluation_periods, statistic, description)
+
+
+def freeze_alarm_catalog(alarms, separator):
+    """
+    Validates every alarm of a default alarm catalog, the nested dict of namespace (and platform) to lists of
+    {'Key': <alarm tag key>, 'Value': <threshold>} alarms, and returns a read-only copy of it.
+    Raises AlarmSpecError if an alarm key or threshold is invalid.
+    """
+    if isinstance(alarms, Mapping) and 'Key' in alarms:
+        parse_alarm_spec(alarms['Key'], separator)
+        try:
+            float(alarms['Value'])
+        except (TypeError, ValueError):
+            raise AlarmSpecError('Invalid threshold {} for alarm {}'.format(alarms['Value'], alarms['Key']))
+        return MappingProxyType(dict(alarms))
+    if isinstance(alarms, Mapping):
+        return MappingProxyType({key: freeze_alarm_catalog(value, separator) for key, value in alarms.items()})
+    return tuple(freeze_alarm_catalog(alarm, separator) for alarm in alarms)
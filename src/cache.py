@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+
+class ExpiringCache:
+    """
+    Thread-safe in-memory cache where every entry carries its own expiry time.
+    The cache lives at module scope so entries survive warm Lambda invocations. Expired entries are evicted on
+    lookup and whenever a new entry is stored. When max_size is set, the least recently used entries are evicted to
+    stay within it. Hit and miss counters are kept for reporting.
+    """
+
+    def __init__(self, name, max_size=None):
+        self.name = name
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _lookup(self, key, now):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return _missing
+        value, expires_at = entry
+        if expires_at <= now:
+            del self._entries[key]
+            return _missing
+        self._entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key, time.time())
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at):
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            if expires_at > now:
+                self._entries[key] = (value, expires_at)
+                self._entries.move_to_end(key)
+                if self.max_size and len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value for key, calling loader() on a miss. loader must return a (value, expires_at) tuple
+        where expires_at is an epoch timestamp. Concurrent misses for the same key only call loader once.
+        """
+        with self._lock:
+            value = self._lookup(key, time.time())
+            if value is not _missing:
+                self.hits += 1
+                return value
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # another thread may have loaded the entry while we were waiting for the key lock
+            with self._lock:
+                value = self._lookup(key, time.time())
+                if value is not _missing:
+                    self.hits += 1
+                    return value
+                self.misses += 1
+            value, expires_at = loader()
+            self.set(key, value, expires_at)
+            return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._key_locks.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'name': self.name, 'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def _evict_expired(self, now):
+        expired = [key for key, (value, expires_at) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
@@ -1,186 +1,513 @@
+import json
 import logging
+from datetime import datetime, timezone
+
+from concurrent.futures import ThreadPoolExecutor
 
 from actions import check_alarm_tag, process_alarm_tags, delete_alarms, process_lambda_alarms, \
-    scan_and_process_alarm_tags, process_rds_alarms, separate_wildcard_alarms, get_active_accounts_by_organizational_unit
+    process_rds_alarms, separate_wildcard_alarms, get_account_inventory, account_inventory_cache, \
+    scan_accounts_and_regions, credentials_cache, client_pool, get_scan_state_store, invoke_scan_continuation, \
+    get_work_queue, describe_tagged_instances, determine_platforms, concurrency_controller, alarm_fingerprint, \
+    fingerprint_tag_value, update_alarm_fingerprints, collect_orphaned_alarms_in_accounts_and_regions, \
+    plan_accounts_and_regions, startup_mode, preload_clients, scan_resource_types, uses_asg_alarms, asg_alarms_mode
+from alarm_spec import freeze_alarm_catalog
+from metrics import api_metrics
+from structured_log import structured_log
+from scan_state import Deadline, ScanCheckpoint
+from sharded_scan import start_sharded_scan, load_shard_checkpoint, finish_shard, sharded_scan_status
 from os import getenv
 
-def lambda_handler(event, context):
-    logger = logging.getLogger()
-    log_level = getenv("LOGLEVEL", "INFO")
-    level = logging.getLevelName(log_level)
-    logger.setLevel(level)
-
-    create_alarm_tag = getenv("ALARM_TAG", "Create_Auto_Alarms")
-
-    target_org_units = getenv("TARGET_ORG_UNITS", None)
-    target_org_units = target_org_units.split(",")
-
-    target_regions = getenv("TARGET_REGIONS", None)
-    target_regions = target_regions.split(",")
-
-    local_account_id = getenv("LOCAL_ACCOUNT_ID", None)
-
-    org_mgmt_account_id = getenv("ORG_MGMT_ACCOUNT", None)
-
-    cw_namespace = getenv("CLOUDWATCH_NAMESPACE", "CWAgent")
-
-    create_default_alarms_flag = getenv("CREATE_DEFAULT_ALARMS", "true").lower()
-
-    append_dimensions = getenv("CLOUDWATCH_APPEND_DIMENSIONS", 'InstanceId, ImageId, InstanceType')
-    append_dimensions = [dimension.strip() for dimension in append_dimensions.split(',')]
-
-    alarm_cpu_high_default_threshold = getenv("ALARM_CPU_HIGH_THRESHOLD", "75")
-    alarm_cpu_high_anomaly_detection_default_threshold = getenv("ALARM_DEFAULT_ANOMALY_THRESHOLD", "2")
-    alarm_memory_high_default_threshold = getenv("ALARM_MEMORY_HIGH_THRESHOLD", "75")
-    alarm_disk_space_percent_free_threshold = getenv("ALARM_DISK_PERCENT_LOW_THRESHOLD", "20")
-    alarm_disk_used_percent_threshold = 100 - int(alarm_disk_space_percent_free_threshold)
-
-    alarm_rds_cpu_high_default_threshold = getenv("ALARM_RDS_CPU_HIGH_THRESHOLD", "75")
-
-    alarm_lambda_error_threshold = getenv("ALARM_LAMBDA_ERROR_THRESHOLD", "1")
-    alarm_lambda_throttles_threshold = getenv("ALARM_LAMBDA_THROTTLE_THRESHOLD", "1")
-    alarm_lambda_dead_letter_error_threshold = getenv("ALARM_LAMBDA_DEAD_LETTER_ERROR_THRESHOLD", "1")
-    alarm_lambda_destination_delivery_failure_threshold = getenv("ALARM_LAMBDA_DESTINATION_DELIVERY_FAILURE_THRESHOLD", "1")
-
-    alarm_separator = '-'
-    alarm_identifier = getenv("ALARM_IDENTIFIER_PREFIX", 'AutoAlarm')
-
-    default_period = '5m'
-    default_evaluation_periods = '1'
-    default_statistic = 'Average'
-
-    metric_dimensions_map = {
-        cw_namespace: append_dimensions,
-        'AWS/EC2': ['InstanceId']
-    }
+logger = logging.getLogger()
+log_level = getenv("LOGLEVEL", "INFO")
+level = logging.getLevelName(log_level)
+logger.setLevel(level)
+
+create_alarm_tag = getenv("ALARM_TAG", "Create_Auto_Alarms")
+
+target_org_units = [ou_id.strip() for ou_id in getenv("TARGET_ORG_UNITS", "").split(",") if ou_id.strip()]
+
+target_regions = [region.strip() for region in getenv("TARGET_REGIONS", "").split(",") if region.strip()]
+
+local_account_id = getenv("LOCAL_ACCOUNT_ID", None)
+
+org_mgmt_account_id = getenv("ORG_MGMT_ACCOUNT", None)
+
+scan_concurrency = int(getenv("SCAN_CONCURRENCY", "10"))
+
+# Scans stop SCAN_DEADLINE_MARGIN seconds before the invocation times out and checkpoint their progress to
+# SCAN_STATE_STORE, an s3://bucket/prefix/ or file:///directory URL, an empty value disables checkpointing.  With
+# SCAN_CONTINUATION enabled an interrupted scan invokes the function again to continue from the checkpoint.  The
+# continuation can run in another execution environment, so it needs a checkpoint in S3 and is off by default for
+# the other stores.  A checkpoint older than SCAN_CHECKPOINT_MAX_AGE seconds is abandoned and the scan starts over.
+scan_state_store_url = getenv("SCAN_STATE_STORE", "file:///tmp/cloudwatch-auto-alarms-scan-state")
+scan_deadline_margin = int(getenv("SCAN_DEADLINE_MARGIN", "60"))
+scan_checkpoint_max_age = int(getenv("SCAN_CHECKPOINT_MAX_AGE", "86400"))
+scan_continuation_flag = getenv("SCAN_CONTINUATION",
+                                "true" if scan_state_store_url.startswith('s3://') else "false").lower()
+if scan_continuation_flag == 'true' and not scan_state_store_url.startswith('s3://'):
+    raise Exception('SCAN_CONTINUATION needs a SCAN_STATE_STORE in Amazon S3, a continuation can run in another '
+                    'execution environment than the checkpoint in {}'.format(scan_state_store_url or 'memory'))
+
+# With SCAN_SHARD_QUEUE set to an SQS queue URL (or 'local' for a single container) a scan enqueues one work item per
+# (account, region) and the function scans each of them in its own invocation.  A sharded scan that is still running
+# is not restarted unless it is older than SHARDED_SCAN_MAX_AGE seconds.  The shards of an SQS queue run in other
+# execution environments than the manifest they load, so they need a SCAN_STATE_STORE in S3.
+scan_shard_queue_url = getenv("SCAN_SHARD_QUEUE", "")
+sharded_scan_max_age = int(getenv("SHARDED_SCAN_MAX_AGE", "86400"))
+if scan_shard_queue_url and scan_shard_queue_url != 'local' and not scan_state_store_url.startswith('s3://'):
+    raise Exception('An SQS SCAN_SHARD_QUEUE needs a SCAN_STATE_STORE in Amazon S3, a shard can run in another '
+                    'execution environment than the scan manifest in {}'.format(scan_state_store_url or 'memory'))
+
+cw_namespace = getenv("CLOUDWATCH_NAMESPACE", "CWAgent")
+
+create_default_alarms_flag = getenv("CREATE_DEFAULT_ALARMS", "true").lower()
+
+reconcile_alarms_flag = getenv("RECONCILE_ALARMS", "false").lower()
+
+append_dimensions = getenv("CLOUDWATCH_APPEND_DIMENSIONS", 'InstanceId, ImageId, InstanceType')
+append_dimensions = [dimension.strip() for dimension in append_dimensions.split(',')]
+
+alarm_cpu_high_default_threshold = getenv("ALARM_CPU_HIGH_THRESHOLD", "75")
+alarm_cpu_high_anomaly_detection_default_threshold = getenv("ALARM_DEFAULT_ANOMALY_THRESHOLD", "2")
+alarm_memory_high_default_threshold = getenv("ALARM_MEMORY_HIGH_THRESHOLD", "75")
+alarm_disk_space_percent_free_threshold = getenv("ALARM_DISK_PERCENT_LOW_THRESHOLD", "20")
+alarm_disk_used_percent_threshold = 100 - int(alarm_disk_space_percent_free_threshold)
+
+alarm_rds_cpu_high_default_threshold = getenv("ALARM_RDS_CPU_HIGH_THRESHOLD", "75")
+
+alarm_lambda_error_threshold = getenv("ALARM_LAMBDA_ERROR_THRESHOLD", "1")
+alarm_lambda_throttles_threshold = getenv("ALARM_LAMBDA_THROTTLE_THRESHOLD", "1")
+alarm_lambda_dead_letter_error_threshold = getenv("ALARM_LAMBDA_DEAD_LETTER_ERROR_THRESHOLD", "1")
+alarm_lambda_destination_delivery_failure_threshold = getenv("ALARM_LAMBDA_DESTINATION_DELIVERY_FAILURE_THRESHOLD", "1")
+
+alarm_separator = '-'
+alarm_identifier = getenv("ALARM_IDENTIFIER_PREFIX", 'AutoAlarm')
+
+default_period = '5m'
+default_evaluation_periods = '1'
+default_statistic = 'Average'
+
+metric_dimensions_map = {
+    cw_namespace: append_dimensions,
+    'AWS/EC2': ['InstanceId']
+}
+
+# For Redhat, the default device is xvda2, xfs, for Ubuntu, the default fstype is ext4,
+# for Amazon Linux, the default device is xvda1, xfs
+default_alarms = {
+    # default<number> added to the end of the key to  make the key unique
+    # this differentiate alarms with similar settings but different thresholds
+    'AWS/RDS': [
+        {
+            'Key': alarm_separator.join(
+                [alarm_identifier, 'AWS/RDS', 'CPUUtilization', 'GreaterThanThreshold', default_period,
+                 default_evaluation_periods, default_statistic, 'Created_by_CloudWatchAutoAlarms']),
+            'Value': alarm_rds_cpu_high_default_threshold
+        }
+    ],
+    'AWS/EC2': [
+        {
+            'Key': alarm_separator.join(
+                [alarm_identifier, 'AWS/EC2', 'CPUUtilization', 'GreaterThanThreshold', default_period,
+                 default_evaluation_periods, default_statistic, 'Created_by_CloudWatchAutoAlarms']),
+            'Value': alarm_cpu_high_default_threshold
+        },
+        # This is an example alarm using anomaly detection
+        # {
+        #     'Key': alarm_separator.join(
+        #         [alarm_identifier, 'AWS/EC2', 'CPUUtilization', 'GreaterThanUpperThreshold', default_period,
+        #          default_evaluation_periods, default_statistic, 'Created_by_CloudWatchAutoAlarms']),
+        #     'Value': alarm_cpu_high_anomaly_detection_default_threshold
+        # }
+    ],
+    'AWS/Lambda': [
+        {
+            'Key': alarm_separator.join(
+                [alarm_identifier, 'AWS/Lambda', 'Errors', 'GreaterThanThreshold', default_period,
+                 default_evaluation_periods, default_statistic, 'Created_by_CloudWatchAutoAlarms']),
+            'Value': alarm_lambda_error_threshold
+        },
+        {
+            'Key': alarm_separator.join(
+                [alarm_identifier, 'AWS/Lambda', 'Throttles', 'GreaterThanThreshold', default_period,
+                 default_evaluation_periods, default_statistic, 'Created_by_CloudWatchAutoAlarms']),
+            'Value': alarm_lambda_throttles_threshold
+        }
+    ],
+    cw_namespace: {
+        'Windows': [
 
-    # For Redhat, the default device is xvda2, xfs, for Ubuntu, the default fstype is ext4,
-    # for Amazon Linux, the default device is xvda1, xfs
-    default_alarms = {
-        # default<number> added to the end of the key to  make the key unique
-        # this differentiate alarms with similar settings but different thresholds
-        'AWS/RDS': [
             {
                 'Key': alarm_separator.join(
-                    [alarm_identifier, 'AWS/RDS', 'CPUUtilization', 'GreaterThanThreshold', default_period,
-                     default_evaluation_periods, default_statistic, 'Created_by_CloudWatchAutoAlarms']),
-                'Value': alarm_rds_cpu_high_default_threshold
+                    [alarm_identifier, cw_namespace, 'LogicalDisk % Free Space', 'objectname', 'LogicalDisk',
+                     'instance', 'C:', 'LessThanThreshold', default_period, default_evaluation_periods,
+                     default_statistic, 'Created_by_CloudWatchAutoAlarms']),
+                'Value': alarm_disk_space_percent_free_threshold
+            },
+            {
+                'Key': alarm_separator.join(
+                    [alarm_identifier, cw_namespace, 'Memory % Committed Bytes In Use', 'objectname', 'Memory',
+                     'GreaterThanThreshold', default_period, default_evaluation_periods, default_statistic,
+                     'Created_by_CloudWatchAutoAlarms']),
+                'Value': alarm_memory_high_default_threshold
             }
         ],
-        'AWS/EC2': [
+        'Amazon Linux': [
             {
                 'Key': alarm_separator.join(
-                    [alarm_identifier, 'AWS/EC2', 'CPUUtilization', 'GreaterThanThreshold', default_period,
-                     default_evaluation_periods, default_statistic, 'Created_by_CloudWatchAutoAlarms']),
-                'Value': alarm_cpu_high_default_threshold
+                    [alarm_identifier, cw_namespace, 'disk_used_percent', 'device', 'nvme0n1p1', 'fstype', 'xfs', 'path',
+                     '/', 'GreaterThanThreshold', default_period, default_evaluation_periods, default_statistic,
+                     'Created_by_CloudWatchAutoAlarms']),
+                'Value': alarm_disk_used_percent_threshold
             },
-            # This is an example alarm using anomaly detection
-            # {
-            #     'Key': alarm_separator.join(
-            #         [alarm_identifier, 'AWS/EC2', 'CPUUtilization', 'GreaterThanUpperThreshold', default_period,
-            #          default_evaluation_periods, default_statistic, 'Created_by_CloudWatchAutoAlarms']),
-            #     'Value': alarm_cpu_high_anomaly_detection_default_threshold
-            # }
+            {
+                'Key': alarm_separator.join(
+                    [alarm_identifier, cw_namespace, 'mem_used_percent', 'GreaterThanThreshold', default_period,
+                     default_evaluation_periods, default_statistic,
+                     'Created_by_CloudWatchAutoAlarms']),
+                'Value': alarm_memory_high_default_threshold
+            }
         ],
-        'AWS/Lambda': [
+        'Red Hat': [
             {
                 'Key': alarm_separator.join(
-                    [alarm_identifier, 'AWS/Lambda', 'Errors', 'GreaterThanThreshold', default_period,
-                     default_evaluation_periods, default_statistic, 'Created_by_CloudWatchAutoAlarms']),
-                'Value': alarm_lambda_error_threshold
+                    [alarm_identifier, cw_namespace, 'disk_used_percent', 'device', 'xvda2', 'fstype', 'xfs', 'path',
+                     '/', 'GreaterThanThreshold', default_period, default_evaluation_periods, default_statistic,
+                     'Created_by_CloudWatchAutoAlarms']),
+                'Value': alarm_disk_used_percent_threshold
             },
             {
                 'Key': alarm_separator.join(
-                    [alarm_identifier, 'AWS/Lambda', 'Throttles', 'GreaterThanThreshold', default_period,
-                     default_evaluation_periods, default_statistic, 'Created_by_CloudWatchAutoAlarms']),
-                'Value': alarm_lambda_throttles_threshold
+                    [alarm_identifier, cw_namespace, 'mem_used_percent', 'GreaterThanThreshold', default_period,
+                     default_evaluation_periods, default_statistic,
+                     'Created_by_CloudWatchAutoAlarms']),
+                'Value': alarm_memory_high_default_threshold
             }
         ],
-        cw_namespace: {
-            'Windows': [
-
-                {
-                    'Key': alarm_separator.join(
-                        [alarm_identifier, cw_namespace, 'LogicalDisk % Free Space', 'objectname', 'LogicalDisk',
-                         'instance', 'C:', 'LessThanThreshold', default_period, default_evaluation_periods,
-                         default_statistic, 'Created_by_CloudWatchAutoAlarms']),
-                    'Value': alarm_disk_space_percent_free_threshold
-                },
-                {
-                    'Key': alarm_separator.join(
-                        [alarm_identifier, cw_namespace, 'Memory % Committed Bytes In Use', 'objectname', 'Memory',
-                         'GreaterThanThreshold', default_period, default_evaluation_periods, default_statistic,
-                         'Created_by_CloudWatchAutoAlarms']),
-                    'Value': alarm_memory_high_default_threshold
-                }
-            ],
-            'Amazon Linux': [
-                {
-                    'Key': alarm_separator.join(
-                        [alarm_identifier, cw_namespace, 'disk_used_percent', 'device', 'nvme0n1p1', 'fstype', 'xfs', 'path',
-                         '/', 'GreaterThanThreshold', default_period, default_evaluation_periods, default_statistic,
-                         'Created_by_CloudWatchAutoAlarms']),
-                    'Value': alarm_disk_used_percent_threshold
-                },
-                {
-                    'Key': alarm_separator.join(
-                        [alarm_identifier, cw_namespace, 'mem_used_percent', 'GreaterThanThreshold', default_period,
-                         default_evaluation_periods, default_statistic,
-                         'Created_by_CloudWatchAutoAlarms']),
-                    'Value': alarm_memory_high_default_threshold
-                }
-            ],
-            'Red Hat': [
-                {
-                    'Key': alarm_separator.join(
-                        [alarm_identifier, cw_namespace, 'disk_used_percent', 'device', 'xvda2', 'fstype', 'xfs', 'path',
-                         '/', 'GreaterThanThreshold', default_period, default_evaluation_periods, default_statistic,
-                         'Created_by_CloudWatchAutoAlarms']),
-                    'Value': alarm_disk_used_percent_threshold
-                },
-                {
-                    'Key': alarm_separator.join(
-                        [alarm_identifier, cw_namespace, 'mem_used_percent', 'GreaterThanThreshold', default_period,
-                         default_evaluation_periods, default_statistic,
-                         'Created_by_CloudWatchAutoAlarms']),
-                    'Value': alarm_memory_high_default_threshold
-                }
-            ],
-            'Ubuntu': [
-                {
-                    'Key': alarm_separator.join(
-                        [alarm_identifier, cw_namespace, 'disk_used_percent', 'device', 'xvda1', 'fstype', 'ext4', 'path',
-                         '/', 'GreaterThanThreshold', default_period, default_evaluation_periods, default_statistic,
-                         'Created_by_CloudWatchAutoAlarms']),
-                    'Value': alarm_disk_used_percent_threshold
-                },
-                {
-                    'Key': alarm_separator.join(
-                        [alarm_identifier, cw_namespace, 'mem_used_percent', 'GreaterThanThreshold', default_period,
-                         default_evaluation_periods, default_statistic,
-                         'Created_by_CloudWatchAutoAlarms']),
-                    'Value': alarm_memory_high_default_threshold
-                }
-            ],
-            'SUSE': [
-                {
-                    'Key': alarm_separator.join(
-                        [alarm_identifier, cw_namespace, 'disk_used_percent', 'device', 'xvda1', 'fstype', 'xfs', 'path',
-                         '/', 'GreaterThanThreshold', default_period, default_evaluation_periods, default_statistic,
-                         'Created_by_CloudWatchAutoAlarms']),
-                    'Value': alarm_disk_used_percent_threshold
-                },
-                {
-                    'Key': alarm_separator.join(
-                        [alarm_identifier, cw_namespace, 'mem_used_percent', 'GreaterThanThreshold', default_period,
-                         default_evaluation_periods, default_statistic,
-                         'Created_by_CloudWatchAutoAlarms']),
-                    'Value': alarm_memory_high_default_threshold
-                }
-            ]
-        }
+        'Ubuntu': [
+            {
+                'Key': alarm_separator.join(
+                    [alarm_identifier, cw_namespace, 'disk_used_percent', 'device', 'xvda1', 'fstype', 'ext4', 'path',
+                     '/', 'GreaterThanThreshold', default_period, default_evaluation_periods, default_statistic,
+                     'Created_by_CloudWatchAutoAlarms']),
+                'Value': alarm_disk_used_percent_threshold
+            },
+            {
+                'Key': alarm_separator.join(
+                    [alarm_identifier, cw_namespace, 'mem_used_percent', 'GreaterThanThreshold', default_period,
+                     default_evaluation_periods, default_statistic,
+                     'Created_by_CloudWatchAutoAlarms']),
+                'Value': alarm_memory_high_default_threshold
+            }
+        ],
+        'SUSE': [
+            {
+                'Key': alarm_separator.join(
+                    [alarm_identifier, cw_namespace, 'disk_used_percent', 'device', 'xvda1', 'fstype', 'xfs', 'path',
+                     '/', 'GreaterThanThreshold', default_period, default_evaluation_periods, default_statistic,
+                     'Created_by_CloudWatchAutoAlarms']),
+                'Value': alarm_disk_used_percent_threshold
+            },
+            {
+                'Key': alarm_separator.join(
+                    [alarm_identifier, cw_namespace, 'mem_used_percent', 'GreaterThanThreshold', default_period,
+                     default_evaluation_periods, default_statistic,
+                     'Created_by_CloudWatchAutoAlarms']),
+                'Value': alarm_memory_high_default_threshold
+            }
+        ]
     }
-    logger.info('event received: {}'.format(event))
+}
+
+# The alarm catalog is validated and frozen once per container and reused across warm invocations.  Per-resource alarm
+# lists are derived from it without modifying it.
+default_alarms = freeze_alarm_catalog(default_alarms, alarm_separator)
+default_filtered_alarms, wildcard_alarms = separate_wildcard_alarms(alarm_separator, cw_namespace, default_alarms)
+default_filtered_alarms = freeze_alarm_catalog(default_filtered_alarms, alarm_separator)
+wildcard_alarms = freeze_alarm_catalog(wildcard_alarms, alarm_separator)
+
+sns_topic_name = getenv('SNS_TOPIC_NAME')
+sns_topic_account = getenv('SNS_TOPIC_ACCOUNT')
+
+# AWS API call metrics are written as one CloudWatch Embedded Metric Format record per invocation
+api_metrics_flag = getenv("API_METRICS", "true").lower()
+api_metrics_namespace = getenv("API_METRICS_NAMESPACE", "CloudWatchAutoAlarms")
+
+
+def get_scan_units():
+    """
+    Returns the (organizational_unit_id, account_id, region) units to scan, account_id and organizational_unit_id are
+    None when scanning the regions of the local account.
+    """
+    scan_units = list()
+    if org_mgmt_account_id:
+        accounts_by_ou, _, _ = get_account_inventory(target_org_units, org_mgmt_account_id)
+        for ou_id, accounts in accounts_by_ou.items():
+            logger.debug('Processing Organizational Unit (OU): %s', ou_id)
+            for account in accounts:
+                account_id = account['AccountId']
+                account_name = account['AccountName']
+                logger.debug('Queueing account %s (%s) in OU %s', account_id, account_name, ou_id)
+                for region in target_regions:
+                    scan_units.append((ou_id, account_id, region))
+    else:
+        # scan the regions of the single account
+        for region in target_regions:
+            scan_units.append((None, None, region))
+    return scan_units
+
+
+def get_sns_topic_arn(region):
+    """
+    Returns the ARN of the notification topic in the region, or None if notifications are not set up.
+    """
+    if not sns_topic_name or not sns_topic_account or not region:
+        return None
+    return f"arn:aws:sns:{region}:{sns_topic_account}:{sns_topic_name}"
+
+
+def is_instance_state_event(event):
+    return isinstance(event, dict) and event.get('source', None) == 'aws.ec2' and \
+        event.get('detail', {}).get('state', None) in ['running', 'terminated']
+
+
+def coalesce_instance_state_events(events):
+    """
+    Collapses the EC2 instance state change events of a batch to one state per instance, applying the events in event
+    time order, and groups the instances by (account, region).  Duplicate events are dropped, and an instance that is
+    started and terminated within the batch only has its alarms deleted.  Returns a dict of (account, region) to a
+    dict of instance ID to (state, indexes of the events collapsed into it).
+    """
+    groups = dict()
+    indexes = [index for index, event in enumerate(events) if is_instance_state_event(event)]
+    # sort is stable, events of the same second keep their order in the batch
+    for index in sorted(indexes, key=lambda index: events[index].get('time', '')):
+        event = events[index]
+        instances = groups.setdefault((event.get('account', None), event.get('region', None)), dict())
+        instance_id = event['detail']['instance-id']
+        state, event_indexes = instances.get(instance_id, (None, []))
+        instances[instance_id] = (event['detail']['state'], event_indexes + [index])
+    return groups
+
+
+def process_instance_state_group(account_id, region, instances):
+    """
+    Creates the alarms of the started and deletes the alarms of the terminated instances of one (account, region)
+    group.  The started instances are described and their AMIs resolved in batches, their alarms are then written on
+    a pool of worker threads and their alarm fingerprints tagged in batches.  Returns the number of alarms written and the indexes of the events that
+    failed.
+    """
+    cross_account_id = None if account_id == local_account_id else account_id
+    sns_topic_arn = get_sns_topic_arn(region)
+    instance_ids = list(instances)
+    running_instance_ids = [instance_id for instance_id in instance_ids if instances[instance_id][0] == 'running']
+    failed = list()
+    try:
+        tagged_instances = describe_tagged_instances(running_instance_ids, create_alarm_tag, region, cross_account_id)
+        determine_platforms(list(tagged_instances.values()), region, cross_account_id)
+    except Exception as e:
+        logger.error('Failure describing instances in account {} region {}: {}'.format(account_id, region, e))
+        failed = [index for instance_id in running_instance_ids for index in instances[instance_id][1]]
+        # the terminated instances can still be processed
+        instance_ids = [instance_id for instance_id in instance_ids if instances[instance_id][0] != 'running']
+        tagged_instances = dict()
+
+    def process_instance(instance_id):
+        state, event_indexes = instances[instance_id]
+        try:
+            with concurrency_controller.slot():
+                if state == 'terminated':
+                    delete_alarms(instance_id, alarm_identifier, alarm_separator, region, cross_account_id)
+                    return 0, []
+                instance_info = tagged_instances.get(instance_id, None)
+                if not instance_info:
+                    return 0, []
+                instance_sns_target = [instance_tag['Value'] for instance_tag in instance_info['Tags'] if
+                                       instance_tag['Key'] == 'notify']
+                target_sns_topic_arn = instance_sns_target[0] if instance_sns_target else sns_topic_arn
+                alarms_written, complete = process_alarm_tags(instance_id, instance_info, default_filtered_alarms,
+                                                              wildcard_alarms, metric_dimensions_map,
+                                                              target_sns_topic_arn, cw_namespace,
+                                                              create_default_alarms_flag, alarm_separator,
+                                                              alarm_identifier, region, cross_account_id,
+                                                              reconcile_alarms_flag)
+                # an instance with alarms that failed to write keeps its old fingerprint so the next scan retries it
+                if not complete or uses_asg_alarms(instance_info):
+                    return alarms_written, []
+                tag_values[instance_id] = fingerprint_tag_value(alarm_fingerprint(
+                    instance_info, default_filtered_alarms, wildcard_alarms, metric_dimensions_map,
+                    target_sns_topic_arn, cw_namespace, create_default_alarms_flag, alarm_separator,
+                    alarm_identifier), timestamp)
+                return alarms_written, []
+        except Exception as e:
+            logger.error('Failure processing {} event of instance {}: {}'.format(state, instance_id, e))
+            return 0, event_indexes
+
+    # the instances processed share one timestamp so that instances with the same fingerprint are tagged in one call
+    tag_values = dict()
+    timestamp = datetime.now(timezone.utc)
+    alarms_written = 0
+    with ThreadPoolExecutor(max_workers=scan_concurrency) as executor:
+        for instance_alarms_written, instance_failed in executor.map(process_instance, instance_ids):
+            alarms_written += instance_alarms_written
+            failed.extend(instance_failed)
+    try:
+        update_alarm_fingerprints(tag_values, create_alarm_tag, region, cross_account_id)
+    except Exception as e:
+        # the alarms are written, the next scan processes the instances again
+        logger.error('Failure tagging instances in account {} region {}: {}'.format(account_id, region, e))
+    return alarms_written, failed
+
+
+def process_event_batch(events, context):
+    """
+    Processes a batch of events.  EC2 instance state change events are coalesced per instance and processed in
+    (account, region) groups, every other event is handled on its own.  Returns a summary and the sorted indexes of
+    the events that failed.
+    """
+    concurrency_controller.reset(scan_concurrency)
+    groups = coalesce_instance_state_events(events)
+    summary = {
+        'events': len(events),
+        'groups': len(groups),
+        'instances_started': sum(1 for instances in groups.values() for state, _ in instances.values() if
+                                 state == 'running'),
+        'instances_terminated': sum(1 for instances in groups.values() for state, _ in instances.values() if
+                                    state == 'terminated'),
+        'alarms_written': 0,
+        'events_failed': 0
+    }
+    structured_log.info('event_batch', events=summary['events'], groups=summary['groups'],
+                        instances_started=summary['instances_started'],
+                        instances_terminated=summary['instances_terminated'])
+    failed = list()
+    for index, event in enumerate(events):
+        if not is_instance_state_event(event):
+            try:
+                handle_event(event, context)
+            except Exception:
+                failed.append(index)
+    for (account_id, region), instances in groups.items():
+        alarms_written, group_failed = process_instance_state_group(account_id, region, instances)
+        summary['alarms_written'] += alarms_written
+        failed.extend(group_failed)
+    summary['events_failed'] = len(failed)
+    return summary, sorted(failed)
+
+
+def handle_sqs_batch(event, context):
+    """
+    Handles the messages delivered by an SQS event source mapping as one event batch, every message body is an event.
+    Returns the messages that failed as batch item failures, so only they are delivered again.
+    """
+    records = list()
+    events = list()
+    for record in event['Records']:
+        if record.get('eventSource', None) != 'aws:sqs':
+            continue
+        try:
+            events.append(json.loads(record['body']))
+        except ValueError as e:
+            # a malformed message can never succeed, drop it rather than have it delivered again
+            logger.error('Dropping malformed message {}: {}'.format(record.get('messageId', None), e))
+            continue
+        records.append(record)
+    summary, failed = process_event_batch(events, context)
+    structured_log.info('event_batch_summary', **summary)
+    return {'batchItemFailures': [{'itemIdentifier': records[index]['messageId']} for index in failed]}
+
+
+def handle_event_list(events, context):
+    """
+    Handles a list of EventBridge events as one event batch.  Raises an exception after processing the batch if any
+    event failed.
+    """
+    summary, failed = process_event_batch(events, context)
+    if failed:
+        raise Exception('{} of {} events failed'.format(len(failed), len(events)))
+    return summary
+
+
+def event_services(event):
+    """
+    Returns the AWS services the event makes calls to, roughly in the order of its first call to each.  A batch is
+    assumed to hold events of one kind, its first event decides.
+    """
+    if isinstance(event, list):
+        event = event[0] if event else dict()
+    elif 'Records' in event:
+        try:
+            event = json.loads(event['Records'][0]['body'])
+        except (IndexError, KeyError, ValueError):
+            return []
+
+    services = list()
+    action = event.get('action', None)
+    if action in ['scan', 'plan', 'apply-plan', 'collect-orphaned-alarms'] and org_mgmt_account_id:
+        services.extend(['sts', 'organizations'])
+    elif action == 'scan-shard' and event.get('account_id', None):
+        services.append('sts')
+    elif event.get('account', local_account_id) != local_account_id:
+        services.append('sts')
+
+    if action in ['scan', 'scan-shard', 'plan', 'apply-plan', 'scan-status'] and \
+            scan_state_store_url.startswith('s3://'):
+        services.append('s3')
+    if action == 'scan' and scan_shard_queue_url and scan_shard_queue_url != 'local':
+        services.append('sqs')
+    elif action in ['scan', 'scan-shard']:
+        services.extend(['ec2', 'cloudwatch'])
+        if 'lambda' in scan_resource_types:
+            services.append('resourcegroupstaggingapi')
+        if 'rds' in scan_resource_types:
+            services.append('rds')
+    elif action in ['plan', 'apply-plan']:
+        services.extend(['ec2', 'cloudwatch'])
+    elif action == 'collect-orphaned-alarms':
+        services.extend(['cloudwatch', 'ec2', 'lambda', 'rds'])
+        if asg_alarms_mode in ['dimension', 'metrics-insights']:
+            services.append('autoscaling')
+    elif event.get('source', None) == 'aws.ec2':
+        services.extend(['ec2', 'cloudwatch'])
+    elif event.get('source', None) in ['aws.lambda', 'aws.rds']:
+        services.append('cloudwatch')
+    return services
+
+
+def lambda_handler(event, context):
+    api_metrics.reset()
+    structured_log.reset()
+    if startup_mode == 'optimized':
+        region = (event.get('region', None) if isinstance(event, dict) else None) or \
+                 (target_regions[0] if target_regions else getenv('AWS_REGION', None))
+        preload_clients(event_services(event), region)
+    try:
+        if isinstance(event, list):
+            return handle_event_list(event, context)
+        if 'Records' in event:
+            return handle_sqs_batch(event, context)
+        return handle_event(event, context)
+    finally:
+        structured_log.summary()
+        if api_metrics_flag == 'true':
+            function_name = getattr(context, 'function_name', None) or getenv('AWS_LAMBDA_FUNCTION_NAME',
+                                                                               'CloudWatchAutoAlarms')
+            if isinstance(event, list):
+                trigger = 'batch'
+            elif 'Records' in event:
+                trigger = 'aws.sqs'
+            else:
+                trigger = event.get('action', None) or event.get('source', None) or 'unknown'
+            api_metrics.emit(api_metrics_namespace, {'FunctionName': function_name, 'Trigger': trigger})
+
+
+def handle_event(event, context):
+    logger.debug('event received: %s', event)
+    detail = event.get('detail', None) or dict()
+    structured_log.info('event', sample=True, source=event.get('source', None), action=event.get('action', None),
+                        account=event.get('account', None), region=event.get('region', None),
+                        instance_id=detail.get('instance-id', None), state=detail.get('state', None),
+                        event_name=detail.get('eventName', None))
     event_account_id = event.get('account', None)
     event_region = event.get('region', None)
     if not local_account_id:
@@ -192,14 +519,9 @@ def lambda_handler(event, context):
     else:
         cross_account_id = event_account_id
 
-    sns_topic_name = getenv('SNS_TOPIC_NAME')
-    sns_topic_account = getenv('SNS_TOPIC_ACCOUNT')
-
-    if not sns_topic_name or not sns_topic_account or not event_region:
-        logger.info("SNS_TOPIC_ACCOUNT and SNS_TOPIC_NAME environment variables not set, skipping notifications setup")
-        sns_topic_arn = None
-    else:
-        sns_topic_arn = f"arn:aws:sns:{event_region}:{sns_topic_account}:{sns_topic_name}"
+    sns_topic_arn = get_sns_topic_arn(event_region)
+    if not sns_topic_arn:
+        structured_log.info('notifications_disabled', 'SNS_TOPIC_ACCOUNT and SNS_TOPIC_NAME are not set')
 
 
     try:
@@ -217,17 +539,25 @@ def lambda_handler(event, context):
                 else:
                     target_sns_topic_arn = sns_topic_arn
 
-                default_filtered_alarms, wildcard_alarms = separate_wildcard_alarms(alarm_separator, cw_namespace, default_alarms)
-                process_alarm_tags(instance_id, instance_info, default_filtered_alarms, wildcard_alarms, metric_dimensions_map,
-                                   target_sns_topic_arn,
-                                   cw_namespace, create_default_alarms_flag, alarm_separator, alarm_identifier, event_region, cross_account_id)
+                _, complete = process_alarm_tags(instance_id, instance_info, default_filtered_alarms, wildcard_alarms, metric_dimensions_map,
+                                                 target_sns_topic_arn,
+                                                 cw_namespace, create_default_alarms_flag, alarm_separator, alarm_identifier, event_region, cross_account_id,
+                                                 reconcile_alarms_flag)
+                # the alarms of Auto Scaling group members are tracked per group, their tags are left alone.  An
+                # instance with alarms that failed to write keeps its old fingerprint so the next scan retries it
+                if complete and not uses_asg_alarms(instance_info):
+                    fingerprint = alarm_fingerprint(instance_info, default_filtered_alarms, wildcard_alarms,
+                                                    metric_dimensions_map, target_sns_topic_arn, cw_namespace,
+                                                    create_default_alarms_flag, alarm_separator, alarm_identifier)
+                    update_alarm_fingerprints({instance_id: fingerprint_tag_value(fingerprint)}, create_alarm_tag,
+                                              event_region, cross_account_id)
         elif 'source' in event and event['source'] == 'aws.ec2' and event['detail']['state'] == 'terminated':
             instance_id = event['detail']['instance-id']
             result = delete_alarms(instance_id, alarm_identifier, alarm_separator, event_region, cross_account_id)
         elif 'source' in event and event['source'] == 'aws.lambda' and event['detail'][
             'eventName'] == 'TagResource20170331v2':
-            logger.debug(
-                'Tag Lambda Function event occurred, tags are: {}'.format(event['detail']['requestParameters']['tags']))
+            logger.debug('Tag Lambda Function event occurred, tags are: %s',
+                         event['detail']['requestParameters']['tags'])
             tags = event['detail']['requestParameters']['tags']
 
             if 'notify' in tags.keys():
@@ -242,12 +572,11 @@ def lambda_handler(event, context):
         elif 'source' in event and event['source'] == 'aws.lambda' and event['detail'][
             'eventName'] == 'DeleteFunction20150331':
             function = event['detail']['requestParameters']['functionName']
-            logger.debug('Delete Lambda Function event occurred for: {}'.format(function))
+            logger.debug('Delete Lambda Function event occurred for: %s', function)
             delete_alarms(function, alarm_identifier, alarm_separator, event_region, cross_account_id)
         elif 'source' in event and event['source'] == 'aws.rds' and event['detail'].get('eventName',
                                                                                         None) == 'AddTagsToResource':
-            logger.info(
-                'Tag RDS event occurred, tags are: {}'.format(event['detail']['requestParameters']['tags']))
+            logger.debug('Tag RDS event occurred, tags are: %s', event['detail']['requestParameters']['tags'])
             tags = event['detail']['requestParameters']['tags']
 
             instance_sns_target = [tag['value'] for tag in tags if tag.get("key", None) == 'notify']
@@ -263,7 +592,7 @@ def lambda_handler(event, context):
             else:
                 is_cluster = False
 
-            logger.info('Tag DB event occurred for RDS: {}'.format(db_arn))
+            logger.debug('Tag DB event occurred for RDS: %s', db_arn)
             process_rds_alarms(db_arn, is_cluster, create_alarm_tag, default_alarms, target_sns_topic_arn,
                                alarm_separator,
                                alarm_identifier, tags, event_region, cross_account_id)
@@ -272,39 +601,105 @@ def lambda_handler(event, context):
             'detail'] and 'deletion' in event['detail']['EventCategories']:
             db_arn = event['detail']['SourceArn']
             db_id = db_arn.split(':')[-1]
-            logger.info('Delete DB Instance event occurred for RDS: {}'.format(db_id))
+            logger.debug('Delete DB Instance event occurred for RDS: %s', db_id)
             delete_alarms(db_id, alarm_identifier, alarm_separator, event_region, cross_account_id)
         elif 'action' in event and event['action'] == 'scan':
-            logger.debug(
-                f'Scanning for EC2 instances with tag: {create_alarm_tag} to create alarm'
-            )
+            logger.debug('Scanning for EC2 instances with tag: %s to create alarm', create_alarm_tag)
             # TODO:  Verify that target_sns_topic_arn is also considered for each instance if set
-            if org_mgmt_account_id:
-                accounts_by_ou = get_active_accounts_by_organizational_unit(target_org_units, org_mgmt_account_id)
-                for ou_id, accounts in accounts_by_ou.items():
-                    logger.info(f"Processing Organizational Unit (OU): {ou_id}")
-                    for account in accounts:
-                        account_id = account['AccountId']
-                        account_name = account['AccountName']
-                        logger.info(f"Processing account {account_id} ({account_name}) in OU {ou_id}")
-
-                        # Call scan_and_process_alarm_tags for the account
-                        for region in target_regions:
-                            region = region.strip()
-                            logger.info(f"Processing region {region}")
-                            # Call scan_and_process_alarm_tags for the account and region
-                            scan_and_process_alarm_tags(create_alarm_tag, default_alarms, metric_dimensions_map, sns_topic_arn,
-                                                        cw_namespace, create_default_alarms_flag, alarm_separator, alarm_identifier, region, account_id)
-            else:
-                # Call scan_and_process_alarm_tags for single account
-                for region in target_regions:
-                    logger.info(f"Processing region {region}")
-                    # Call scan_and_process_alarm_tags for the account and region
-                    scan_and_process_alarm_tags(create_alarm_tag, default_alarms, metric_dimensions_map, sns_topic_arn,
-                                                cw_namespace, create_default_alarms_flag, alarm_separator, alarm_identifier, region)
+            if scan_shard_queue_url:
+                return start_sharded_scan(get_scan_units(), get_scan_state_store(scan_state_store_url),
+                                          get_work_queue(scan_shard_queue_url), sharded_scan_max_age)
+
+            deadline = Deadline(context, scan_deadline_margin)
+            checkpoint = None
+            if scan_state_store_url:
+                store = get_scan_state_store(scan_state_store_url)
+                checkpoint = ScanCheckpoint.load(store, 'scan')
+                if event.get('scan_id', None) and event['scan_id'] != checkpoint.scan_id:
+                    if ScanCheckpoint.last_completed(store, 'scan') == event['scan_id']:
+                        structured_log.info('scan_already_complete', scan_id=event['scan_id'])
+                        return {'scan_id': event['scan_id'], 'complete': True}
+                    if checkpoint.resumed:
+                        logger.warning('Scan {} was replaced by scan {}, continuing that scan instead'.format(
+                            event['scan_id'], checkpoint.scan_id))
+                    else:
+                        logger.error('The checkpoint of scan {} was not found, starting the scan over as scan '
+                                     '{}'.format(event['scan_id'], checkpoint.scan_id))
+                if checkpoint.resumed and checkpoint.age() > scan_checkpoint_max_age:
+                    logger.warning('Scan {} started at {} is older than {} seconds, starting the scan over'.format(
+                        checkpoint.scan_id, checkpoint.state['StartedAt'], scan_checkpoint_max_age))
+                    checkpoint = ScanCheckpoint(store, 'scan')
+                if checkpoint.leased():
+                    structured_log.info('scan_in_progress', scan_id=checkpoint.scan_id)
+                    return {'scan_id': checkpoint.scan_id, 'complete': False}
+                if checkpoint.resumed:
+                    structured_log.info('scan_resumed', scan_id=checkpoint.scan_id,
+                                        started_at=checkpoint.state['StartedAt'])
+                remaining = deadline.remaining()
+                checkpoint.acquire_lease(remaining + scan_deadline_margin if remaining is not None else 900)
+
+            summary = scan_accounts_and_regions(get_scan_units(), create_alarm_tag, default_filtered_alarms,
+                                                wildcard_alarms, metric_dimensions_map,
+                                                sns_topic_arn, cw_namespace, create_default_alarms_flag,
+                                                alarm_separator, alarm_identifier, scan_concurrency,
+                                                reconcile_alarms_flag, checkpoint, deadline)
+            summary['complete'] = summary['units_interrupted'] == 0
+            if checkpoint:
+                summary['scan_id'] = checkpoint.scan_id
+                summary['totals'] = checkpoint.add_summary(summary)
+                if summary['complete']:
+                    checkpoint.complete()
+                else:
+                    checkpoint.release_lease()
+                    checkpoint.save()
+                    function_arn = getattr(context, 'invoked_function_arn', None)
+                    if scan_continuation_flag == 'true' and function_arn:
+                        invoke_scan_continuation(function_arn, checkpoint.scan_id)
+            structured_log.info('cache_stats', credentials_cache=credentials_cache.stats,
+                                client_pool=client_pool.stats, account_inventory=account_inventory_cache.stats)
+            return summary
+        elif 'action' in event and event['action'] == 'scan-shard':
+            store = get_scan_state_store(scan_state_store_url)
+            checkpoint = load_shard_checkpoint(store, event)
+            if checkpoint is None:
+                return {'scan_id': event['scan_id'], 'shard_id': event['shard_id'], 'complete': True, 'stale': True}
+            structured_log.info('scan_shard', scan_id=event['scan_id'], shard_id=event['shard_id'],
+                                account_id=event['account_id'] or 'local', region=event['region'])
+            summary = scan_accounts_and_regions([(event['organizational_unit_id'], event['account_id'],
+                                                  event['region'])], create_alarm_tag, default_filtered_alarms,
+                                                wildcard_alarms, metric_dimensions_map,
+                                                sns_topic_arn, cw_namespace, create_default_alarms_flag,
+                                                alarm_separator, alarm_identifier, 1,
+                                                reconcile_alarms_flag, checkpoint,
+                                                Deadline(context, scan_deadline_margin))
+            return finish_shard(store, get_work_queue(scan_shard_queue_url or 'local'), event, checkpoint, summary)
+        elif 'action' in event and event['action'] == 'collect-orphaned-alarms':
+            dry_run = str(event.get('dry_run', 'false')).lower() == 'true'
+            structured_log.info('orphaned_alarm_sweep_started', prefix=alarm_identifier + alarm_separator,
+                                dry_run=dry_run)
+            return collect_orphaned_alarms_in_accounts_and_regions(get_scan_units(), alarm_identifier,
+                                                                   alarm_separator, cw_namespace, scan_concurrency,
+                                                                   dry_run)
+        elif 'action' in event and event['action'] in ['plan', 'apply-plan']:
+            if not scan_state_store_url:
+                raise Exception('SCAN_STATE_STORE must be set to keep alarm plans')
+            return plan_accounts_and_regions(get_scan_units(), create_alarm_tag, default_filtered_alarms,
+                                             wildcard_alarms, metric_dimensions_map, sns_topic_arn, cw_namespace,
+                                             create_default_alarms_flag, alarm_separator, alarm_identifier,
+                                             get_scan_state_store(scan_state_store_url), scan_concurrency,
+                                             event['action'] == 'apply-plan')
+        elif 'action' in event and event['action'] == 'scan-status':
+            return sharded_scan_status(get_scan_state_store(scan_state_store_url))
 
     except Exception as e:
         # If any other exceptions which we didn't expect are raised
         # then fail the job and log the exception message.
         logger.error('Failure creating alarm: {}'.format(e))
         raise
+
+
+if startup_mode == 'eager':
+    # load the SDK and the models of every service the function uses during the init phase
+    for preloaded in preload_clients(['sts', 'organizations', 'ec2', 'cloudwatch', 'resourcegroupstaggingapi', 'rds',
+                                      'lambda'], getenv('AWS_REGION', None)):
+        preloaded.result()
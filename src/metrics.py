@@ -0,0 +1,288 @@
+import json
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+# upper bounds of the latency histogram buckets in milliseconds, the last bucket counts everything above 10 seconds
+latency_buckets_ms = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# error codes botocore treats as throttling
+throttling_error_codes = {'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                          'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+                          'TransactionInProgressException', 'RequestLimitExceeded', 'BandwidthLimitExceeded',
+                          'LimitExceededException', 'RequestThrottled', 'SlowDown', 'PriorRequestNotComplete',
+                          'EC2ThrottledException'}
+
+# client methods that are not API operations
+client_helper_methods = {'get_paginator', 'can_paginate', 'get_waiter', 'generate_presigned_url', 'close'}
+
+# CloudWatch accepts at most 100 metrics per EMF metric directive
+emf_max_metrics_per_directive = 100
+
+_snake_case_boundary = re.compile(r'_([a-z0-9])')
+
+
+def operation_name(method_name):
+    return _snake_case_boundary.sub(lambda match: match.group(1).upper(), '_' + method_name)
+
+
+def is_throttling_error(error_code):
+    return error_code in throttling_error_codes
+
+
+class ApiCallStats:
+    __slots__ = ('calls', 'errors', 'retries', 'throttles', 'latency_ms', 'latency_max_ms', 'latency_histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.latency_ms = 0.0
+        self.latency_max_ms = 0.0
+        self.latency_histogram = [0] * (len(latency_buckets_ms) + 1)
+
+    def as_dict(self):
+        histogram = dict()
+        for index, count in enumerate(self.latency_histogram):
+            if count:
+                if index < len(latency_buckets_ms):
+                    histogram['<={}'.format(latency_buckets_ms[index])] = count
+                else:
+                    histogram['>{}'.format(latency_buckets_ms[-1])] = count
+        return {
+            'Calls': self.calls,
+            'Errors': self.errors,
+            'Retries': self.retries,
+            'Throttles': self.throttles,
+            'LatencyMs': round(self.latency_ms, 1),
+            'LatencyMaxMs': round(self.latency_max_ms, 1),
+            'LatencyHistogramMs': histogram
+        }
+
+
+class ApiMetrics:
+    """
+    Thread-safe per-invocation counters of the AWS API calls made by the function, kept per (service, operation,
+    account, region) together with a latency histogram, and of the resources processed.  reset() is called at the start
+    of every invocation and emit() writes everything as one CloudWatch Embedded Metric Format (EMF) record at the end.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+        self._counters = dict()
+
+    def reset(self):
+        with self._lock:
+            self._calls = dict()
+            self._counters = dict()
+
+    def _stats(self, service, operation, account, region):
+        key = (service, operation, account, region)
+        stats = self._calls.get(key, None)
+        if stats is None:
+            stats = self._calls[key] = ApiCallStats()
+        return stats
+
+    def record_call(self, service, operation, account, region, latency_ms, retries=0, error_code=None,
+                    count_throttle=True):
+        with self._lock:
+            stats = self._stats(service, operation, account, region)
+            stats.calls += 1
+            stats.retries += retries
+            stats.latency_ms += latency_ms
+            stats.latency_max_ms = max(stats.latency_max_ms, latency_ms)
+            stats.latency_histogram[bisect_left(latency_buckets_ms, latency_ms)] += 1
+            if error_code:
+                stats.errors += 1
+                if count_throttle and is_throttling_error(error_code):
+                    stats.throttles += 1
+
+    def record_throttle(self, service, operation, account, region):
+        with self._lock:
+            self._stats(service, operation, account, region).throttles += 1
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        Returns a list of the API call statistics per service, operation, account and region and a dict of the
+        counters.
+        """
+        with self._lock:
+            calls = list()
+            for (service, operation, account, region), stats in sorted(self._calls.items()):
+                call = {'Service': service, 'Operation': operation, 'AccountId': account, 'Region': region}
+                call.update(stats.as_dict())
+                calls.append(call)
+            return calls, dict(self._counters)
+
+    def emf_record(self, namespace, dimensions, timestamp=None):
+        """
+        Returns the EMF record of the invocation.  Calls, errors, retries, throttles and latency are published as
+        metrics in total and per service and operation, the breakdown per account and region with the latency
+        histograms is included in the ApiCallBreakdown property for CloudWatch Logs Insights.
+        """
+        calls, counters = self.snapshot()
+        by_operation = dict()
+        for call in calls:
+            totals = by_operation.setdefault('{}.{}'.format(call['Service'], call['Operation']), {
+                'Calls': 0, 'Errors': 0, 'Retries': 0, 'Throttles': 0, 'Latency': 0.0, 'LatencyMax': 0.0})
+            for name in ['Calls', 'Errors', 'Retries', 'Throttles']:
+                totals[name] += call[name]
+            totals['Latency'] += call['LatencyMs']
+            totals['LatencyMax'] = max(totals['LatencyMax'], call['LatencyMaxMs'])
+
+        record = dict(dimensions)
+        metrics = list()
+
+        def add_metric(name, value, unit):
+            record[name] = value
+            metrics.append({'Name': name, 'Unit': unit})
+
+        for name in ['Calls', 'Errors', 'Retries', 'Throttles']:
+            add_metric('Api{}'.format(name), sum(totals[name] for totals in by_operation.values()), 'Count')
+        add_metric('ApiLatency', round(sum(totals['Latency'] for totals in by_operation.values()), 1), 'Milliseconds')
+        for name, value in sorted(counters.items()):
+            add_metric(name, value, 'Count')
+        for operation, totals in sorted(by_operation.items()):
+            for name in ['Calls', 'Errors', 'Retries', 'Throttles']:
+                add_metric('{}.{}'.format(operation, name), totals[name], 'Count')
+            add_metric('{}.Latency'.format(operation), round(totals['Latency'], 1), 'Milliseconds')
+            add_metric('{}.LatencyMax'.format(operation), round(totals['LatencyMax'], 1), 'Milliseconds')
+        record['ApiCallBreakdown'] = calls
+
+        directives = list()
+        for start in range(0, len(metrics), emf_max_metrics_per_directive):
+            directives.append({
+                'Namespace': namespace,
+                'Dimensions': [sorted(dimensions)],
+                'Metrics': metrics[start:start + emf_max_metrics_per_directive]
+            })
+        record['_aws'] = {
+            'Timestamp': int((timestamp or time.time()) * 1000),
+            'CloudWatchMetrics': directives
+        }
+        return record
+
+    def emit(self, namespace, dimensions, stream=None):
+        """
+        Writes the EMF record of the invocation to stdout, Lambda sends every line written to stdout to CloudWatch Logs
+        which extracts the metrics from it.
+        """
+        stream = stream or sys.stdout
+        stream.write(json.dumps(self.emf_record(namespace, dimensions), default=str) + '\n')
+        stream.flush()
+
+
+api_metrics = ApiMetrics()
+
+
+class InstrumentedClient:
+    """
+    Wraps a boto3 client and records every API call it makes, including the pages fetched by its paginators, in
+    api_metrics.  Throttled attempts that botocore retries internally are counted through its needs-retry event when
+    the client supports it, otherwise only calls failing with a throttling error are counted.
+    When given, every call first takes a token from rate_limiter, and throttles and successful calls are reported to
+    the concurrency controller.
+    """
+
+    def __init__(self, client, service, account, region, rate_limiter=None, concurrency=None):
+        self._client = client
+        self._service = service
+        self._account = account
+        self._region = region
+        self._rate_limiter = rate_limiter
+        self._concurrency = concurrency
+        self._methods = dict()
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        self._counts_attempts = events is not None
+        if self._counts_attempts:
+            events.register('needs-retry', self._on_needs_retry)
+
+    def _on_needs_retry(self, response=None, operation=None, **kwargs):
+        if response is not None and operation is not None:
+            error_code = response[1].get('Error', {}).get('Code', None)
+            if is_throttling_error(error_code):
+                api_metrics.record_throttle(self._service, operation.name, self._account, self._region)
+                if self._concurrency:
+                    self._concurrency.on_throttle()
+        return None
+
+    def _operation_name(self, method_name):
+        method_to_api = getattr(getattr(self._client, 'meta', None), 'method_to_api_mapping', None)
+        if method_to_api and method_name in method_to_api:
+            return method_to_api[method_name]
+        return operation_name(method_name)
+
+    def _call(self, operation, method, *args, **kwargs):
+        if self._rate_limiter:
+            self._rate_limiter.acquire(self._service, operation, self._account, self._region)
+        start = time.perf_counter()
+        try:
+            response = method(*args, **kwargs)
+        except StopIteration:
+            # a paginator ran out of pages, no API call was made
+            raise
+        except Exception as e:
+            # botocore ClientErrors carry the error response, it is looked up on the exception so that botocore is
+            # not imported before the first client is created
+            error_response = getattr(e, 'response', None)
+            if isinstance(error_response, dict) and 'Error' in error_response:
+                self._record(operation, start, error_response, error_response['Error'].get('Code', 'Unknown'))
+            else:
+                self._record(operation, start, None, type(e).__name__)
+            raise
+        self._record(operation, start, response)
+        return response
+
+    def _record(self, operation, start, response, error_code=None):
+        latency_ms = (time.perf_counter() - start) * 1000.0
+        retries = 0
+        if isinstance(response, dict):
+            retries = response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        api_metrics.record_call(self._service, operation, self._account, self._region, latency_ms, retries,
+                                error_code, count_throttle=not self._counts_attempts)
+        if self._concurrency:
+            if not error_code:
+                self._concurrency.on_success()
+            elif is_throttling_error(error_code) and not self._counts_attempts:
+                self._concurrency.on_throttle()
+
+    def get_paginator(self, method_name):
+        return InstrumentedPaginator(self, self._operation_name(method_name), self._client.get_paginator(method_name))
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name.startswith('_') or name in client_helper_methods or not callable(attribute):
+            return attribute
+        method = self._methods.get(name, None)
+        if method is None:
+            operation = self._operation_name(name)
+
+            def method(*args, **kwargs):
+                return self._call(operation, attribute, *args, **kwargs)
+
+            self._methods[name] = method
+        return method
+
+
+class InstrumentedPaginator:
+    def __init__(self, client, operation, paginator):
+        self._client = client
+        self._operation = operation
+        self._paginator = paginator
+
+    def paginate(self, **kwargs):
+        pages = iter(self._paginator.paginate(**kwargs))
+        while True:
+            try:
+                page = self._client._call(self._operation, next, pages)
+            except StopIteration:
+                return
+            yield page
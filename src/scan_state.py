@@ -0,0 +1,352 @@
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+
+class ScanInterrupted(Exception):
+    """
+    Raised by a scan worker that stopped before the Lambda deadline, its progress is kept in the scan checkpoint.
+    """
+
+    def __init__(self, alarms_written=0):
+        super().__init__('scan stopped before the Lambda deadline')
+        self.alarms_written = alarms_written
+
+
+class Deadline:
+    """
+    The point in time, margin seconds before the invocation times out, after which a scan stops processing resources.
+    A context without get_remaining_time_in_millis never reaches its deadline.
+    """
+
+    def __init__(self, context, margin):
+        remaining_millis = getattr(context, 'get_remaining_time_in_millis', None)
+        if remaining_millis:
+            self.expires_at = time.monotonic() + remaining_millis() / 1000.0 - margin
+        else:
+            self.expires_at = None
+
+    def reached(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.monotonic(), 0)
+
+
+class LocalFileStateStore:
+    """
+    Keeps scan state as JSON files in a local directory.  Lambda only preserves /tmp for the lifetime of an execution
+    environment, so this store is meant for testing and single container deployments.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, '{}.json'.format(key))
+
+    def load(self, key):
+        try:
+            with open(self._path(key)) as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, state):
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = '{}.{}.tmp'.format(self._path(key), uuid.uuid4().hex)
+        with open(temporary_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(temporary_path, self._path(key))
+
+    def save_if_absent(self, key, state):
+        """
+        Saves the state only if the key does not exist yet, atomically.  Returns True if the state was saved.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = '{}.{}.tmp'.format(self._path(key), uuid.uuid4().hex)
+        with open(temporary_path, 'w') as state_file:
+            json.dump(state, state_file)
+        try:
+            # link fails if the key exists, unlike replace
+            os.link(temporary_path, self._path(key))
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temporary_path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def save_lines(self, key, lines):
+        """
+        Writes an iterable of text lines, e.g. an NDJSON document, without holding it in memory.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, key)
+        temporary_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(temporary_path, 'w') as lines_file:
+            lines_file.writelines(lines)
+        os.replace(temporary_path, path)
+
+    def load_lines(self, key):
+        """
+        Yields the lines written by save_lines, nothing if there are none.
+        """
+        try:
+            lines_file = open(os.path.join(self.directory, key))
+        except FileNotFoundError:
+            return
+        with lines_file:
+            for line in lines_file:
+                yield line
+
+    def list(self, prefix):
+        """
+        Returns the keys starting with prefix.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [name[:-len('.json')] for name in names if name.startswith(prefix) and name.endswith('.json')]
+
+
+class S3StateStore:
+    """
+    Keeps scan state as JSON objects in an S3 bucket under prefix.
+    """
+
+    def __init__(self, s3_client, bucket, prefix=''):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _key(self, key):
+        return '{}{}.json'.format(self.prefix, key)
+
+    def load(self, key):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read())
+
+    def save(self, key, state):
+        self.s3_client.put_object(Bucket=self.bucket, Key=self._key(key), Body=json.dumps(state).encode('utf-8'),
+                                  ContentType='application/json')
+
+    def save_if_absent(self, key, state):
+        """
+        Saves the state only if the key does not exist yet, with a conditional put.  Returns True if the state was
+        saved.
+        """
+        try:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self._key(key), Body=json.dumps(state).encode('utf-8'),
+                                      ContentType='application/json', IfNoneMatch='*')
+            return True
+        except Exception as e:
+            # the error code is looked up on the exception so that botocore is not imported here
+            error_response = getattr(e, 'response', None)
+            if isinstance(error_response, dict) and error_response.get('Error', {}).get('Code', None) in \
+                    ['PreconditionFailed', 'ConditionalRequestConflict']:
+                return False
+            raise
+
+    def delete(self, key):
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def save_lines(self, key, lines):
+        """
+        Writes an iterable of text lines, e.g. an NDJSON document, as one object.
+        """
+        self.s3_client.put_object(Bucket=self.bucket, Key='{}{}'.format(self.prefix, key),
+                                  Body=''.join(lines).encode('utf-8'), ContentType='application/x-ndjson')
+
+    def load_lines(self, key):
+        """
+        Yields the lines written by save_lines as they are downloaded, nothing if there are none.
+        """
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key='{}{}'.format(self.prefix, key))
+        except self.s3_client.exceptions.NoSuchKey:
+            return
+        for line in response['Body'].iter_lines():
+            yield line
+
+    def list(self, prefix):
+        """
+        Returns the keys starting with prefix.
+        """
+        keys = list()
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix)[:-len('.json')]):
+            for s3_object in page.get('Contents', []):
+                keys.append(s3_object['Key'][len(self.prefix):-len('.json')])
+        return keys
+
+
+def unit_key(account_id, region):
+    return '{}/{}'.format(account_id or 'local', region)
+
+
+def completed_key(key):
+    return '{}-completed'.format(key)
+
+
+class ScanCheckpoint:
+    """
+    Progress of a scan that spans several invocations: the (account, region) units that are finished, the units that
+    failed in their last attempt, a cursor of (organizational unit, account, region, pagination token) for every unit
+    in progress together with the instances already processed on that page, and the summary accumulated so far.
+    Thread-safe, save() writes it to the store.
+    """
+
+    def __init__(self, store, key, state=None):
+        self.store = store
+        self.key = key
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self.state = state or {
+            'ScanId': uuid.uuid4().hex,
+            'StartedAt': datetime.now(timezone.utc).isoformat(),
+            'Invocations': 0,
+            'LeaseExpiresAt': 0,
+            'Completed': [],
+            'Failed': {},
+            'Cursors': {},
+            'Summary': {'units_processed': 0, 'units_failed': 0, 'alarms_written': 0, 'failures': []}
+        }
+        self.state.setdefault('Failed', {})
+        self._completed = set(self.state['Completed'])
+
+    @classmethod
+    def load(cls, store, key):
+        return cls(store, key, store.load(key))
+
+    @property
+    def scan_id(self):
+        return self.state['ScanId']
+
+    @property
+    def resumed(self):
+        return self.state['Invocations'] > 0
+
+    def age(self):
+        """
+        Returns the number of seconds since the scan started.
+        """
+        return time.time() - datetime.fromisoformat(self.state['StartedAt']).timestamp()
+
+    def leased(self):
+        """
+        Returns True while another invocation is working on the scan.
+        """
+        return self.state['LeaseExpiresAt'] > time.time()
+
+    def acquire_lease(self, seconds):
+        with self._lock:
+            self.state['Invocations'] += 1
+            self.state['LeaseExpiresAt'] = time.time() + seconds
+        self.save()
+
+    def release_lease(self):
+        with self._lock:
+            self.state['LeaseExpiresAt'] = 0
+
+    def is_complete(self, account_id, region):
+        with self._lock:
+            return unit_key(account_id, region) in self._completed
+
+    def cursor(self, account_id, region):
+        with self._lock:
+            cursor = self.state['Cursors'].get(unit_key(account_id, region), None)
+            return dict(cursor) if cursor else None
+
+    def start_page(self, organizational_unit_id, account_id, region, next_token):
+        """
+        Moves the cursor of the unit to the page fetched with next_token, the processed instances are kept when the
+        cursor already points at that page.
+        """
+        key = unit_key(account_id, region)
+        with self._lock:
+            cursor = self.state['Cursors'].get(key, None)
+            if cursor and cursor['NextToken'] == next_token:
+                return
+            self.state['Cursors'][key] = {
+                'OrganizationalUnitId': organizational_unit_id,
+                'AccountId': account_id,
+                'Region': region,
+                'NextToken': next_token,
+                'ProcessedInstanceIds': []
+            }
+
+    def instance_processed(self, account_id, region, instance_id):
+        with self._lock:
+            self.state['Cursors'][unit_key(account_id, region)]['ProcessedInstanceIds'].append(instance_id)
+
+    def complete_unit(self, account_id, region):
+        key = unit_key(account_id, region)
+        with self._lock:
+            self.state['Cursors'].pop(key, None)
+            self.state['Failed'].pop(key, None)
+            if key not in self._completed:
+                self._completed.add(key)
+                self.state['Completed'].append(key)
+
+    def fail_unit(self, account_id, region, failure):
+        """
+        Records the failure of the unit.  The unit stays pending, so a continuation of the scan retries it from its
+        cursor.
+        """
+        with self._lock:
+            self.state['Failed'][unit_key(account_id, region)] = failure
+
+    def add_summary(self, summary):
+        """
+        Adds the summary of an invocation to the totals of the scan and returns the totals.  The failures of the
+        totals are those of the units whose last attempt failed.
+        """
+        with self._lock:
+            totals = self.state['Summary']
+            for name in ['units_processed', 'alarms_written']:
+                totals[name] += summary[name]
+            totals['failures'] = list(self.state['Failed'].values())
+            totals['units_failed'] = len(totals['failures'])
+            return dict(totals)
+
+    def save(self):
+        # serialize saves so an older snapshot never overwrites a newer one
+        with self._save_lock:
+            with self._lock:
+                state = json.loads(json.dumps(self.state))
+            self.store.save(self.key, state)
+
+    def finish(self):
+        self.store.delete(self.key)
+
+    def complete(self):
+        """
+        Finishes the scan and records it as the last completed scan of the key, so that a continuation that arrives
+        after the scan completed is recognized.
+        """
+        self.store.save(completed_key(self.key), {'ScanId': self.scan_id,
+                                                  'CompletedAt': datetime.now(timezone.utc).isoformat()})
+        self.finish()
+
+    @staticmethod
+    def last_completed(store, key):
+        """
+        Returns the ScanId of the last scan of the key that completed, or None.
+        """
+        completed = store.load(completed_key(key))
+        return completed['ScanId'] if completed else None
@@ -0,0 +1,158 @@
+import logging
+import time
+import uuid
+from datetime import datetime, timezone
+
+from scan_state import ScanCheckpoint
+from structured_log import structured_log
+
+logger = logging.getLogger()
+
+# the manifest of the current sharded scan, shards keep their checkpoint and completion marker next to it
+manifest_key = 'sharded-scan'
+
+
+def shard_checkpoint_key(scan_id, shard_id):
+    return 'shard-{}-{}'.format(scan_id, shard_id)
+
+
+def shard_done_prefix(scan_id):
+    return 'shard-done-{}-'.format(scan_id)
+
+
+def scan_completion_key(scan_id):
+    return 'sharded-scan-completion-{}'.format(scan_id)
+
+
+def start_sharded_scan(scan_units, store, queue, max_age):
+    """
+    Starts a sharded scan: writes its manifest to the state store and enqueues one scan-shard work item per
+    (organizational_unit_id, account_id, region) unit.  A scan that is still running and younger than max_age seconds
+    is left to finish instead.  Returns the status of the scan.
+    """
+    manifest = store.load(manifest_key)
+    if manifest and manifest['Status'] == 'running' and time.time() - manifest['StartedAtEpoch'] < max_age:
+        structured_log.info('sharded_scan_running', 'not starting a new scan', scan_id=manifest['ScanId'],
+                            started_at=manifest['StartedAt'])
+        return sharded_scan_status(store)
+    if manifest:
+        store.delete(scan_completion_key(manifest['ScanId']))
+
+    scan_id = uuid.uuid4().hex
+    shards = [{
+        'action': 'scan-shard',
+        'scan_id': scan_id,
+        'shard_id': shard_id,
+        'organizational_unit_id': organizational_unit_id,
+        'account_id': account_id,
+        'region': region
+    } for shard_id, (organizational_unit_id, account_id, region) in enumerate(scan_units)]
+    now = datetime.now(timezone.utc)
+    store.save(manifest_key, {
+        'ScanId': scan_id,
+        'StartedAt': now.isoformat(),
+        'StartedAtEpoch': now.timestamp(),
+        'Status': 'running' if shards else 'complete',
+        'Shards': len(shards),
+        'Summary': None if shards else {'units_processed': 0, 'units_failed': 0, 'alarms_written': 0, 'failures': []}
+    })
+    queue.send(shards)
+    structured_log.info('sharded_scan_started', scan_id=scan_id, shards=len(shards))
+    return sharded_scan_status(store)
+
+
+def load_shard_checkpoint(store, shard):
+    """
+    Returns the checkpoint of the shard, or None if the shard belongs to a scan that is no longer current.
+    """
+    manifest = store.load(manifest_key)
+    if not manifest or manifest['ScanId'] != shard['scan_id'] or manifest['Status'] != 'running':
+        structured_log.info('shard_skipped', 'stale', sample=True, scan_id=shard['scan_id'],
+                            shard_id=shard['shard_id'])
+        return None
+    if store.load('{}{}'.format(shard_done_prefix(shard['scan_id']), shard['shard_id'])):
+        structured_log.info('shard_skipped', 'already done', sample=True, scan_id=shard['scan_id'],
+                            shard_id=shard['shard_id'])
+        return None
+    return ScanCheckpoint.load(store, shard_checkpoint_key(shard['scan_id'], shard['shard_id']))
+
+
+def finish_shard(store, queue, shard, checkpoint, summary):
+    """
+    Records the result of a shard invocation.  An interrupted shard saves its checkpoint and enqueues itself again
+    to continue, a finished shard writes its done marker.  Shards finishing at the same time can all see every done
+    marker, only the one that creates the completion marker of the scan completes it.  Returns the result of the
+    shard.
+    """
+    totals = checkpoint.add_summary(summary)
+    result = {'scan_id': shard['scan_id'], 'shard_id': shard['shard_id'], 'complete': not summary['units_interrupted'],
+              'totals': totals}
+    if summary['units_interrupted']:
+        checkpoint.save()
+        queue.send([shard])
+        structured_log.info('shard_interrupted', 'enqueued to continue', scan_id=shard['scan_id'],
+                            shard_id=shard['shard_id'])
+        return result
+
+    store.save('{}{}'.format(shard_done_prefix(shard['scan_id']), shard['shard_id']), {'Summary': totals})
+    checkpoint.finish()
+    manifest = store.load(manifest_key)
+    if manifest and manifest['ScanId'] == shard['scan_id'] and manifest['Status'] == 'running' and \
+            len(store.list(shard_done_prefix(shard['scan_id']))) >= manifest['Shards']:
+        if store.save_if_absent(scan_completion_key(shard['scan_id']), {'ShardId': shard['shard_id']}):
+            result['scan'] = complete_sharded_scan(store, manifest)
+        else:
+            structured_log.info('sharded_scan_completed_elsewhere', scan_id=shard['scan_id'],
+                                shard_id=shard['shard_id'])
+    return result
+
+
+def complete_sharded_scan(store, manifest):
+    """
+    Aggregates the summaries of all shards into the manifest, marks the scan complete and reports it.  Only called
+    by the shard that created the completion marker of the scan.
+    """
+    if manifest['Status'] == 'complete':
+        return sharded_scan_status(store)
+    summary = {'units_processed': 0, 'units_failed': 0, 'alarms_written': 0, 'failures': []}
+    done_keys = store.list(shard_done_prefix(manifest['ScanId']))
+    for key in done_keys:
+        done = store.load(key)
+        if not done:
+            logger.warning('Done marker {} of sharded scan {} disappeared, its shard is left out of the summary'
+                           .format(key, manifest['ScanId']))
+            continue
+        shard_summary = done['Summary']
+        for name in ['units_processed', 'units_failed', 'alarms_written']:
+            summary[name] += shard_summary[name]
+        summary['failures'].extend(shard_summary['failures'])
+    manifest['Status'] = 'complete'
+    manifest['CompletedAt'] = datetime.now(timezone.utc).isoformat()
+    manifest['Summary'] = summary
+    store.save(manifest_key, manifest)
+    for key in done_keys:
+        store.delete(key)
+    structured_log.info('sharded_scan_complete', scan_id=manifest['ScanId'], shards=manifest['Shards'], **summary)
+    return sharded_scan_status(store)
+
+
+def sharded_scan_status(store):
+    """
+    Returns the progress of the current sharded scan, or None if no sharded scan was started.
+    """
+    manifest = store.load(manifest_key)
+    if not manifest:
+        return None
+    status = {
+        'scan_id': manifest['ScanId'],
+        'status': manifest['Status'],
+        'started_at': manifest['StartedAt'],
+        'shards': manifest['Shards'],
+    }
+    if manifest['Status'] == 'complete':
+        status['shards_done'] = manifest['Shards']
+        status['completed_at'] = manifest.get('CompletedAt', manifest['StartedAt'])
+        status['summary'] = manifest['Summary']
+    else:
+        status['shards_done'] = len(store.list(shard_done_prefix(manifest['ScanId'])))
+    return status
@@ -0,0 +1,150 @@
+import json
+import logging
+import threading
+import time
+from os import getenv
+
+# Structured records are written as one JSON object per log line.  An invocation writes at most LOG_BYTE_BUDGET bytes
+# of INFO and DEBUG records, 0 disables the budget, warnings and errors are always written.  Sampled records, the
+# repetitive per-alarm messages, are written for the first LOG_SAMPLE_FIRST occurrences of each kind in an invocation
+# and for every LOG_SAMPLE_EVERY-th occurrence after that, 0 writes none after the first.  What was left out is
+# reported in a summary record at the end of the invocation.
+log_byte_budget = int(getenv("LOG_BYTE_BUDGET", "1048576"))
+log_sample_first = int(getenv("LOG_SAMPLE_FIRST", "10"))
+log_sample_every = int(getenv("LOG_SAMPLE_EVERY", "100"))
+
+
+class StructuredLog:
+    """
+    Thread-safe per-invocation structured logger.  Records are only built and serialized when the level is enabled and
+    the record passes sampling and the byte budget, field values may be callables that are called at that point so
+    that expensive payloads are never formatted for records that are not written.  reset() is called at the start of
+    every invocation and summary() writes what was suppressed at the end.
+    """
+
+    def __init__(self, logger, byte_budget=0, sample_first=0, sample_every=0):
+        self.logger = logger
+        self.byte_budget = byte_budget
+        self.sample_first = sample_first
+        self.sample_every = sample_every
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._occurrences = dict()
+            self._bytes_written = 0
+            self._records_written = 0
+            self._sampled_out = dict()
+            self._over_budget = dict()
+
+    def _sampled(self, kind):
+        """
+        Counts an occurrence of a sampled kind and returns True if the record is to be written.
+        """
+        with self._lock:
+            occurrence = self._occurrences.get(kind, 0) + 1
+            self._occurrences[kind] = occurrence
+            if occurrence <= self.sample_first or \
+                    (self.sample_every > 0 and (occurrence - self.sample_first) % self.sample_every == 0):
+                return True
+            self._sampled_out[kind] = self._sampled_out.get(kind, 0) + 1
+            return False
+
+    def log(self, level, kind, message=None, sample=False, **fields):
+        """
+        Writes a record {"kind": kind, "message": message, <fields>} at level.  With sample, the record is subject to
+        sampling by kind.  Callable field values are called to obtain the value, fields that are None are left out.
+        Returns True if the record was written.
+        """
+        if not self.logger.isEnabledFor(level):
+            return False
+        if sample and level < logging.WARNING and not self._sampled(kind):
+            return False
+        record = {'kind': kind}
+        if message is not None:
+            record['message'] = message
+        for name, value in fields.items():
+            if callable(value):
+                value = value()
+            if value is not None:
+                record[name] = value
+        line = json.dumps(record, separators=(',', ':'), default=str)
+        with self._lock:
+            if level < logging.WARNING and 0 < self.byte_budget < self._bytes_written + len(line):
+                self._over_budget[kind] = self._over_budget.get(kind, 0) + 1
+                return False
+            self._bytes_written += len(line)
+            self._records_written += 1
+        self.logger.log(level, line)
+        return True
+
+    def debug(self, kind, message=None, **fields):
+        return self.log(logging.DEBUG, kind, message, **fields)
+
+    def info(self, kind, message=None, **fields):
+        return self.log(logging.INFO, kind, message, **fields)
+
+    def warning(self, kind, message=None, **fields):
+        return self.log(logging.WARNING, kind, message, **fields)
+
+    def error(self, kind, message=None, **fields):
+        return self.log(logging.ERROR, kind, message, **fields)
+
+    def resource(self, resource_type, resource_id, **fields):
+        """
+        Returns a ResourceRecord that collects the steps of processing one resource and writes them as one record.
+        """
+        return ResourceRecord(self, resource_type, resource_id, fields)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'records_written': self._records_written,
+                'bytes_written': self._bytes_written,
+                'sampled_out': dict(self._sampled_out),
+                'over_budget': dict(self._over_budget)
+            }
+
+    def summary(self):
+        """
+        Writes a summary record of the records that were sampled out or over the byte budget, if there were any, and
+        returns the statistics of the invocation.  The summary itself is not subject to the budget.
+        """
+        stats = self.stats()
+        if stats['sampled_out'] or stats['over_budget']:
+            self.logger.warning(json.dumps(dict(stats, kind='log_summary',
+                                                message='log records were suppressed in this invocation'),
+                                           separators=(',', ':'), sort_keys=True))
+        return stats
+
+
+class ResourceRecord:
+    """
+    The fields of one resource, e.g. an EC2 instance, collected while it is processed and written as a single record
+    of kind 'resource' when the with block exits, together with the processing time and any error.
+    """
+
+    def __init__(self, structured_log, resource_type, resource_id, fields):
+        self.structured_log = structured_log
+        self.fields = dict(fields, resource_type=resource_type, resource_id=resource_id)
+        self.start = None
+
+    def add(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.fields['duration_ms'] = round((time.perf_counter() - self.start) * 1000.0, 1)
+        if exc_value is not None:
+            self.fields['error'] = str(exc_value)
+            self.structured_log.error('resource', **self.fields)
+        else:
+            self.structured_log.info('resource', **self.fields)
+        return False
+
+
+structured_log = StructuredLog(logging.getLogger(), log_byte_budget, log_sample_first, log_sample_every)
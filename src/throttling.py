@@ -0,0 +1,146 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+def api_family(service, operation):
+    """
+    Returns the API family an operation is rate limited under.  EC2 Describe* operations share one family, as they
+    share one request token bucket in EC2, other operations are limited individually.
+    """
+    if service == 'ec2' and operation.startswith('Describe'):
+        return 'ec2:Describe*'
+    if service == 'sts':
+        return 'sts'
+    return '{}:{}'.format(service, operation)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at rate tokens per second up to burst tokens.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """
+        Takes a token and returns 0, or reserves the next token and returns the number of seconds to wait for it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a token is available and returns the number of seconds waited.
+        """
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiter:
+    """
+    Client-side rate limits per (account, region, API family), shared by every worker thread of the container.
+    rates maps an API family to the requests per second allowed in each account and region, families without a rate
+    or with a rate of 0 are not limited.
+    """
+
+    def __init__(self, rates):
+        self.rates = dict((family, float(rate)) for family, rate in rates.items() if float(rate) > 0)
+        self.waited = 0.0
+        self._buckets = dict()
+        self._lock = threading.Lock()
+
+    def acquire(self, service, operation, account, region):
+        family = api_family(service, operation)
+        rate = self.rates.get(family, None)
+        if rate is None:
+            return 0
+        key = (account, region, family)
+        bucket = self._buckets.get(key, None)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(key, TokenBucket(rate))
+        wait = bucket.acquire()
+        if wait:
+            with self._lock:
+                self.waited += wait
+        return wait
+
+
+class AdaptiveConcurrency:
+    """
+    Additive increase, multiplicative decrease (AIMD) limit on the number of workers processing resources at the same
+    time.  Every throttled API call cuts the limit by decrease_factor, at most once per cooldown seconds so that a burst
+    of throttles counts once, and every successful call raises it by 1 / limit, about one worker per round of calls,
+    back up to max_limit.
+    """
+
+    def __init__(self, max_limit, min_limit=1, decrease_factor=0.5, cooldown=1.0):
+        self.min_limit = min_limit
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self.reset(max_limit)
+
+    def reset(self, max_limit):
+        """
+        Restores the limit to max_limit and clears the statistics.  Slots held by workers of an earlier run stay
+        counted until they are released.
+        """
+        with self._condition:
+            self.max_limit = max(max_limit, self.min_limit)
+            self.limit = float(self.max_limit)
+            self.lowest_limit = self.limit
+            self.decreases = 0
+            self._decreased_at = 0.0
+            self._condition.notify_all()
+
+    def on_success(self):
+        with self._condition:
+            if self.limit < self.max_limit:
+                previous = int(self.limit)
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+                if int(self.limit) > previous:
+                    self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            now = time.monotonic()
+            if now - self._decreased_at < self.cooldown:
+                return
+            self._decreased_at = now
+            self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+            self.lowest_limit = min(self.lowest_limit, self.limit)
+            self.decreases += 1
+
+    @contextmanager
+    def slot(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {'limit': int(self.limit), 'max_limit': self.max_limit, 'lowest_limit': int(self.lowest_limit),
+                    'decreases': self.decreases}
@@ -0,0 +1,71 @@
+import json
+import threading
+import uuid
+from collections import deque
+
+# SQS accepts at most 10 messages per SendMessageBatch and ReceiveMessage call
+sqs_max_batch_size = 10
+
+
+class LocalWorkQueue:
+    """
+    In-memory FIFO work queue with the same interface as SqsWorkQueue, for tests and local runs.  Received messages
+    are not redelivered.
+    """
+
+    def __init__(self):
+        self._messages = deque()
+        self._lock = threading.Lock()
+
+    def send(self, messages):
+        with self._lock:
+            self._messages.extend(json.dumps(message) for message in messages)
+
+    def receive(self, max_messages=sqs_max_batch_size):
+        """
+        Returns up to max_messages (receipt handle, message) tuples.
+        """
+        with self._lock:
+            received = list()
+            while self._messages and len(received) < max_messages:
+                received.append((uuid.uuid4().hex, json.loads(self._messages.popleft())))
+            return received
+
+    def delete(self, receipt_handle):
+        pass
+
+    def __len__(self):
+        with self._lock:
+            return len(self._messages)
+
+
+class SqsWorkQueue:
+    """
+    Work queue backed by an Amazon SQS queue, messages are JSON documents.  In production the queue is consumed by
+    the SQS event source mapping of the function rather than by receive().
+    """
+
+    def __init__(self, sqs_client, queue_url):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+
+    def send(self, messages):
+        messages = list(messages)
+        for index in range(0, len(messages), sqs_max_batch_size):
+            batch = messages[index:index + sqs_max_batch_size]
+            response = self.sqs_client.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(entry), 'MessageBody': json.dumps(message)} for entry, message in
+                         enumerate(batch)]
+            )
+            if response.get('Failed', None):
+                raise RuntimeError('Failed to send {} messages to {}: {}'.format(
+                    len(response['Failed']), self.queue_url, response['Failed'][0].get('Message', '')))
+
+    def receive(self, max_messages=sqs_max_batch_size):
+        response = self.sqs_client.receive_message(QueueUrl=self.queue_url,
+                                                   MaxNumberOfMessages=min(max_messages, sqs_max_batch_size))
+        return [(message['ReceiptHandle'], json.loads(message['Body'])) for message in response.get('Messages', [])]
+
+    def delete(self, receipt_handle):
+        self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt_handle)
@@ -0,0 +1,81 @@
+"""
+Fixtures that run the Lambda function against the in-process AWS stand-in of the benchmarks.
+
+The function reads its configuration and builds its caches at import time, so every test imports it afresh with its
+own environment through the load_function fixture.
+"""
+import importlib
+import os
+import sys
+
+import boto3
+import pytest
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(tests_dir), 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(tests_dir), 'benchmarks'))
+
+import fake_aws  # noqa: E402
+
+function_modules = ['cw_auto_alarms', 'actions', 'alarm_engine', 'alarm_index', 'alarm_plan', 'alarm_spec', 'cache',
+                    'metrics', 'scan_state', 'sharded_scan', 'structured_log', 'throttling', 'work_queue']
+
+
+def unload_function():
+    for name in function_modules:
+        sys.modules.pop(name, None)
+
+
+@pytest.fixture
+def load_function(monkeypatch, tmp_path):
+    """
+    Returns load(aws, **environment), which installs the FakeAws aws and imports cw_auto_alarms with the Lambda
+    environment variables of the benchmarks updated with environment.
+    """
+
+    def load(aws, **environment):
+        monkeypatch.setattr(boto3, 'client', aws.client)
+        lambda_environment = {
+            'LOCAL_ACCOUNT_ID': fake_aws.LOCAL_ACCOUNT_ID,
+            'TARGET_REGIONS': ','.join(aws.regions),
+            'ALARM_TAG': fake_aws.ALARM_TAG,
+            'AWS_REGION': aws.regions[0],
+            'SCAN_STATE_STORE': 'file://' + str(tmp_path / 'scan-state'),
+            'API_METRICS': 'false',
+            'PUT_METRIC_ALARM_RATE_LIMIT': '0',
+            'DESCRIBE_ALARMS_RATE_LIMIT': '0',
+            'EC2_DESCRIBE_RATE_LIMIT': '0',
+            'STS_RATE_LIMIT': '0',
+        }
+        if len(aws.account_ids) > 1:
+            lambda_environment['ORG_MGMT_ACCOUNT'] = fake_aws.MANAGEMENT_ACCOUNT_ID
+            lambda_environment['TARGET_ORG_UNITS'] = fake_aws.ORGANIZATIONAL_UNIT_ID
+        lambda_environment.update(environment)
+        for name, value in lambda_environment.items():
+            monkeypatch.setenv(name, value)
+        unload_function()
+        return importlib.import_module('cw_auto_alarms')
+
+    yield load
+    unload_function()
+
+
+def failing_put_metric_alarm(should_fail):
+    """
+    Returns a put_metric_alarm for the fake CloudWatch client that fails for the alarms should_fail(alarm) is true
+    for and writes the others.
+    """
+    put_metric_alarm = fake_aws.CloudWatchClient.put_metric_alarm
+
+    def put_or_fail(self, **alarm):
+        if should_fail(alarm):
+            self.record('put_metric_alarm')
+            raise fake_aws.ClientError({'Error': {'Code': 'InternalFailure', 'Message': 'injected failure'}},
+                                       'PutMetricAlarm')
+        return put_metric_alarm(self, **alarm)
+
+    return put_or_fail
+
+
+def fingerprint_tag(instance):
+    return [tag['Value'] for tag in instance['Tags'] if tag['Key'] == fake_aws.ALARM_TAG][0]
@@ -0,0 +1,77 @@
+import fake_aws
+
+
+def terminated_event(instance_id, region):
+    return {'source': 'aws.ec2', 'detail-type': 'EC2 Instance State-change Notification',
+            'account': fake_aws.LOCAL_ACCOUNT_ID, 'region': region,
+            'detail': {'instance-id': instance_id, 'state': 'terminated'}}
+
+
+def instance_with_alarms(aws):
+    unit = aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0])
+    for instance_id in unit.instances:
+        if unit.alarm_names('AutoAlarm-{}-'.format(instance_id)):
+            return instance_id
+    raise AssertionError('no instance has alarms')
+
+
+def test_delete_removes_alarms_missing_from_index(load_function, tmp_path):
+    aws = fake_aws.FakeAws(instances=20, asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2', RECONCILE_ALARMS='true',
+                                   ALARM_INDEX=str(tmp_path / 'index.sqlite3'))
+    cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    unit = aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0])
+    instance_id = instance_with_alarms(aws)
+    # written by another execution environment, this one's index does not know it
+    aws.client('cloudwatch', aws.regions[0]).put_metric_alarm(
+        AlarmName='AutoAlarm-{}-AWS/EC2-StatusCheckFailed-GreaterThanThreshold-0-5m-2p-Maximum-extra'.format(
+            instance_id), Namespace='AWS/EC2', MetricName='StatusCheckFailed')
+    assert len(unit.alarm_names('AutoAlarm-{}-'.format(instance_id))) > 1
+
+    cw_auto_alarms.lambda_handler(terminated_event(instance_id, aws.regions[0]), None)
+    assert unit.alarm_names('AutoAlarm-{}-'.format(instance_id)) == []
+
+
+def test_reconciling_scan_refreshes_index_before_skipping_writes(load_function, tmp_path):
+    aws = fake_aws.FakeAws(instances=20, asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2', RECONCILE_ALARMS='true',
+                                   SKIP_UNCHANGED_RESOURCES='false', ALARM_INDEX=str(tmp_path / 'index.sqlite3'))
+    cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    unit = aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0])
+    instance_id = instance_with_alarms(aws)
+    deleted_alarm = unit.alarm_names('AutoAlarm-{}-'.format(instance_id))[0]
+    # deleted outside of this execution environment, its index still has the alarm
+    unit.delete_alarm(deleted_alarm)
+
+    aws.calls.clear()
+    summary = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert summary['alarms_written'] == 1
+    assert deleted_alarm in unit.alarms
+    # one refresh of the unit instead of one describe_alarms call per instance
+    assert aws.calls['cloudwatch:DescribeAlarms'] == 1
+
+
+def test_refresh_only_hashes_changed_alarms(load_function, tmp_path):
+    aws = fake_aws.FakeAws(instances=1)
+    load_function(aws)
+    import alarm_index
+
+    index = alarm_index.AlarmIndex(str(tmp_path / 'index.sqlite3'))
+    alarms = [{'AlarmName': 'AutoAlarm-i-1-a', 'AlarmConfigurationUpdatedTimestamp': '2024-01-01T00:00:00'},
+              {'AlarmName': 'AutoAlarm-i-1-b', 'AlarmConfigurationUpdatedTimestamp': '2024-01-01T00:00:00'},
+              {'AlarmName': 'AutoAlarm-i-2-a', 'AlarmConfigurationUpdatedTimestamp': '2024-01-02T00:00:00'}]
+    hashed = list()
+
+    def entry(alarm):
+        hashed.append(alarm['AlarmName'])
+        return 'AWS/EC2', alarm['AlarmName'] + alarm['AlarmConfigurationUpdatedTimestamp']
+
+    assert index.refresh(None, 'us-east-1', alarms, entry) == {'alarms': 3, 'updated': 3, 'removed': 0}
+    hashed.clear()
+    changed = [alarms[0], dict(alarms[2], AlarmConfigurationUpdatedTimestamp='2024-01-03T00:00:00')]
+    assert index.refresh(None, 'us-east-1', changed, entry) == {'alarms': 2, 'updated': 1, 'removed': 1}
+    assert hashed == ['AutoAlarm-i-2-a']
+    assert index.alarm_hashes(None, 'us-east-1', 'AutoAlarm-i-1-') == {
+        'AutoAlarm-i-1-a': 'AutoAlarm-i-1-a2024-01-01T00:00:00'}
+    assert index.alarm_hashes(None, 'us-east-1', 'AutoAlarm-i-2-') == {
+        'AutoAlarm-i-2-a': 'AutoAlarm-i-2-a2024-01-03T00:00:00'}
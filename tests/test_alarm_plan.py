@@ -0,0 +1,72 @@
+import fake_aws
+
+
+def entry(resource_id, *alarms):
+    return {'ResourceId': resource_id, 'Alarms': [list(alarm) for alarm in alarms]}
+
+
+def test_diff_manifests(load_function):
+    load_function(fake_aws.FakeAws(instances=1))
+    import alarm_plan
+
+    previous = [
+        entry('i-1', ('a-cpu', '1'), ('a-mem', '2')),
+        entry('i-2', ('b-cpu', '3')),
+        entry('i-3', ('c-cpu', '4'), ('c-disk', '5')),
+        entry('i-5', ('e-cpu', '6')),
+    ]
+    current = [
+        entry('i-1', ('a-cpu', '1'), ('a-mem', '2')),
+        entry('i-3', ('c-cpu', '7'), ('c-mem', '8')),
+        entry('i-4', ('d-cpu', '9')),
+        entry('i-5', ('e-cpu', '6')),
+    ]
+    # i-1 and i-5 are unchanged, i-2 is removed, i-3 is changed and i-4 is added
+    assert list(alarm_plan.diff_manifests(previous, current)) == [
+        ('i-2', [], ['b-cpu']),
+        ('i-3', ['c-cpu', 'c-mem'], ['c-disk']),
+        ('i-4', ['d-cpu'], []),
+    ]
+    assert list(alarm_plan.diff_manifests([], current[:1])) == [('i-1', ['a-cpu', 'a-mem'], [])]
+    assert list(alarm_plan.diff_manifests(previous[:1], [])) == [('i-1', [], ['a-cpu', 'a-mem'])]
+    assert list(alarm_plan.diff_manifests(previous, previous)) == []
+
+
+def test_manifest_round_trip(load_function):
+    load_function(fake_aws.FakeAws(instances=1))
+    import alarm_plan
+
+    entries = [alarm_plan.plan_entry('i-1', {'b': {'AlarmName': 'b', 'Threshold': 1.0},
+                                             'a': {'AlarmName': 'a', 'Threshold': 2.0}}),
+               alarm_plan.plan_entry('i-2', {})]
+    lines = list(alarm_plan.manifest_lines(entries))
+    assert [alarm_name for alarm_name, _ in entries[0]['Alarms']] == ['a', 'b']
+    assert list(alarm_plan.read_manifest(lines)) == entries
+    # S3 yields the lines as bytes without line ends
+    assert list(alarm_plan.read_manifest([line.rstrip('\n').encode('utf-8') for line in lines] + [b''])) == entries
+    assert alarm_plan.alarm_hash({'AlarmName': 'a', 'Threshold': 2.0}) != \
+        alarm_plan.alarm_hash({'AlarmName': 'a', 'Threshold': 3.0})
+
+
+def test_apply_plan_only_writes_changes(load_function):
+    aws = fake_aws.FakeAws(instances=30, asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2')
+    unit = aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0])
+
+    plan = cw_auto_alarms.lambda_handler({'action': 'plan'}, None)
+    assert plan['alarms_to_put'] == plan['alarms_planned'] > 0
+    assert not unit.alarms
+
+    applied = cw_auto_alarms.lambda_handler({'action': 'apply-plan'}, None)
+    assert applied['alarms_written'] == plan['alarms_planned'] == len(unit.alarms)
+
+    instance = next(instance for instance in unit.instances.values() if
+                    unit.is_tagged(instance) and instance['State']['Name'] == 'running')
+    instance['Tags'] = [tag for tag in instance['Tags'] if tag['Key'] != fake_aws.ALARM_TAG]
+    aws.calls.clear()
+    again = cw_auto_alarms.lambda_handler({'action': 'apply-plan'}, None)
+    assert again['resources_changed'] == 1
+    assert again['alarms_written'] == 0
+    assert again['alarms_deleted'] > 0
+    assert aws.calls['cloudwatch:PutMetricAlarm'] == 0
+    assert unit.alarm_names('AutoAlarm-{}-'.format(instance['InstanceId'])) == []
@@ -0,0 +1,94 @@
+import pytest
+
+import fake_aws
+
+instance_info = {
+    'InstanceId': 'i-1',
+    'ImageId': 'ami-1',
+    'InstanceType': 't3.micro',
+    'Tags': [{'Key': 'aws:autoscaling:groupName', 'Value': 'web'}]
+}
+
+metric_dimensions_map = {
+    'CWAgent': ['InstanceId', 'ImageId', 'InstanceType'],
+    'AWS/EC2': ['InstanceId'],
+    'Custom/App': ['AutoScalingGroupName', 'InstanceId']
+}
+
+instance_dimensions = [('InstanceId', 'i-1'), ('ImageId', 'ami-1'), ('InstanceType', 't3.micro')]
+
+# tag key, tag value, alarm name, metric dimensions, evaluation periods, description, as create_alarm_from_tag
+# derived them before the tag keys were compiled to alarm specs
+alarm_tags = [
+    ('AutoAlarm-AWS/EC2-CPUUtilization-GreaterThanThreshold-5m-Average', '80',
+     'AutoAlarm-i-1-AWS/EC2-CPUUtilization-GreaterThanThreshold-80-5m-1p-Average',
+     [('InstanceId', 'i-1')], 1, 'Created by cloudwatch-auto-alarms'),
+    ('AutoAlarm-AWS/EC2-CPUUtilization-GreaterThanThreshold-5m-3-Maximum-High_CPU', '90',
+     'AutoAlarm-i-1-AWS/EC2-CPUUtilization-GreaterThanThreshold-90-5m-3p-Maximum-High_CPU',
+     [('InstanceId', 'i-1')], 3, 'High CPU'),
+    ('AutoAlarm-CWAgent-disk_used_percent-device-xvda1-fstype-xfs-path-/-GreaterThanThreshold-5m-2-Average-Disk', '80',
+     'AutoAlarm-i-1-CWAgent-disk_used_percent-device-xvda1-fstype-xfs-path-/-GreaterThanThreshold-80-5m-2p-Average-'
+     'Disk',
+     instance_dimensions + [('device', 'xvda1'), ('fstype', 'xfs'), ('path', '/')], 2, 'Disk'),
+    ('AutoAlarm-CWAgent-disk_used_percent-device-*-fstype-*-path-/-GreaterThanThreshold-5m-Average', '80',
+     'AutoAlarm-i-1-CWAgent-disk_used_percent-device-*-fstype-*-path-/-GreaterThanThreshold-80-5m-1p-Average',
+     instance_dimensions + [('device', '*'), ('fstype', '*'), ('path', '/')], 1, 'Created by cloudwatch-auto-alarms'),
+    ('AutoAlarm-AWS/EC2-CPUUtilization-LessThanLowerOrGreaterThanUpperThreshold-5m-1-Average-Anomaly', '2',
+     'AutoAlarm-i-1-AWS/EC2-CPUUtilization-LessThanLowerOrGreaterThanUpperThreshold-2-5m-1p-Average-Anomaly',
+     [('InstanceId', 'i-1')], 1, 'Anomaly'),
+    ('AutoAlarm-Custom/App-QueueDepth-Queue-orders-GreaterThanOrEqualToThreshold-1h-2-Sum-Backlog', '100',
+     'AutoAlarm-i-1-Custom/App-QueueDepth-Queue-orders-GreaterThanOrEqualToThreshold-100-1h-2p-Sum-Backlog',
+     [('AutoScalingGroupName', 'web'), ('InstanceId', 'i-1'), ('Queue', 'orders')], 2, 'Backlog'),
+    ('AutoAlarm-Custom/App-QueueDepth-GreaterThanThreshold-1d-Minimum', '0',
+     'AutoAlarm-i-1-Custom/App-QueueDepth-GreaterThanThreshold-0-1d-1p-Minimum',
+     [('AutoScalingGroupName', 'web'), ('InstanceId', 'i-1')], 1, 'Created by cloudwatch-auto-alarms'),
+]
+
+
+@pytest.fixture
+def actions(load_function):
+    load_function(fake_aws.FakeAws(instances=1))
+    import actions
+    return actions
+
+
+@pytest.mark.parametrize('key, value, alarm_name, dimensions, evaluation_periods, description', alarm_tags)
+def test_alarm_from_tag(actions, key, value, alarm_name, dimensions, evaluation_periods, description):
+    alarm = actions.build_alarm_from_tag('i-1', {'Key': key, 'Value': value}, instance_info, metric_dimensions_map,
+                                         None, '-', 'AutoAlarm')
+    assert alarm['AlarmName'] == alarm_name
+    metric = alarm['Metrics'][0]['MetricStat']['Metric']
+    assert metric['Dimensions'] == [{'Name': name, 'Value': value} for name, value in dimensions]
+    assert alarm['EvaluationPeriods'] == evaluation_periods
+    assert alarm['AlarmDescription'] == description
+
+
+def test_anomaly_detection_alarm_uses_band(actions):
+    alarm = actions.build_alarm_from_tag('i-1', {'Key': alarm_tags[4][0], 'Value': '2'}, instance_info,
+                                         metric_dimensions_map, None, '-', 'AutoAlarm')
+    assert alarm['ThresholdMetricId'] == 't1'
+    assert alarm['Metrics'][1]['Expression'] == 'ANOMALY_DETECTION_BAND(m1, 2.0)'
+    assert 'Threshold' not in alarm
+
+
+def test_wildcard_spec_resolves_to_fixed_alarm(actions):
+    import alarm_spec
+
+    spec = alarm_spec.parse_alarm_spec(alarm_tags[3][0], '-')
+    assert spec.wildcard_dimensions == ('device', 'fstype')
+    resolved = spec.resolve_wildcards({'device': 'xvda1', 'fstype': 'xfs'})
+    assert resolved.key == 'AutoAlarm-CWAgent-disk_used_percent-device-xvda1-fstype-xfs-path-/-GreaterThanThreshold-' \
+                           '5m-Average'
+    assert not resolved.has_wildcards
+
+
+@pytest.mark.parametrize('key', ['AutoAlarm-AWS/EC2-CPUUtilization-5m-Average-x',
+                                 'AutoAlarm-AWS/EC2-CPUUtilization-InstanceId-GreaterThanThreshold-5m-Average',
+                                 'AutoAlarm-AWS/EC2-CPUUtilization-GreaterThanThreshold-5x-Average',
+                                 'AutoAlarm-AWS/EC2'])
+def test_invalid_tag_key_raises(actions, key):
+    import alarm_spec
+
+    with pytest.raises(alarm_spec.AlarmSpecError):
+        actions.build_alarm_from_tag('i-1', {'Key': key, 'Value': '1'}, instance_info, metric_dimensions_map, None,
+                                     '-', 'AutoAlarm')
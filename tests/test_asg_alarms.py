@@ -0,0 +1,52 @@
+import fake_aws
+
+
+def scan(load_function, **environment):
+    aws = fake_aws.FakeAws(instances=20, asg_size=10, custom_tag_fraction=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2', **environment)
+    summary = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert summary['units_failed'] == 0
+    return aws, aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0])
+
+
+def metric_dimensions(alarm):
+    return alarm['Metrics'][0]['MetricStat']['Metric']['Dimensions']
+
+
+def test_instance_alarms_without_opt_in(load_function):
+    aws, unit = scan(load_function)
+    assert unit.alarms
+    assert unit.alarm_names('AutoAlarm-asg-') == []
+    for instance_id, instance in unit.instances.items():
+        if unit.is_tagged(instance) and instance['State']['Name'] == 'running':
+            assert unit.alarm_names('AutoAlarm-{}-'.format(instance_id))
+
+
+def test_dimension_alarms_replace_instance_alarms(load_function):
+    aws, unit = scan(load_function, ASG_ALARMS='dimension')
+    # every instance is in a group, each alarm of a group is written once for all its members
+    assert unit.alarm_names('AutoAlarm-i-') == []
+    assert set(unit.alarms) == set(unit.alarm_names('AutoAlarm-asg-0-') + unit.alarm_names('AutoAlarm-asg-1-'))
+    assert aws.calls['cloudwatch:PutMetricAlarm'] == len(unit.alarms)
+
+    cpu_alarm = unit.alarms[unit.alarm_names('AutoAlarm-asg-0-AWS/EC2-CPUUtilization-')[0]]
+    assert metric_dimensions(cpu_alarm) == [{'Name': 'AutoScalingGroupName', 'Value': 'asg-0'}]
+    for alarm_name in unit.alarm_names('AutoAlarm-asg-1-CWAgent-'):
+        assert metric_dimensions(unit.alarms[alarm_name])[0] == {'Name': 'AutoScalingGroupName', 'Value': 'asg-1'}
+
+
+def test_metrics_insights_alarms_query_the_group(load_function):
+    aws, unit = scan(load_function, ASG_ALARMS='metrics-insights',
+                     CLOUDWATCH_APPEND_DIMENSIONS='InstanceId, ImageId, InstanceType, AutoScalingGroupName')
+    assert unit.alarm_names('AutoAlarm-i-') == []
+
+    agent_alarm_names = unit.alarm_names('AutoAlarm-asg-0-CWAgent-')
+    assert agent_alarm_names
+    for alarm_name in agent_alarm_names:
+        query = unit.alarms[alarm_name]['Metrics'][0]['Expression']
+        assert 'FROM SCHEMA("CWAgent", "InstanceId", "ImageId", "InstanceType", "AutoScalingGroupName"' in query
+        assert "WHERE \"AutoScalingGroupName\" = 'asg-0'" in query
+        assert 'GROUP BY "InstanceId"' in query
+    # the AWS/EC2 metrics have no AutoScalingGroupName per instance, the group metric is alarmed on
+    cpu_alarm = unit.alarms[unit.alarm_names('AutoAlarm-asg-0-AWS/EC2-CPUUtilization-')[0]]
+    assert metric_dimensions(cpu_alarm) == [{'Name': 'AutoScalingGroupName', 'Value': 'asg-0'}]
@@ -0,0 +1,89 @@
+import json
+
+import fake_aws
+
+
+def state_event(instance_id, state, region, time, account_id=fake_aws.LOCAL_ACCOUNT_ID):
+    return {'source': 'aws.ec2', 'detail-type': 'EC2 Instance State-change Notification', 'account': account_id,
+            'region': region, 'time': time, 'detail': {'instance-id': instance_id, 'state': state}}
+
+
+def sqs_batch(events):
+    return {'Records': [{'eventSource': 'aws:sqs', 'messageId': str(index), 'body': json.dumps(event)} for
+                        index, event in enumerate(events)]}
+
+
+def tagged_running_instance_ids(aws, region):
+    unit = aws.unit(fake_aws.LOCAL_ACCOUNT_ID, region)
+    return [instance_id for instance_id, instance in unit.instances.items() if
+            unit.is_tagged(instance) and instance['State']['Name'] == 'running']
+
+
+def test_events_coalesce_to_last_state_per_instance(load_function):
+    cw_auto_alarms = load_function(fake_aws.FakeAws(instances=1))
+    events = [
+        state_event('i-1', 'terminated', 'us-east-1', '2024-01-01T00:00:02Z'),
+        state_event('i-1', 'running', 'us-east-1', '2024-01-01T00:00:01Z'),
+        state_event('i-2', 'running', 'us-east-1', '2024-01-01T00:00:01Z'),
+        state_event('i-2', 'running', 'us-east-1', '2024-01-01T00:00:01Z'),
+        state_event('i-3', 'running', 'us-west-2', '2024-01-01T00:00:01Z'),
+        {'source': 'aws.ec2', 'detail': {'instance-id': 'i-4', 'state': 'stopped'}},
+        {'source': 'aws.lambda', 'detail': {'eventName': 'CreateFunction20150331'}},
+    ]
+
+    groups = cw_auto_alarms.coalesce_instance_state_events(events)
+    # the events are applied in event time order, not in batch order
+    assert groups == {
+        (fake_aws.LOCAL_ACCOUNT_ID, 'us-east-1'): {'i-1': ('terminated', [1, 0]), 'i-2': ('running', [2, 3])},
+        (fake_aws.LOCAL_ACCOUNT_ID, 'us-west-2'): {'i-3': ('running', [4])},
+    }
+
+
+def test_sqs_batch_processes_each_instance_once(load_function):
+    aws = fake_aws.FakeAws(instances=40, regions=('us-east-1', 'us-west-2'), asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2')
+    started = [(instance_id, region) for region in aws.regions for instance_id in
+               tagged_running_instance_ids(aws, region)[:5]]
+    events = [state_event(instance_id, 'running', region, '2024-01-01T00:00:01Z') for instance_id, region in
+              started]
+    # delivered twice, and one instance is terminated right after it started
+    events += list(events)
+    terminated_id, terminated_region = started[0]
+    events.append(state_event(terminated_id, 'terminated', terminated_region, '2024-01-01T00:00:02Z'))
+
+    response = cw_auto_alarms.lambda_handler(sqs_batch(events), None)
+    assert response == {'batchItemFailures': []}
+    # the started instances of a region are described together
+    assert aws.calls['ec2:DescribeInstances'] == len(aws.regions)
+    for instance_id, region in started:
+        alarm_names = aws.unit(fake_aws.LOCAL_ACCOUNT_ID, region).alarm_names('AutoAlarm-{}-'.format(instance_id))
+        if instance_id == terminated_id:
+            assert alarm_names == []
+        else:
+            assert alarm_names
+    assert aws.calls['cloudwatch:PutMetricAlarm'] == sum(
+        len(aws.unit(fake_aws.LOCAL_ACCOUNT_ID, region).alarms) for region in aws.regions)
+
+
+def test_sqs_batch_reports_messages_of_failed_group(load_function, monkeypatch):
+    aws = fake_aws.FakeAws(instances=20, regions=('us-east-1', 'us-west-2'), asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2')
+    describe_instances = fake_aws.Ec2Client.describe_instances
+
+    def describe_or_fail(self, **request):
+        if self.region == 'us-west-2':
+            raise fake_aws.ClientError({'Error': {'Code': 'InternalFailure', 'Message': 'injected failure'}},
+                                       'DescribeInstances')
+        return describe_instances(self, **request)
+
+    monkeypatch.setattr(fake_aws.Ec2Client, 'describe_instances', describe_or_fail)
+    events = [state_event(instance_id, 'running', region, '2024-01-01T00:00:01Z') for region in aws.regions for
+              instance_id in tagged_running_instance_ids(aws, region)[:3]]
+    events.append(state_event(tagged_running_instance_ids(aws, 'us-west-2')[3], 'terminated', 'us-west-2',
+                              '2024-01-01T00:00:01Z'))
+
+    response = cw_auto_alarms.lambda_handler(sqs_batch(events), None)
+    # only the started instances of the failed region are delivered again, its terminated instance is processed
+    assert response == {'batchItemFailures': [{'itemIdentifier': str(index)} for index in range(3, 6)]}
+    assert aws.unit(fake_aws.LOCAL_ACCOUNT_ID, 'us-east-1').alarms
+    assert aws.calls['cloudwatch:DescribeAlarms'] == 1
@@ -0,0 +1,97 @@
+import pytest
+
+from conftest import failing_put_metric_alarm, fingerprint_tag
+import fake_aws
+
+
+def tagged_running_instances(aws):
+    unit = aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0])
+    return [instance for instance in unit.instances.values() if
+            unit.is_tagged(instance) and instance['State']['Name'] == 'running']
+
+
+def test_scan_skips_instances_with_current_fingerprint(load_function):
+    aws = fake_aws.FakeAws(instances=30, asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2')
+
+    first = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert first['alarms_written'] > 0
+    assert all(fingerprint_tag(instance) for instance in tagged_running_instances(aws))
+
+    aws.calls.clear()
+    second = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert second['alarms_written'] == 0
+    assert aws.calls['cloudwatch:PutMetricAlarm'] == 0
+
+
+@pytest.mark.parametrize('reconcile_alarms', ['false', 'true'])
+def test_failed_alarm_write_is_retried_by_next_scan(load_function, monkeypatch, reconcile_alarms):
+    aws = fake_aws.FakeAws(instances=30, asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2', RECONCILE_ALARMS=reconcile_alarms)
+    failing_instance_id = tagged_running_instances(aws)[0]['InstanceId']
+    # clients are pooled with their methods, the failure is switched off rather than unpatched
+    failing = [True]
+    monkeypatch.setattr(fake_aws.CloudWatchClient, 'put_metric_alarm', failing_put_metric_alarm(
+        lambda alarm: failing and failing_instance_id in alarm['AlarmName'] and 'CPUUtilization' in
+        alarm['AlarmName']))
+
+    cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    for instance in tagged_running_instances(aws):
+        if instance['InstanceId'] == failing_instance_id:
+            assert fingerprint_tag(instance) == ''
+        else:
+            assert fingerprint_tag(instance)
+
+    failing.clear()
+    second = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    unit = aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0])
+    # only the failed instance is processed again, reconciliation only writes its missing alarm
+    if reconcile_alarms == 'true':
+        assert second['alarms_written'] == 1
+    else:
+        assert second['alarms_written'] == len(unit.alarm_names('AutoAlarm-{}-'.format(failing_instance_id)))
+    assert any('CPUUtilization' in name for name in unit.alarm_names('AutoAlarm-{}-'.format(failing_instance_id)))
+    assert fingerprint_tag(unit.instances[failing_instance_id])
+
+
+def test_failed_alarm_write_leaves_event_instance_untagged(load_function, monkeypatch):
+    aws = fake_aws.FakeAws(instances=30, asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2')
+    instance_id = tagged_running_instances(aws)[0]['InstanceId']
+    monkeypatch.setattr(fake_aws.CloudWatchClient, 'put_metric_alarm', failing_put_metric_alarm(lambda alarm: True))
+    event = {'source': 'aws.ec2', 'detail-type': 'EC2 Instance State-change Notification',
+             'account': fake_aws.LOCAL_ACCOUNT_ID, 'region': aws.regions[0],
+             'detail': {'instance-id': instance_id, 'state': 'running'}}
+
+    cw_auto_alarms.lambda_handler(event, None)
+    assert fingerprint_tag(aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0]).instances[instance_id]) == ''
+
+    cw_auto_alarms.lambda_handler({'Records': [{'eventSource': 'aws:sqs', 'messageId': '1',
+                                                'body': cw_auto_alarms.json.dumps(event)}]}, None)
+    assert fingerprint_tag(aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0]).instances[instance_id]) == ''
+
+
+def test_scan_writes_only_changed_lambda_and_rds_alarms(load_function):
+    aws = fake_aws.FakeAws(instances=200, asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='lambda,rds')
+    unit = aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0])
+
+    first = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert first['alarms_written'] == len(unit.alarms) > 0
+    assert any('AWS/Lambda' in alarm_name for alarm_name in unit.alarms)
+    assert any('AWS/RDS' in alarm_name for alarm_name in unit.alarms)
+
+    aws.calls.clear()
+    second = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert second['alarms_written'] == 0
+    assert aws.calls['cloudwatch:PutMetricAlarm'] == 0
+
+    # a deleted alarm and the alarms of a retagged function are written again
+    function = next(function for function in unit.functions if fake_aws.ALARM_TAG in function['_tags'])
+    function['_tags']['AutoAlarm-AWS/Lambda-Throttles-GreaterThanThreshold-5m-Sum'] = '1'
+    deleted_alarm_name = next(alarm_name for alarm_name in unit.alarms if 'AWS/RDS' in alarm_name)
+    unit.delete_alarm(deleted_alarm_name)
+    third = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert third['alarms_written'] == 2
+    assert deleted_alarm_name in unit.alarms
+    assert unit.alarm_names('AutoAlarm-{}-AWS/Lambda-Throttles-'.format(function['FunctionName']))
@@ -0,0 +1,67 @@
+import fake_aws
+
+
+def suspend_accounts(monkeypatch, suspended_account_ids):
+    list_accounts_for_parent = fake_aws.OrganizationsClient.list_accounts_for_parent
+
+    def list_with_suspended_accounts(self, **request):
+        response = list_accounts_for_parent(self, **request)
+        for account in response['Accounts']:
+            if account['Id'] in suspended_account_ids:
+                account['Status'] = 'SUSPENDED'
+        return response
+
+    monkeypatch.setattr(fake_aws.OrganizationsClient, 'list_accounts_for_parent', list_with_suspended_accounts)
+
+
+def organization_calls(aws):
+    return sum(count for operation, count in aws.calls.items() if operation.startswith('organizations:'))
+
+
+def test_scan_covers_active_accounts_of_nested_organizational_units(load_function, monkeypatch):
+    aws = fake_aws.FakeAws(accounts=6, instances=60, regions=('us-east-1', 'us-west-2'), asg_size=0)
+    suspended_account_id = aws.account_ids[4]
+    suspend_accounts(monkeypatch, [suspended_account_id])
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2')
+
+    scan_units = cw_auto_alarms.get_scan_units()
+    # the accounts are spread over the target OU, its child and its grandchild
+    active_account_ids = [account_id for account_id in aws.account_ids if account_id != suspended_account_id]
+    assert sorted(scan_units) == sorted((fake_aws.ORGANIZATIONAL_UNIT_ID, account_id, region) for account_id in
+                                        active_account_ids for region in aws.regions)
+    assert aws.calls['organizations:ListAccountsForParent'] == len(fake_aws.NESTED_ORGANIZATIONAL_UNIT_IDS)
+
+    summary = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert summary['units_processed'] == len(scan_units)
+    for account_id in aws.account_ids:
+        for region in aws.regions:
+            assert bool(aws.unit(account_id, region).alarms) == (account_id != suspended_account_id)
+
+
+def test_nested_target_organizational_unit_is_its_own_root(load_function):
+    aws = fake_aws.FakeAws(accounts=6, instances=6, asg_size=0)
+    grandchild_ou_id = fake_aws.NESTED_ORGANIZATIONAL_UNIT_IDS[2]
+    cw_auto_alarms = load_function(aws, TARGET_ORG_UNITS=','.join([fake_aws.ORGANIZATIONAL_UNIT_ID,
+                                                                   grandchild_ou_id]))
+
+    scan_units = cw_auto_alarms.get_scan_units()
+    # every account is scanned once, under the nearest target OU above it
+    assert sorted(account_id for _, account_id, _ in scan_units) == sorted(aws.account_ids)
+    assert sorted(account_id for ou_id, account_id, _ in scan_units if ou_id == grandchild_ou_id) == \
+        [account_id for index, account_id in enumerate(aws.account_ids) if index % 3 == 2]
+
+
+def test_account_inventory_is_cached(load_function):
+    aws = fake_aws.FakeAws(accounts=6, instances=6, asg_size=0)
+    cw_auto_alarms = load_function(aws)
+    import actions
+
+    scan_units = cw_auto_alarms.get_scan_units()
+    calls = organization_calls(aws)
+    assert calls > 0
+    assert cw_auto_alarms.get_scan_units() == scan_units
+    assert organization_calls(aws) == calls
+
+    actions.account_inventory_cache.clear()
+    assert cw_auto_alarms.get_scan_units() == scan_units
+    assert organization_calls(aws) == 2 * calls
@@ -0,0 +1,67 @@
+import pytest
+
+import fake_aws
+
+
+def put_alarm(aws, alarm_name, namespace):
+    aws.client('cloudwatch', aws.regions[0]).put_metric_alarm(AlarmName=alarm_name, Namespace=namespace,
+                                                               MetricName='Errors')
+
+
+@pytest.mark.parametrize('use_alarm_index', [False, True])
+def test_sweep_deletes_only_alarms_of_missing_resources(load_function, tmp_path, use_alarm_index):
+    aws = fake_aws.FakeAws(instances=40, asg_size=0)
+    environment = {'SCAN_RESOURCE_TYPES': 'ec2'}
+    if use_alarm_index:
+        environment['ALARM_INDEX'] = str(tmp_path / 'index.sqlite3')
+    cw_auto_alarms = load_function(aws, **environment)
+    cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    unit = aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0])
+
+    removed_ids = [instance_id for instance_id in unit.instances if
+                   unit.alarm_names('AutoAlarm-{}-'.format(instance_id))][:2]
+    orphaned = set(name for instance_id in removed_ids for name in
+                   unit.alarm_names('AutoAlarm-{}-'.format(instance_id)))
+    for instance_id in removed_ids:
+        del unit.instances[instance_id]
+    live_function = unit.functions[0]['FunctionName']
+    put_alarm(aws, 'AutoAlarm-{}-AWS/Lambda-Errors-GreaterThanThreshold-1-5m-1p-Sum'.format(live_function),
+              'AWS/Lambda')
+    put_alarm(aws, 'AutoAlarm-deleted-function-AWS/Lambda-Errors-GreaterThanThreshold-1-5m-1p-Sum', 'AWS/Lambda')
+    orphaned.add('AutoAlarm-deleted-function-AWS/Lambda-Errors-GreaterThanThreshold-1-5m-1p-Sum')
+    # the resource type of the namespace is unknown, the alarm is kept
+    put_alarm(aws, 'AutoAlarm-deleted-queue-AWS/SQS-ApproximateAgeOfOldestMessage-GreaterThanThreshold-1-5m-1p-Max',
+              'AWS/SQS')
+    alarms = set(unit.alarms)
+
+    dry_run = cw_auto_alarms.lambda_handler({'action': 'collect-orphaned-alarms', 'dry_run': True}, None)
+    assert dry_run['dry_run']
+    assert dry_run['alarms'] == len(alarms)
+    assert dry_run['alarms_orphaned'] == len(orphaned)
+    assert dry_run['alarms_deleted'] == 0
+    assert set(unit.alarms) == alarms
+
+    summary = cw_auto_alarms.lambda_handler({'action': 'collect-orphaned-alarms'}, None)
+    assert summary['alarms_deleted'] == len(orphaned)
+    assert set(unit.alarms) == alarms - orphaned
+
+
+def test_sweep_keeps_alarms_of_resources_that_cannot_be_listed(load_function, monkeypatch):
+    aws = fake_aws.FakeAws(instances=40, asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2')
+    cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    unit = aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0])
+    put_alarm(aws, 'AutoAlarm-deleted-function-AWS/Lambda-Errors-GreaterThanThreshold-1-5m-1p-Sum', 'AWS/Lambda')
+
+    def fail(self, **request):
+        raise fake_aws.ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'injected failure'}},
+                                   'ListFunctions')
+
+    monkeypatch.setattr(fake_aws.LambdaClient, 'list_functions', fail)
+    alarms = set(unit.alarms)
+
+    summary = cw_auto_alarms.lambda_handler({'action': 'collect-orphaned-alarms'}, None)
+    assert summary['units_failed'] == 0
+    assert summary['alarms_unverified'] == 1
+    assert summary['alarms_deleted'] == 0
+    assert set(unit.alarms) == alarms
@@ -0,0 +1,134 @@
+import pytest
+
+import fake_aws
+
+
+class CountdownDeadline:
+    """
+    A deadline that is reached after a number of checks, the scan checks it before every instance.
+    """
+
+    def __init__(self, checks):
+        self.checks = checks
+
+    def reached(self):
+        self.checks -= 1
+        return self.checks < 0
+
+    def remaining(self):
+        return None
+
+
+class Context:
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:{}:function:CloudWatchAutoAlarms'.format(
+        fake_aws.LOCAL_ACCOUNT_ID)
+
+
+def fleet_alarms(aws):
+    return sum(len(aws.unit(account_id, region).alarms) for account_id in aws.account_ids for region in aws.regions)
+
+
+def test_interrupted_scan_resumes_from_checkpoint(load_function, monkeypatch):
+    aws = fake_aws.FakeAws(instances=60, regions=('us-east-1', 'us-west-2'), asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2')
+    monkeypatch.setattr(cw_auto_alarms, 'Deadline', lambda context, margin: CountdownDeadline(15))
+
+    first = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert not first['complete']
+    assert first['units_interrupted'] > 0
+    assert 0 < fleet_alarms(aws)
+
+    monkeypatch.setattr(cw_auto_alarms, 'Deadline', lambda context, margin: CountdownDeadline(1000))
+    second = cw_auto_alarms.lambda_handler({'action': 'scan', 'scan_id': first['scan_id']}, None)
+    assert second['complete']
+    assert second['scan_id'] == first['scan_id']
+    # every instance is processed by exactly one of the invocations
+    assert second['totals']['alarms_written'] == fleet_alarms(aws)
+    assert aws.calls['cloudwatch:PutMetricAlarm'] == fleet_alarms(aws)
+
+
+def test_continuation_of_completed_scan_does_nothing(load_function):
+    aws = fake_aws.FakeAws(instances=20, asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2')
+    first = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert first['complete']
+
+    aws.calls.clear()
+    second = cw_auto_alarms.lambda_handler({'action': 'scan', 'scan_id': first['scan_id']}, None)
+    assert second == {'scan_id': first['scan_id'], 'complete': True}
+    assert not aws.calls
+
+
+def test_continuation_without_checkpoint_starts_over(load_function, caplog):
+    aws = fake_aws.FakeAws(instances=20, asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2', SKIP_UNCHANGED_RESOURCES='false')
+
+    summary = cw_auto_alarms.lambda_handler({'action': 'scan', 'scan_id': 'lost'}, None)
+    assert summary['complete']
+    assert summary['scan_id'] != 'lost'
+    assert summary['alarms_written'] == fleet_alarms(aws) > 0
+    assert any(record.levelname == 'ERROR' and 'lost' in record.getMessage() for record in caplog.records)
+
+
+def test_continuation_is_off_without_shared_store(load_function, monkeypatch):
+    aws = fake_aws.FakeAws(instances=20, asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2')
+    monkeypatch.setattr(cw_auto_alarms, 'Deadline', lambda context, margin: CountdownDeadline(3))
+
+    summary = cw_auto_alarms.lambda_handler({'action': 'scan'}, Context())
+    assert not summary['complete']
+    assert not aws.calls['lambda:Invoke']
+
+
+def test_continuation_with_local_store_fails_to_load(load_function):
+    aws = fake_aws.FakeAws(instances=1)
+    with pytest.raises(Exception, match='SCAN_CONTINUATION'):
+        load_function(aws, SCAN_CONTINUATION='true')
+
+
+def test_continuation_retries_failed_unit(load_function, monkeypatch):
+    aws = fake_aws.FakeAws(instances=60, regions=('us-east-1', 'us-west-2'), asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2')
+    describe_instances = fake_aws.Ec2Client.describe_instances
+    # clients are pooled with their methods, the failure is switched off rather than unpatched
+    failing = [True]
+
+    def describe_or_fail(self, **request):
+        if failing and self.region == 'us-west-2':
+            raise fake_aws.ClientError({'Error': {'Code': 'InternalFailure', 'Message': 'injected failure'}},
+                                       'DescribeInstances')
+        return describe_instances(self, **request)
+
+    monkeypatch.setattr(fake_aws.Ec2Client, 'describe_instances', describe_or_fail)
+    monkeypatch.setattr(cw_auto_alarms, 'Deadline', lambda context, margin: CountdownDeadline(15))
+    first = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert first['units_failed'] == 1
+    assert first['units_interrupted'] == 1
+    assert not aws.unit(fake_aws.LOCAL_ACCOUNT_ID, 'us-west-2').alarms
+
+    failing.clear()
+    monkeypatch.setattr(cw_auto_alarms, 'Deadline', lambda context, margin: CountdownDeadline(1000))
+    second = cw_auto_alarms.lambda_handler({'action': 'scan', 'scan_id': first['scan_id']}, None)
+    assert second['complete']
+    assert second['units_processed'] == 2
+    assert second['totals']['units_failed'] == 0
+    assert second['totals']['failures'] == []
+    assert aws.unit(fake_aws.LOCAL_ACCOUNT_ID, 'us-west-2').alarms
+
+
+def test_stale_checkpoint_is_abandoned(load_function, monkeypatch):
+    aws = fake_aws.FakeAws(instances=60, regions=('us-east-1', 'us-west-2'), asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2', SCAN_CHECKPOINT_MAX_AGE='3600')
+    import scan_state
+
+    monkeypatch.setattr(cw_auto_alarms, 'Deadline', lambda context, margin: CountdownDeadline(15))
+    first = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert not first['complete']
+    monkeypatch.setattr(scan_state.ScanCheckpoint, 'age', lambda self: 7200)
+
+    monkeypatch.setattr(cw_auto_alarms, 'Deadline', lambda context, margin: CountdownDeadline(1000))
+    second = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert second['complete']
+    assert second['scan_id'] != first['scan_id']
+    assert second['units_skipped'] == 0
+    assert second['totals']['alarms_written'] == second['alarms_written']
@@ -0,0 +1,128 @@
+import json
+import threading
+
+import pytest
+
+import fake_aws
+
+
+def shard_summary(alarms_written):
+    return {'units_processed': 1, 'units_failed': 0, 'units_interrupted': 0, 'alarms_written': alarms_written,
+            'failures': []}
+
+
+def deliver_shards(cw_auto_alarms, actions):
+    while len(actions.local_work_queue):
+        for receipt_handle, message in actions.local_work_queue.receive(1):
+            cw_auto_alarms.lambda_handler({'Records': [{'eventSource': 'aws:sqs', 'receiptHandle': receipt_handle,
+                                                        'messageId': receipt_handle, 'body': json.dumps(message)}]},
+                                          None)
+
+
+def test_sharded_scan_completes(load_function):
+    aws = fake_aws.FakeAws(accounts=2, instances=40, regions=('us-east-1', 'us-west-2'), asg_size=0)
+    cw_auto_alarms = load_function(aws, SCAN_RESOURCE_TYPES='ec2', SCAN_SHARD_QUEUE='local')
+    import actions
+
+    started = cw_auto_alarms.lambda_handler({'action': 'scan'}, None)
+    assert started['status'] == 'running'
+    assert started['shards'] == 4
+    deliver_shards(cw_auto_alarms, actions)
+
+    status = cw_auto_alarms.lambda_handler({'action': 'scan-status'}, None)
+    assert status['status'] == 'complete'
+    assert status['shards_done'] == 4
+    alarms = sum(len(aws.unit(account_id, region).alarms) for account_id in aws.account_ids for region in
+                 aws.regions)
+    assert status['summary']['alarms_written'] == alarms > 0
+
+
+def test_shards_finishing_together_complete_the_scan_once(load_function, tmp_path):
+    load_function(fake_aws.FakeAws(instances=1))
+    import scan_state
+    import sharded_scan
+    import work_queue
+
+    barrier = threading.Barrier(2)
+    waited = threading.local()
+
+    class ConcurrentStore(scan_state.LocalFileStateStore):
+        # both shards list the done markers of both before either goes on
+        def list(self, prefix):
+            if prefix.startswith('shard-done-') and threading.current_thread().name.startswith('shard') and \
+                    not getattr(waited, 'done', False):
+                waited.done = True
+                barrier.wait(timeout=10)
+                keys = super().list(prefix)
+                barrier.wait(timeout=10)
+                return keys
+            return super().list(prefix)
+
+    store = ConcurrentStore(str(tmp_path / 'state'))
+    queue = work_queue.LocalWorkQueue()
+    sharded_scan.start_sharded_scan([(None, None, 'us-east-1'), (None, None, 'us-west-2')], store, queue, 86400)
+    shards = [message for _, message in queue.receive()]
+    results = dict()
+    errors = list()
+
+    def finish(shard):
+        try:
+            checkpoint = sharded_scan.load_shard_checkpoint(store, shard)
+            results[shard['shard_id']] = sharded_scan.finish_shard(store, queue, shard, checkpoint,
+                                                                   shard_summary(10))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=finish, args=(shard,), name='shard-{}'.format(shard['shard_id'])) for
+               shard in shards]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sum(1 for result in results.values() if 'scan' in result) == 1
+    status = sharded_scan.sharded_scan_status(store)
+    assert status['status'] == 'complete'
+    assert status['summary']['alarms_written'] == 20
+
+
+def test_completion_skips_missing_done_markers(load_function, tmp_path):
+    load_function(fake_aws.FakeAws(instances=1))
+    import scan_state
+    import sharded_scan
+    import work_queue
+
+    store = scan_state.LocalFileStateStore(str(tmp_path / 'state'))
+    queue = work_queue.LocalWorkQueue()
+    sharded_scan.start_sharded_scan([(None, None, 'us-east-1'), (None, None, 'us-west-2')], store, queue, 86400)
+    scan_id = store.load(sharded_scan.manifest_key)['ScanId']
+    store.save('{}0'.format(sharded_scan.shard_done_prefix(scan_id)), {'Summary': shard_summary(10)})
+    store.save('{}1'.format(sharded_scan.shard_done_prefix(scan_id)), {'Summary': shard_summary(10)})
+    load = store.load
+    store.load = lambda key: None if key.endswith('-1') else load(key)
+
+    status = sharded_scan.complete_sharded_scan(store, load(sharded_scan.manifest_key))
+    assert status['status'] == 'complete'
+    assert status['summary']['alarms_written'] == 10
+
+
+def test_sqs_shard_queue_with_local_store_fails_to_load(load_function):
+    aws = fake_aws.FakeAws(instances=1)
+    with pytest.raises(Exception, match='SCAN_SHARD_QUEUE'):
+        load_function(aws, SCAN_SHARD_QUEUE='https://sqs.us-east-1.amazonaws.com/{}/shards'.format(
+            fake_aws.LOCAL_ACCOUNT_ID))
+
+
+@pytest.mark.parametrize('url', ['https://sqs.us-west-2.amazonaws.com/100000000000/shards',
+                                 'https://us-west-2.queue.amazonaws.com/100000000000/shards',
+                                 'https://vpce-0a1b2c3d-4e5f6a7b.sqs.us-west-2.vpce.amazonaws.com/100000000000/shards'])
+def test_shard_queue_client_uses_function_region(load_function, monkeypatch, url):
+    load_function(fake_aws.FakeAws(instances=1, regions=('us-west-2',)))
+    import actions
+
+    regions = list()
+    monkeypatch.setattr(actions, 'boto3_client', lambda service, region: regions.append(region))
+    queue = actions.get_work_queue(url)
+    assert regions == ['us-west-2']
+    assert queue.queue_url == url
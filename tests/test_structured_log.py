@@ -0,0 +1,24 @@
+import logging
+
+import fake_aws
+
+
+def test_large_cleanup_stays_within_log_budget(load_function, caplog):
+    aws = fake_aws.FakeAws(instances=1)
+    cw_auto_alarms = load_function(aws, LOG_BYTE_BUDGET='32768', LOG_SAMPLE_FIRST='2', LOG_SAMPLE_EVERY='0')
+    cloudwatch = aws.client('cloudwatch', aws.regions[0])
+    instance_id = 'i-0000000000000000a'
+    for n in range(1000):
+        cloudwatch.put_metric_alarm(
+            AlarmName='AutoAlarm-{}-AWS/EC2-CPUUtilization-GreaterThanThreshold-{}-5m-1p-Average'.format(
+                instance_id, n), Namespace='AWS/EC2', MetricName='CPUUtilization')
+
+    caplog.set_level(logging.DEBUG)
+    cw_auto_alarms.lambda_handler({'source': 'aws.ec2', 'detail-type': 'EC2 Instance State-change Notification',
+                                   'account': fake_aws.LOCAL_ACCOUNT_ID, 'region': aws.regions[0],
+                                   'detail': {'instance-id': instance_id, 'state': 'terminated'}}, None)
+    assert aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0]).alarms == {}
+    # ten delete_alarms batches, only the first two are logged with their alarm names
+    assert sum(len(record.getMessage()) for record in caplog.records if record.levelno < logging.WARNING) <= 32768
+    assert sum('"kind":"alarms_deleted"' in record.getMessage() for record in caplog.records) == 2
+    assert any('"kind":"log_summary"' in record.getMessage() for record in caplog.records)
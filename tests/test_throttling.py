@@ -0,0 +1,99 @@
+import threading
+
+import pytest
+
+import fake_aws
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def throttling(load_function, monkeypatch):
+    load_function(fake_aws.FakeAws(instances=1))
+    import throttling
+
+    clock = Clock()
+    monkeypatch.setattr(throttling.time, 'monotonic', clock)
+    monkeypatch.setattr(throttling.time, 'sleep', lambda seconds: None)
+    throttling.clock = clock
+    return throttling
+
+
+def test_token_bucket_refills_at_rate(throttling):
+    bucket = throttling.TokenBucket(2, burst=4)
+    assert [bucket.acquire() for _ in range(4)] == [0, 0, 0, 0]
+    # the bucket is empty, the next tokens are reserved half a second apart
+    assert bucket.acquire() == pytest.approx(0.5)
+    assert bucket.acquire() == pytest.approx(1.0)
+
+    throttling.clock.now += 1.0
+    assert bucket.acquire() == pytest.approx(0.5)
+    # refilled up to the burst and no further
+    throttling.clock.now += 60.0
+    assert [bucket.acquire() for _ in range(4)] == [0, 0, 0, 0]
+    assert bucket.acquire() == pytest.approx(0.5)
+
+
+def test_rate_limiter_limits_each_account_region_and_family(throttling):
+    limiter = throttling.RateLimiter({'ec2:Describe*': 1, 'cloudwatch:PutMetricAlarm': 0})
+    assert limiter.acquire('ec2', 'DescribeInstances', 'a', 'us-east-1') == 0
+    assert limiter.acquire('ec2', 'DescribeImages', 'a', 'us-east-1') == pytest.approx(1.0)
+    assert limiter.acquire('ec2', 'DescribeInstances', 'b', 'us-east-1') == 0
+    assert limiter.acquire('ec2', 'DescribeInstances', 'a', 'us-west-2') == 0
+    assert [limiter.acquire('cloudwatch', 'PutMetricAlarm', 'a', 'us-east-1') for _ in range(10)] == [0] * 10
+    assert limiter.waited == pytest.approx(1.0)
+
+
+def test_adaptive_concurrency_decreases_and_increases(throttling):
+    concurrency = throttling.AdaptiveConcurrency(8, cooldown=1.0)
+    concurrency.on_throttle()
+    # a burst of throttles within the cooldown counts once
+    concurrency.on_throttle()
+    assert concurrency.stats() == {'limit': 4, 'max_limit': 8, 'lowest_limit': 4, 'decreases': 1}
+    throttling.clock.now += 1.0
+    concurrency.on_throttle()
+    assert concurrency.stats()['limit'] == 2
+    throttling.clock.now += 1.0
+    concurrency.on_throttle()
+    throttling.clock.now += 1.0
+    concurrency.on_throttle()
+    assert concurrency.stats()['limit'] == 1
+
+    # every success adds 1 / limit, about one worker per round of calls
+    concurrency.on_success()
+    assert concurrency.stats()['limit'] == 2
+    for _ in range(3):
+        concurrency.on_success()
+    assert concurrency.stats()['limit'] == 3
+    for _ in range(100):
+        concurrency.on_success()
+    assert concurrency.stats() == {'limit': 8, 'max_limit': 8, 'lowest_limit': 1, 'decreases': 4}
+
+
+def test_adaptive_concurrency_reset_keeps_held_slots(throttling):
+    concurrency = throttling.AdaptiveConcurrency(2)
+    held = [concurrency.slot(), concurrency.slot()]
+    for slot in held:
+        slot.__enter__()
+    concurrency.reset(2)
+    entered = threading.Event()
+
+    def work():
+        with concurrency.slot():
+            entered.set()
+
+    worker = threading.Thread(target=work)
+    worker.start()
+    # both slots are still held by workers of the earlier run
+    assert not entered.wait(0.2)
+    held[0].__exit__(None, None, None)
+    assert entered.wait(5)
+    worker.join()
+    held[1].__exit__(None, None, None)
+    assert concurrency._in_flight == 0
@@ -0,0 +1,61 @@
+import fake_aws
+
+disk_tags = [
+    {'Key': 'AutoAlarm-CWAgent-disk_used_percent-device-*-fstype-*-path-*-GreaterThanThreshold-5m-Average',
+     'Value': '80'},
+    {'Key': 'AutoAlarm-CWAgent-disk_used_percent-device-*-fstype-*-path-/-GreaterThanThreshold-5m-Average-Root',
+     'Value': '90'},
+]
+
+
+def instances_of(aws, platform):
+    unit = aws.unit(fake_aws.LOCAL_ACCOUNT_ID, aws.regions[0])
+    return [instance for instance in unit.instances.values() if instance['_platform'] == platform]
+
+
+def test_wildcard_tags_sharing_fixed_dimensions_list_metrics_once(load_function):
+    aws = fake_aws.FakeAws(instances=10, asg_size=0)
+    cw_auto_alarms = load_function(aws)
+    import actions
+
+    ubuntu, other_ubuntu = instances_of(aws, 'ubuntu')
+    resolved = actions.resolve_wildcard_alarms(disk_tags, '-', ubuntu, cw_auto_alarms.metric_dimensions_map,
+                                               aws.regions[0])
+    # the path is fixed for the second tag only, both are resolved from the instance's disk metrics
+    assert aws.calls['cloudwatch:ListMetrics'] == 1
+    assert resolved == [
+        {'Key': 'AutoAlarm-CWAgent-disk_used_percent-device-xvda1-fstype-ext4-path-/-GreaterThanThreshold-5m-Average',
+         'Value': '80'},
+        {'Key': 'AutoAlarm-CWAgent-disk_used_percent-device-xvdb-fstype-ext4-path-/data-GreaterThanThreshold-5m-'
+                'Average', 'Value': '80'},
+        {'Key': 'AutoAlarm-CWAgent-disk_used_percent-device-xvda1-fstype-ext4-path-/-GreaterThanThreshold-5m-Average-'
+                'Root', 'Value': '90'},
+    ]
+
+    # the metrics of the instance are cached, another instance has its own fixed dimensions
+    assert actions.resolve_wildcard_alarms(disk_tags, '-', ubuntu, cw_auto_alarms.metric_dimensions_map,
+                                           aws.regions[0]) == resolved
+    assert aws.calls['cloudwatch:ListMetrics'] == 1
+    assert len(actions.resolve_wildcard_alarms(disk_tags, '-', other_ubuntu, cw_auto_alarms.metric_dimensions_map,
+                                               aws.regions[0])) == 3
+    assert aws.calls['cloudwatch:ListMetrics'] == 2
+
+
+def test_wildcard_tags_of_different_metrics_list_metrics_once(load_function):
+    aws = fake_aws.FakeAws(instances=10, asg_size=0)
+    cw_auto_alarms = load_function(aws)
+    import actions
+
+    al2 = instances_of(aws, 'al2')[0]
+    wildcard_tags = disk_tags + [
+        {'Key': 'AutoAlarm-CWAgent-mem_used_percent-GreaterThanThreshold-5m-Average', 'Value': '90'},
+    ]
+    # the metric names differ, all metrics with the fixed dimensions of the instance are listed
+    resolved = actions.resolve_wildcard_alarms(wildcard_tags, '-', al2, cw_auto_alarms.metric_dimensions_map,
+                                               aws.regions[0])
+    assert aws.calls['cloudwatch:ListMetrics'] == 1
+    assert [tag['Key'] for tag in resolved] == [
+        'AutoAlarm-CWAgent-disk_used_percent-device-nvme0n1p1-fstype-xfs-path-/-GreaterThanThreshold-5m-Average',
+        'AutoAlarm-CWAgent-disk_used_percent-device-nvme0n1p1-fstype-xfs-path-/-GreaterThanThreshold-5m-Average-Root',
+        'AutoAlarm-CWAgent-mem_used_percent-GreaterThanThreshold-5m-Average',
+    ]